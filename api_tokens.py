@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# A token revoked by another process stops working within this long
+TOKEN_TTL = 60.0
+# last_used is written back at most this often
+FLUSH_INTERVAL = 30.0
+
+
+class TokenCache:
+    """
+    In-process cache of valid API tokens
+
+    Clients authenticate every heartbeat, stats post and command poll, so a
+    token is looked up in the database once per TOKEN_TTL instead of once
+    per request. Revoking a token through invalidate() takes effect at once
+    in this process and within TOKEN_TTL in any other.
+
+    last_used is only recorded in memory per request; the latest time of
+    every token used since the previous flush is handed to the flush
+    function every FLUSH_INTERVAL seconds, to be written in one statement.
+    Only valid tokens are cached, so a newly issued token works immediately.
+    """
+
+    def __init__(self, loader, flusher, ttl=TOKEN_TTL, flush_interval=FLUSH_INTERVAL):
+        """
+        Args:
+            loader (callable): Called with a token string; returns (token_id,
+                client_id) for a valid token, or None
+            flusher (callable): Called with {token_id: last_used datetime};
+                raises if the times could not be written
+            ttl (float): Seconds a looked-up token is trusted
+            flush_interval (float): Seconds between last_used flushes
+        """
+        self.loader = loader
+        self.flusher = flusher
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._tokens = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def validate(self, token):
+        """
+        Check a token and record its use
+
+        Args:
+            token (str): Bearer token sent by the client
+
+        Returns:
+            int: The client id the token belongs to, or None if it is not valid
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tokens.get(token)
+        if entry and entry[2] > now:
+            self.hits += 1
+        else:
+            self.misses += 1
+            found = self.loader(token)
+            if found is None:
+                with self._lock:
+                    self._tokens.pop(token, None)
+                return None
+            entry = (found[0], found[1], now + self.ttl)
+            with self._lock:
+                self._tokens[token] = entry
+
+        with self._lock:
+            self._last_used[entry[0]] = datetime.utcnow()
+        self._start()
+        return entry[1]
+
+    def invalidate(self, token=None, client_id=None):
+        """Forget one token, or every token of a client"""
+        with self._lock:
+            if token is not None:
+                self._tokens.pop(token, None)
+            if client_id is not None:
+                for key, entry in list(self._tokens.items()):
+                    if entry[1] == client_id:
+                        del self._tokens[key]
+
+    def flush(self):
+        """Write pending last_used times; kept for the next flush on failure"""
+        with self._lock:
+            pending, self._last_used = self._last_used, {}
+        if not pending:
+            return 0
+        try:
+            self.flusher(pending)
+        except Exception as e:
+            logger.error(f"Failed to record API token usage: {e}")
+            with self._lock:
+                for token_id, used in pending.items():
+                    if self._last_used.get(token_id, used) <= used:
+                        self._last_used[token_id] = used
+            return 0
+        return len(pending)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='api-token-flush')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
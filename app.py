@@ -42,7 +42,7 @@ login_manager.login_view = 'login'
 # Import models and recreate database schema
 with app.app_context():
     # Import all models
-    from models import User, Client, VHDImage, NetworkSettings, ClientStats
+    from models import User, Client, VHDImage, NetworkSettings, ClientStats, ClientStatsRollup, ClientLatestStats
     from models import ApiToken, ClientCommand, ClientSession
     
     # Drop and recreate all tables to handle schema changes
@@ -0,0 +1,172 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# How much traffic may go out back to back, as time at the configured rate
+DEFAULT_BURST_SECONDS = 0.05
+
+
+class TokenBucket:
+    """
+    Token bucket kept as a virtual clock
+
+    `tat` is the time at which everything reserved so far will have been
+    paid for; the bucket is full when it lags `burst` seconds behind now.
+    """
+
+    __slots__ = ('rate', 'burst', 'tat')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tat = 0.0
+
+    def reserve(self, nbytes, now):
+        """Take nbytes from the bucket and return how long to wait before sending"""
+        self.tat = max(self.tat, now - self.burst) + nbytes / self.rate
+        return max(0.0, self.tat - now)
+
+
+class BandwidthScheduler:
+    """
+    Shared egress limit for boot traffic
+
+    Every TFTP session and HTTP boot download reserves bytes before sending
+    them. A global bucket caps the aggregate rate at the configured limit,
+    and each client also has its own bucket refilled at an equal share of
+    that limit, so one client cannot take more than its share while others
+    are booting. Clients are keyed by IP address and count as active while
+    they have a transfer open.
+
+    Reservations never block: they return a delay, so the asyncio TFTP
+    engine can schedule the send and HTTP streams can sleep in their worker
+    thread.
+    """
+
+    def __init__(self, limit_mbps=0, burst_seconds=DEFAULT_BURST_SECONDS):
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._refs = {}
+        self.limit_mbps = 0
+        self.rate = 0
+        self._global = None
+        self.bytes_scheduled = 0
+        self.delayed = 0
+        self.set_limit(limit_mbps)
+
+    @property
+    def limited(self):
+        return self.rate > 0
+
+    def set_limit(self, limit_mbps):
+        """
+        Change the aggregate limit; 0 removes it
+
+        Args:
+            limit_mbps (int): Limit in megabits per second
+        """
+        with self._lock:
+            self.limit_mbps = limit_mbps or 0
+            self.rate = self.limit_mbps * 1000 * 1000 / 8
+            self._global = TokenBucket(self.rate, self.burst_seconds) if self.rate else None
+            self._rebalance()
+        if self.rate:
+            logger.info(f"Boot traffic limited to {self.limit_mbps} Mbps")
+        else:
+            logger.info("Boot traffic bandwidth limit removed")
+
+    def _rebalance(self):
+        """Give every active client an equal share of the limit"""
+        if not self.rate:
+            self._clients.clear()
+            return
+        share = self.rate / max(len(self._refs), 1)
+        for client in self._refs:
+            bucket = self._clients.get(client)
+            if bucket is None:
+                self._clients[client] = TokenBucket(share, self.burst_seconds)
+            else:
+                bucket.rate = share
+
+    def open(self, client):
+        """Register a transfer for a client"""
+        with self._lock:
+            self._refs[client] = self._refs.get(client, 0) + 1
+            if self._refs[client] == 1:
+                self._rebalance()
+
+    def close(self, client):
+        """Unregister a transfer; the client's share goes back to the others"""
+        with self._lock:
+            refs = self._refs.get(client, 0) - 1
+            if refs > 0:
+                self._refs[client] = refs
+                return
+            self._refs.pop(client, None)
+            self._clients.pop(client, None)
+            self._rebalance()
+
+    def reserve(self, client, nbytes):
+        """
+        Reserve bandwidth for a send
+
+        Args:
+            client (str): Client IP address
+            nbytes (int): Bytes about to be sent
+
+        Returns:
+            float: Seconds to wait before sending (0 when unlimited)
+        """
+        if not self.rate:
+            return 0.0
+
+        with self._lock:
+            if self._global is None:
+                return 0.0
+            now = time.monotonic()
+            bucket = self._clients.get(client)
+            if bucket is None:
+                # Unregistered sender: it only gets the global limit
+                delay = self._global.reserve(nbytes, now)
+            else:
+                delay = max(self._global.reserve(nbytes, now), bucket.reserve(nbytes, now))
+            self.bytes_scheduled += nbytes
+            if delay > 0:
+                self.delayed += 1
+            return delay
+
+    def throttled(self, chunks, client):
+        """
+        Wrap a WSGI response iterable so it is sent within the limit
+
+        Args:
+            chunks (iterable): Response body chunks
+            client (str): Client IP address
+
+        Yields:
+            bytes: The same chunks, delayed as needed
+        """
+        self.open(client)
+        try:
+            for chunk in chunks:
+                delay = self.reserve(client, len(chunk))
+                if delay > 0:
+                    time.sleep(delay)
+                yield chunk
+        finally:
+            self.close(client)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def status(self):
+        """Return scheduler counters for the status page"""
+        with self._lock:
+            return {
+                'limit_mbps': self.limit_mbps,
+                'active_clients': len(self._refs),
+                'bytes_scheduled': self.bytes_scheduled,
+                'delayed_sends': self.delayed,
+            }
@@ -0,0 +1,399 @@
+"""
+PXE boot-storm simulator
+
+Starts a PXEServer (DHCP + TFTP) on loopback and powers on N emulated
+clients at once. Each client runs DISCOVER/OFFER/REQUEST/ACK, fetches the
+first-stage loader and its per-client config over TFTP, then the boot image
+over TFTP or HTTP. Reports time-to-boot percentiles, throughput and
+retransmits, and saves the results as JSON so runs can be compared across
+versions.
+
+Without --http-url the HTTP phase uses a stand-in static file server over
+the same boot root; point it at a running web app to measure /boot itself.
+--bind selects the address everything listens on, e.g. a veth address when
+run inside a network namespace.
+
+Usage:
+    python benchmarks/boot_storm.py --clients 100 --image-mb 32 --json storm.json
+    python benchmarks/boot_storm.py --clients 100 --http --http-url http://127.0.0.1:5000/boot
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pxe_server import PXEServer
+from dhcp_server import (DHCPServer, DHCPPacket, DHCPDISCOVER, DHCPOFFER, DHCPREQUEST, DHCPACK,
+                         DHCPNAK, OPT_MESSAGE_TYPE, OPT_VENDOR_CLASS, OPT_CLIENT_ARCH,
+                         OPT_REQUESTED_IP, OPT_SERVER_ID)
+from tftp_benchmark import TFTPClient
+
+FIRST_STAGE_SIZE = 64 * 1024
+IMAGE_PATH = 'winpe/sources/boot.wim'
+
+
+class LoopbackPXEServer(PXEServer):
+    """PXEServer whose DHCP replies go to the simulator instead of the LAN broadcast address"""
+
+    def __init__(self, bind, dhcp_client_port, pool_size, **kwargs):
+        self.bind = bind
+        self.dhcp_client_port = dhcp_client_port
+        self.pool_size = pool_size
+        super().__init__(**kwargs)
+
+    def _create_dhcp_engine(self):
+        return DHCPServer(
+            self.server_ip,
+            subnet=self.subnet,
+            gateway=self.gateway,
+            dns_server=self.dns_server,
+            host=self.bind,
+            port=self.dhcp_port,
+            proxy_port=None,
+            client_port=self.dhcp_client_port,
+            broadcast_address=self.bind,
+            lease_time=self.lease_time,
+            pool_size=self.pool_size,
+            lease_file=self.lease_file,
+            boot_file_selector=self._select_boot_file
+        )
+
+
+class DHCPWire:
+    """Shared client-side DHCP socket; replies are routed to clients by xid"""
+
+    def __init__(self, bind):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind((bind, 0))
+        self.port = self.sock.getsockname()[1]
+        self.waiters = {}
+
+    def start(self, loop):
+        loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                packet = DHCPPacket.from_bytes(data)
+            except (ValueError, struct.error):
+                continue
+            queue = self.waiters.get(packet.xid)
+            if queue is not None:
+                queue.put_nowait(packet)
+
+    def close(self, loop):
+        loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class EmulatedClient:
+    """One PXE client powering on: DHCP, first stage and config over TFTP, then the image"""
+
+    def __init__(self, index, wire, dhcp_port, tftp_port, args):
+        self.index = index
+        self.mac = '02:00:00:%02x:%02x:%02x' % ((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        self.wire = wire
+        self.dhcp_port = dhcp_port
+        self.tftp_port = tftp_port
+        self.args = args
+        self.xid = random.getrandbits(32)
+        self.arch = 7 if index % 2 else 0  # half UEFI, half BIOS
+        self.dhcp_retransmits = 0
+        self.tftp_retransmits = 0
+        self.bytes = 0
+        self.phases = {}
+
+    def _packet(self, msg_type, extra=None):
+        packet = DHCPPacket()
+        packet.xid = self.xid
+        packet.chaddr = bytes.fromhex(self.mac.replace(':', ''))
+        packet.options = {
+            OPT_MESSAGE_TYPE: bytes([msg_type]),
+            OPT_VENDOR_CLASS: b'PXEClient:Arch:%05d:UNDI:002001' % self.arch,
+            OPT_CLIENT_ARCH: struct.pack('!H', self.arch),
+        }
+        packet.options.update(extra or {})
+        return packet.to_bytes()
+
+    async def _exchange(self, queue, request, expected):
+        # PXE ROMs retransmit with exponential backoff (4, 8, 16, 32 s); scaled down here
+        timeout = self.args.dhcp_timeout
+        for _ in range(4):
+            self.wire.sock.sendto(request, (self.args.bind, self.dhcp_port))
+            try:
+                deadline = time.monotonic() + timeout
+                while True:
+                    reply = await asyncio.wait_for(queue.get(), max(deadline - time.monotonic(), 0))
+                    if reply.message_type in expected:
+                        return reply
+            except asyncio.TimeoutError:
+                self.dhcp_retransmits += 1
+                timeout *= 2
+        raise TimeoutError(f"No DHCP reply for {self.mac}")
+
+    async def dhcp(self):
+        queue = asyncio.Queue()
+        self.wire.waiters[self.xid] = queue
+        try:
+            offer = await self._exchange(queue, self._packet(DHCPDISCOVER), (DHCPOFFER,))
+            ack = await self._exchange(queue, self._packet(DHCPREQUEST, {
+                OPT_REQUESTED_IP: socket.inet_aton(offer.yiaddr),
+                OPT_SERVER_ID: socket.inet_aton(offer.siaddr),
+            }), (DHCPACK, DHCPNAK))
+        finally:
+            del self.wire.waiters[self.xid]
+        if ack.message_type == DHCPNAK:
+            raise RuntimeError(f"DHCP NAK for {self.mac}")
+        return offer.file.decode('ascii')
+
+    async def tftp(self, filename, blksize=None, windowsize=None):
+        client = TFTPClient((self.args.bind, self.tftp_port), timeout=self.args.tftp_timeout,
+                            bind_host=self.args.bind)
+        try:
+            received = await client.fetch(filename, blksize=blksize, windowsize=windowsize)
+        finally:
+            self.tftp_retransmits += client.retransmits
+        self.bytes += received
+        return received
+
+    async def http(self, url):
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        try:
+            writer.write(f"GET {parts.path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            status = await reader.readline()
+            if b' 200 ' not in status:
+                raise RuntimeError(f"HTTP boot of {url} failed: {status.decode().strip()}")
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            received = 0
+            while True:
+                chunk = await reader.read(1024 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+        finally:
+            writer.close()
+        self.bytes += received
+        return received
+
+    async def boot(self, delay):
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+
+        mark = started
+        boot_file = await self.dhcp()
+        self.phases['dhcp'] = time.perf_counter() - mark
+
+        mark = time.perf_counter()
+        # PXE ROMs rarely negotiate more than blksize; the loaded stage does
+        await self.tftp(boot_file)
+        await self.tftp(f"pxelinux.cfg/01-{self.mac.replace(':', '-')}")
+        self.phases['tftp'] = time.perf_counter() - mark
+
+        mark = time.perf_counter()
+        if self.args.http:
+            await self.http(f"{self.args.http_url}/{IMAGE_PATH}")
+            self.phases['http'] = time.perf_counter() - mark
+        else:
+            await self.tftp(IMAGE_PATH, blksize=self.args.blksize, windowsize=self.args.windowsize)
+            self.phases['image'] = time.perf_counter() - mark
+
+        self.phases['total'] = time.perf_counter() - started
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'min': ordered[0],
+        'p50': pick(50),
+        'p90': pick(90),
+        'p95': pick(95),
+        'p99': pick(99),
+        'max': ordered[-1],
+        'mean': sum(ordered) / len(ordered),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def prepare_root(root, args):
+    for name in ('pxelinux.0', 'undionly.kpxe', 'bootx64.efi', 'ipxe.efi'):
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(os.urandom(FIRST_STAGE_SIZE))
+    os.makedirs(os.path.join(root, os.path.dirname(IMAGE_PATH)), exist_ok=True)
+    with open(os.path.join(root, IMAGE_PATH), 'wb') as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(args.image_mb):
+            f.write(chunk)
+
+
+def start_http_standin(root, bind):
+    """Static file server standing in for the web app's /boot endpoint"""
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return super().translate_path(path[len('/boot'):] if path.startswith('/boot/') else path)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((bind, 0), partial(Handler, directory=root))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://{bind}:{httpd.server_address[1]}/boot"
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("PXE server did not start")
+        time.sleep(0.01)
+
+
+async def storm(server, wire, args):
+    loop = asyncio.get_running_loop()
+    wire.start(loop)
+    clients = [EmulatedClient(i, wire, server.dhcp_engine.port, server.tftp_engine.port, args)
+               for i in range(args.clients)]
+    started = time.perf_counter()
+    try:
+        results = await asyncio.gather(*[
+            c.boot(random.uniform(0, args.ramp) if args.ramp else 0) for c in clients
+        ], return_exceptions=True)
+    finally:
+        wire.close(loop)
+    wall = time.perf_counter() - started
+
+    failures = [f"{c.mac}: {r}" for c, r in zip(clients, results) if isinstance(r, Exception)]
+    booted = [c for c, r in zip(clients, results) if not isinstance(r, Exception)]
+    total_bytes = sum(c.bytes for c in clients)
+    phases = {}
+    for phase in ('dhcp', 'tftp', 'image', 'http', 'total'):
+        values = [c.phases[phase] for c in booted if phase in c.phases]
+        if values:
+            phases[phase] = percentiles(values)
+
+    return {
+        'clients': args.clients,
+        'booted': len(booted),
+        'failed': len(failures),
+        'failures': failures[:20],
+        'wall_seconds': wall,
+        'bytes': total_bytes,
+        'throughput_mb_s': total_bytes / (1024 * 1024) / wall if wall else 0.0,
+        'time_to_boot': phases,
+        'retransmits': {
+            'dhcp_client': sum(c.dhcp_retransmits for c in clients),
+            'tftp_client': sum(c.tftp_retransmits for c in clients),
+            'tftp_server': server.tftp_engine.stats['retransmits'],
+        },
+    }
+
+
+def print_report(report):
+    results = report['results']
+    print(f"{results['booted']}/{results['clients']} clients booted in {results['wall_seconds']:.2f}s, "
+          f"{results['bytes'] / (1024 * 1024):.1f} MB at {results['throughput_mb_s']:.1f} MB/s")
+    print(f"{'phase':>6} {'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for phase, stats in results['time_to_boot'].items():
+        print(f"{phase:>6} " + ' '.join(f"{stats[p]:>8.3f}" for p in ('p50', 'p90', 'p95', 'p99', 'max')))
+    retx = results['retransmits']
+    print(f"retransmits: dhcp {retx['dhcp_client']}, tftp client {retx['tftp_client']}, "
+          f"tftp server {retx['tftp_server']}")
+    for failure in results['failures']:
+        print(f"failed: {failure}")
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        root = os.path.join(workdir, 'tftp')
+        os.makedirs(root)
+        prepare_root(root, args)
+
+        httpd = None
+        if args.http and not args.http_url:
+            httpd, args.http_url = start_http_standin(root, args.bind)
+
+        wire = DHCPWire(args.bind)
+        macs = [EmulatedClient(i, None, None, None, args).mac for i in range(args.clients)]
+        server = LoopbackPXEServer(
+            args.bind, wire.port, args.clients + 10,
+            tftp_root=root, subnet='10.0.0.0/16', gateway='10.0.0.1', server_ip='10.0.0.2',
+            tftp_port=0, dhcp_port=0, lease_file=os.path.join(workdir, 'dhcp.leases'),
+            caching_enabled=not args.no_cache, mtftp_enabled=False,
+            client_loader=lambda: [{'mac': mac, 'name': f'storm-{i}', 'vhd_id': 1, 'vhd_name': 'storm'}
+                                   for i, mac in enumerate(macs)]
+        )
+        server.start()
+        try:
+            wait_for(lambda: server.tftp_engine.sock is not None and server.dhcp_engine.sock is not None)
+            results = asyncio.run(storm(server, wire, args))
+            status = server.status()
+        finally:
+            server.stop()
+            if httpd:
+                httpd.shutdown()
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'results': results,
+        'server': {'tftp': status['tftp'], 'dhcp': status['dhcp'], 'cache': status['cache']},
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"results written to {args.json}")
+    return 0 if not results['failed'] else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=100, help='number of clients powering on')
+    parser.add_argument('--ramp', type=float, default=0.0, help='spread power-on over this many seconds')
+    parser.add_argument('--image-mb', type=int, default=16, help='size of the boot image in MB')
+    parser.add_argument('--blksize', type=int, default=1468, help='TFTP blksize for the image')
+    parser.add_argument('--windowsize', type=int, default=8, help='TFTP windowsize for the image')
+    parser.add_argument('--http', action='store_true', help='fetch the image over HTTP instead of TFTP')
+    parser.add_argument('--http-url', help='HTTP boot base URL (default: built-in static stand-in)')
+    parser.add_argument('--no-cache', action='store_true', help='disable the boot block cache')
+    parser.add_argument('--bind', default='127.0.0.1', help='address the server and clients use')
+    parser.add_argument('--dhcp-timeout', type=float, default=0.5, help='initial DHCP retransmit timeout')
+    parser.add_argument('--tftp-timeout', type=float, default=1.0, help='TFTP client retransmit timeout')
+    parser.add_argument('--json', help='write results to this JSON file')
+    sys.exit(main(parser.parse_args()))
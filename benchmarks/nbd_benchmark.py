@@ -0,0 +1,228 @@
+"""
+NBD export benchmark
+
+Starts an NBDServer on loopback exporting one golden image under many client
+names (one per emulated MAC address, as the PXE server does), attaches a
+small asyncio NBD client per name, reads the whole image with pipelined
+requests and checks every byte. While the clients are attached it samples
+the server status to show that they all share a single mapping.
+
+Usage:
+    python benchmarks/nbd_benchmark.py --clients 50 --image-mb 64
+    python benchmarks/nbd_benchmark.py --clients 8 --request-kb 1024 --depth 4
+"""
+
+import os
+import sys
+import time
+import struct
+import asyncio
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nbd_server import (
+    NBDServer, NBD_MAGIC, IHAVEOPT, OPTION_REPLY_MAGIC, NBD_FLAG_FIXED_NEWSTYLE,
+    NBD_FLAG_C_FIXED_NEWSTYLE, NBD_FLAG_C_NO_ZEROES, NBD_OPT_GO, NBD_OPT_EXPORT_NAME,
+    NBD_REP_ACK, NBD_REP_INFO, NBD_INFO_EXPORT, NBD_FLAG_READ_ONLY, NBD_FLAG_CAN_MULTI_CONN,
+    NBD_REQUEST_MAGIC, NBD_SIMPLE_REPLY_MAGIC, NBD_CMD_READ, NBD_CMD_WRITE, NBD_CMD_DISC,
+    NBD_EPERM,
+)
+
+
+class NBDError(Exception):
+    pass
+
+
+class NBDClient:
+    """Minimal fixed-newstyle NBD client used by the benchmarks"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.size = 0
+        self.flags = 0
+        self._handle = 0
+
+    async def connect(self, name, use_go=True):
+        """
+        Attach to an export
+
+        Args:
+            name (str): Export name
+            use_go (bool): Negotiate with NBD_OPT_GO instead of NBD_OPT_EXPORT_NAME
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        magic, opt_magic, server_flags = struct.unpack('!QQH', await self.reader.readexactly(18))
+        if magic != NBD_MAGIC or opt_magic != IHAVEOPT or not server_flags & NBD_FLAG_FIXED_NEWSTYLE:
+            raise NBDError("not a fixed newstyle NBD server")
+        self.writer.write(struct.pack('!I', NBD_FLAG_C_FIXED_NEWSTYLE | NBD_FLAG_C_NO_ZEROES))
+
+        encoded = name.encode('utf-8')
+        if not use_go:
+            self.writer.write(struct.pack('!QII', IHAVEOPT, NBD_OPT_EXPORT_NAME, len(encoded)) + encoded)
+            data = await self.reader.readexactly(10)
+            self.size, self.flags = struct.unpack('!QH', data)
+            return
+
+        payload = struct.pack('!I', len(encoded)) + encoded + struct.pack('!H', 0)
+        self.writer.write(struct.pack('!QII', IHAVEOPT, NBD_OPT_GO, len(payload)) + payload)
+        while True:
+            magic, _option, reply, length = struct.unpack('!QIII', await self.reader.readexactly(20))
+            data = await self.reader.readexactly(length)
+            if magic != OPTION_REPLY_MAGIC:
+                raise NBDError("bad option reply magic")
+            if reply == NBD_REP_ACK:
+                return
+            if reply == NBD_REP_INFO:
+                info, = struct.unpack('!H', data[:2])
+                if info == NBD_INFO_EXPORT:
+                    self.size, self.flags = struct.unpack('!QH', data[2:12])
+                continue
+            raise NBDError(f"export {name!r} refused (reply {reply:#x})")
+
+    def _request(self, command, offset, length, data=b''):
+        self._handle += 1
+        self.writer.write(struct.pack('!IHHQQI', NBD_REQUEST_MAGIC, 0, command,
+                                      self._handle, offset, length) + data)
+        return self._handle
+
+    async def _reply(self, payload_length):
+        magic, error, handle = struct.unpack('!IIQ', await self.reader.readexactly(16))
+        if magic != NBD_SIMPLE_REPLY_MAGIC:
+            raise NBDError("bad reply magic")
+        data = await self.reader.readexactly(payload_length) if not error else b''
+        return error, handle, data
+
+    async def read_all(self, request_size, depth, sink):
+        """
+        Read the whole export with up to depth requests in flight
+
+        Replies arrive in order, so each one is matched to the oldest
+        outstanding request.
+        """
+        pending = []
+        offset = 0
+        while offset < self.size or pending:
+            while offset < self.size and len(pending) < depth:
+                length = min(request_size, self.size - offset)
+                pending.append((self._request(NBD_CMD_READ, offset, length), offset, length))
+                offset += length
+            handle, start, length = pending.pop(0)
+            error, reply_handle, data = await self._reply(length)
+            if error or reply_handle != handle:
+                raise NBDError(f"read at {start} failed (error {error})")
+            sink(start, data)
+
+    async def write(self, offset, data):
+        self._request(NBD_CMD_WRITE, offset, len(data), data)
+        error, _handle, _ = await self._reply(0)
+        return error
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self._request(NBD_CMD_DISC, 0, 0)
+        await self.writer.drain()
+        self.writer.close()
+
+
+def mac_for(index):
+    return '02:00:00:00:{:02x}:{:02x}'.format(index >> 8, index & 0xff)
+
+
+async def run_clients(server, names, request_size, depth, expected_digest, attached):
+    """Attach every client, then read the image on all of them concurrently"""
+    clients = [NBDClient('127.0.0.1', server.port) for _ in names]
+    await asyncio.gather(*(c.connect(name, use_go=i % 2 == 0)
+                           for i, (c, name) in enumerate(zip(clients, names))))
+    attached.update(server.status())
+
+    for client in clients:
+        if not client.flags & NBD_FLAG_READ_ONLY or not client.flags & NBD_FLAG_CAN_MULTI_CONN:
+            raise NBDError("export is not advertised as read-only multi-connection")
+
+    # Writes must be refused without touching the golden image
+    if await clients[0].write(0, b'\xff' * 512) != NBD_EPERM:
+        raise NBDError("write to a read-only export was not refused")
+
+    async def read(client):
+        digest = hashlib.sha256()
+        expected_offset = [0]
+
+        def sink(offset, data):
+            if offset != expected_offset[0]:
+                raise NBDError("out of order reply")
+            digest.update(data)
+            expected_offset[0] += len(data)
+
+        await client.read_all(request_size, depth, sink)
+        if digest.digest() != expected_digest:
+            raise NBDError("image content mismatch")
+        return client.size
+
+    start = time.monotonic()
+    sizes = await asyncio.gather(*(read(c) for c in clients))
+    elapsed = time.monotonic() - start
+    await asyncio.gather(*(c.close() for c in clients))
+    return sum(sizes), elapsed
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as root:
+        image = os.path.join(root, 'golden.vhd')
+        digest = hashlib.sha256()
+        with open(image, 'wb') as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(args.image_mb):
+                f.write(chunk)
+                digest.update(chunk)
+
+        names = [mac_for(i) for i in range(args.clients)]
+        exports = {name: {'path': image} for name in names}
+        server = NBDServer(exports.get, host='127.0.0.1', port=0)
+        await server.start()
+        try:
+            # Unknown exports are refused during negotiation
+            stray = NBDClient('127.0.0.1', server.port)
+            try:
+                await stray.connect('02:ff:ff:ff:ff:ff')
+                raise SystemExit("unknown export was accepted")
+            except NBDError:
+                pass
+            stray.writer.close()
+
+            attached = {}
+            received, elapsed = await run_clients(server, names, args.request_kb * 1024,
+                                                  args.depth, digest.digest(), attached)
+            mb = received / (1024 * 1024)
+            print(f"{args.clients} clients read {mb:.1f} MB in {elapsed:.2f}s "
+                  f"= {mb / elapsed:.1f} MB/s aggregate, content verified")
+            print(f"while attached: {attached['mapped_files']} mapped file(s), "
+                  f"{attached['mapped_bytes'] / (1024 * 1024):.1f} MB mapped, "
+                  f"{attached['mapped_refs']} references")
+            # Let the server notice the disconnects before sampling again
+            for _ in range(100):
+                status = server.status()
+                if not status['active_connections']:
+                    break
+                await asyncio.sleep(0.01)
+            print(f"server: {status['connections']} connections, {status['requests']} requests, "
+                  f"{status['errors']} errors, {status['mapped_files']} mapped after detach")
+            if attached['mapped_files'] != 1:
+                raise SystemExit("clients did not share one mapping of the golden image")
+        finally:
+            await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Loopback NBD export benchmark")
+    parser.add_argument('--clients', type=int, default=50, help="Number of clients attached to the golden image")
+    parser.add_argument('--image-mb', type=int, default=64, help="Size of the generated golden image")
+    parser.add_argument('--request-kb', type=int, default=256, help="Size of each read request")
+    parser.add_argument('--depth', type=int, default=8, help="Read requests in flight per client")
+    asyncio.run(main(parser.parse_args()))
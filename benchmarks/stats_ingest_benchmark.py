@@ -0,0 +1,134 @@
+"""
+Client stats ingestion benchmark
+
+Compares two ways of storing ClientStats samples in a scratch SQLite
+database: the per-request path (look up the client, add one row, commit)
+and the batched ingestion queue (producers offer batches, one writer
+inserts up to a batch per transaction with executemany). Producers that
+are refused by a full queue back off and retry, so the number of refusals
+shows how often backpressure kicked in.
+
+Usage:
+    python benchmarks/stats_ingest_benchmark.py --rows 5000
+    python benchmarks/stats_ingest_benchmark.py --rows 200000 --producers 8 --request-samples 500
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py recreates the schema of whatever database it is pointed at
+_scratch = tempfile.mkdtemp(prefix='stats-bench-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_scratch, 'bench.db')}"
+
+from app import app, db
+from models import Client, ClientStats
+from stats_ingest import StatsIngestQueue, insert_stats
+
+
+def make_sample(client_ids):
+    return {
+        'client_id': random.choice(client_ids),
+        'timestamp': datetime.utcnow(),
+        'cpu_usage': random.uniform(0, 100),
+        'memory_usage_mb': random.uniform(1000, 16000),
+        'network_rx_mbps': random.uniform(0, 100),
+        'network_tx_mbps': random.uniform(0, 100),
+    }
+
+
+def bench_per_request(client_ids, rows):
+    """One lookup, one insert and one commit per sample, as submit_client_stats does"""
+    started = time.perf_counter()
+    with app.app_context():
+        for _ in range(rows):
+            sample = make_sample(client_ids)
+            client = db.session.get(Client, sample['client_id'])
+            db.session.add(ClientStats(
+                client_id=client.id,
+                cpu_usage=sample['cpu_usage'],
+                memory_usage_mb=sample['memory_usage_mb'],
+                network_rx_mbps=sample['network_rx_mbps'],
+                network_tx_mbps=sample['network_tx_mbps']
+            ))
+            db.session.commit()
+    return time.perf_counter() - started
+
+
+def bench_batched(client_ids, rows, producers, request_samples, capacity, batch_size):
+    """Producers offer request-sized batches to a StatsIngestQueue until rows are queued"""
+    queue = StatsIngestQueue(insert_stats, capacity=capacity, batch_size=batch_size, flush_interval=0.05)
+    refusals = [0] * producers
+    per_producer = rows // producers
+
+    def produce(index):
+        remaining = per_producer
+        while remaining:
+            batch = [make_sample(client_ids) for _ in range(min(request_samples, remaining))]
+            while not queue.offer(batch):
+                refusals[index] += 1
+                time.sleep(0.01)
+            remaining -= len(batch)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=produce, args=(i,)) for i in range(producers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.flush()
+    elapsed = time.perf_counter() - started
+    return elapsed, queue.status(), sum(refusals), per_producer * producers
+
+
+def count_rows():
+    with app.app_context():
+        return ClientStats.query.count()
+
+
+def main(args):
+    with app.app_context():
+        clients = [Client(name=f"bench-{i}", mac_address=f"02:00:00:00:{i // 256:02x}:{i % 256:02x}")
+                   for i in range(args.clients)]
+        db.session.add_all(clients)
+        db.session.commit()
+        client_ids = [client.id for client in clients]
+
+    single_rows = min(args.rows, args.single_rows)
+    elapsed = bench_per_request(client_ids, single_rows)
+    print(f"per-request commit: {single_rows} rows in {elapsed:.2f}s = {single_rows / elapsed:,.0f} rows/s")
+
+    before = count_rows()
+    elapsed, status, refusals, queued = bench_batched(
+        client_ids, args.rows, args.producers, args.request_samples, args.capacity, args.batch_size)
+    stored = count_rows() - before
+    print(f"batched queue:      {queued} rows in {elapsed:.2f}s = {queued / elapsed:,.0f} rows/s "
+          f"({status['batches']} transactions, {refusals} refused requests, {status['dropped']} dropped)")
+    if stored != queued:
+        print(f"MISMATCH: {queued} rows queued but {stored} stored")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ClientStats ingestion benchmark")
+    parser.add_argument('--clients', type=int, default=100, help="Number of clients the samples come from")
+    parser.add_argument('--rows', type=int, default=50000, help="Samples stored through the batched queue")
+    parser.add_argument('--single-rows', type=int, default=5000, help="Samples stored one commit at a time")
+    parser.add_argument('--producers', type=int, default=4, help="Threads submitting batches concurrently")
+    parser.add_argument('--request-samples', type=int, default=100, help="Samples per batch request")
+    parser.add_argument('--capacity', type=int, default=10000, help="Ingestion queue capacity")
+    parser.add_argument('--batch-size', type=int, default=2000, help="Rows per insert transaction")
+    try:
+        code = main(parser.parse_args())
+    finally:
+        shutil.rmtree(_scratch, ignore_errors=True)
+    sys.exit(code)
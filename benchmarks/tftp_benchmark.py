@@ -0,0 +1,384 @@
+"""
+TFTP throughput benchmark
+
+Starts a TFTPServer on loopback, fetches a generated boot image with a small
+asyncio TFTP client under several blksize/windowsize combinations and prints
+the throughput of each run.
+
+Usage:
+    python benchmarks/tftp_benchmark.py --size-mb 64 --clients 20 --multicast
+    python benchmarks/tftp_benchmark.py --size-mb 16 --loss 1
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tftp_server import TFTPServer, OP_RRQ, OP_DATA, OP_ACK, OP_ERROR, OP_OACK, DEFAULT_BLKSIZE
+
+# (blksize, windowsize) combinations to compare
+DEFAULT_PROFILES = [
+    (512, 1),
+    (1468, 1),
+    (1468, 16),
+    (8192, 8),
+    (65464, 1),
+    (65464, 8),
+]
+
+
+class TFTPClient:
+    """Minimal RFC 1350/2347/7440 read client used by the benchmarks"""
+
+    def __init__(self, server_addr, timeout=1.0, max_retries=10, bind_host='127.0.0.1', loss=0.0):
+        self.server_addr = server_addr
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.bind_host = bind_host
+        self.loss = loss  # fraction of DATA packets to drop, emulating a lossy port
+        self.retransmits = 0
+
+    async def fetch(self, filename, blksize=None, windowsize=None, tsize=True, sink=None):
+        """
+        Download a file
+
+        Args:
+            filename (str): Remote filename
+            blksize (int, optional): Requested block size
+            windowsize (int, optional): Requested window size
+            tsize (bool): Whether to ask for the transfer size
+            sink (callable, optional): Called with each in-order data block
+
+        Returns:
+            int: Number of bytes received
+        """
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind((self.bind_host, 0))
+
+        options = {}
+        if blksize:
+            options['blksize'] = blksize
+        if tsize:
+            options['tsize'] = 0
+        if windowsize:
+            options['windowsize'] = windowsize
+
+        request = struct.pack('!H', OP_RRQ) + filename.encode('ascii') + b'\0octet\0'
+        for name, value in options.items():
+            request += name.encode('ascii') + b'\0' + str(value).encode('ascii') + b'\0'
+
+        block_size = DEFAULT_BLKSIZE
+        window = 1
+        expected = 1
+        in_window = 0
+        received = 0
+        peer = None
+        last_packet = request
+        last_target = self.server_addr
+        retries = 0
+
+        try:
+            sock.sendto(request, self.server_addr)
+            while True:
+                try:
+                    data, addr = await asyncio.wait_for(loop.sock_recvfrom(sock, 65536), self.timeout)
+                except asyncio.TimeoutError:
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise TimeoutError(f"TFTP transfer of {filename} timed out")
+                    self.retransmits += 1
+                    if peer is not None:
+                        # Re-acknowledge our position so the server restarts the window there
+                        last_packet = struct.pack('!HH', OP_ACK, (expected - 1) & 0xFFFF)
+                        last_target = peer
+                    sock.sendto(last_packet, last_target)
+                    in_window = 0
+                    continue
+
+                if peer is None:
+                    peer = addr
+                elif addr != peer:
+                    continue
+
+                opcode = struct.unpack('!H', data[:2])[0]
+                if opcode == OP_ERROR:
+                    code = struct.unpack('!H', data[2:4])[0]
+                    raise RuntimeError(f"TFTP error {code}: {data[4:-1].decode(errors='replace')}")
+
+                if opcode == OP_OACK:
+                    fields = data[2:].split(b'\0')[:-1]
+                    accepted = {fields[i].decode().lower(): fields[i + 1].decode()
+                                for i in range(0, len(fields) - 1, 2)}
+                    block_size = int(accepted.get('blksize', DEFAULT_BLKSIZE))
+                    window = int(accepted.get('windowsize', 1))
+                    last_packet = struct.pack('!HH', OP_ACK, 0)
+                    last_target = peer
+                    sock.sendto(last_packet, peer)
+                    retries = 0
+                    continue
+
+                if opcode != OP_DATA or (self.loss and random.random() < self.loss):
+                    continue
+
+                block = struct.unpack('!H', data[2:4])[0]
+                if block == expected & 0xFFFF:
+                    payload = data[4:]
+                    received += len(payload)
+                    if sink:
+                        sink(payload)
+                    expected += 1
+                    in_window += 1
+                    retries = 0
+
+                    last = len(payload) < block_size
+                    if last or in_window >= window:
+                        last_packet = struct.pack('!HH', OP_ACK, (expected - 1) & 0xFFFF)
+                        last_target = peer
+                        sock.sendto(last_packet, peer)
+                        in_window = 0
+                    if last:
+                        return received
+                else:
+                    # Out of order: acknowledge what we have so the server restarts the window
+                    if in_window:
+                        last_packet = struct.pack('!HH', OP_ACK, (expected - 1) & 0xFFFF)
+                        last_target = peer
+                        sock.sendto(last_packet, peer)
+                        in_window = 0
+        finally:
+            sock.close()
+
+
+    async def fetch_multicast(self, filename, blksize=None, windowsize=None, sink=None, deadline=120):
+        """
+        Download a file through an RFC 2090 multicast group
+
+        Blocks are collected from the group whether or not this client is the
+        master; once promoted to master it ACKs the last block held in
+        sequence until it has the whole file. Only meant for files below
+        65536 blocks.
+
+        Args:
+            filename (str): Remote filename
+            blksize (int, optional): Requested block size
+            windowsize (int, optional): Requested window size
+            sink (callable, optional): Called with each data block, in order, at the end
+            deadline (float): Give up after this many seconds
+
+        Returns:
+            int: Number of bytes received
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind((self.bind_host, 0))
+        mcast_sock = None
+
+        def on_readable(s):
+            while True:
+                try:
+                    queue.put_nowait(s.recvfrom(65536))
+                except (BlockingIOError, InterruptedError):
+                    return
+
+        options = {'multicast': '', 'tsize': 0}
+        if blksize:
+            options['blksize'] = blksize
+        if windowsize:
+            options['windowsize'] = windowsize
+        request = struct.pack('!H', OP_RRQ) + filename.encode('ascii') + b'\0octet\0'
+        for name, value in options.items():
+            request += name.encode('ascii') + b'\0' + str(value).encode('ascii') + b'\0'
+
+        blocks = {}
+        block_size = DEFAULT_BLKSIZE
+        window = 1
+        total = None
+        contiguous = 0
+        since_ack = 0
+        master = False
+        peer = None
+        retries = 0
+        finish_by = time.monotonic() + deadline
+
+        def ack():
+            sock.sendto(struct.pack('!HH', OP_ACK, contiguous & 0xFFFF), peer)
+
+        loop.add_reader(sock.fileno(), on_readable, sock)
+        try:
+            sock.sendto(request, self.server_addr)
+            while True:
+                if time.monotonic() > finish_by:
+                    raise TimeoutError(f"TFTP multicast transfer of {filename} timed out")
+                try:
+                    data, addr = await asyncio.wait_for(queue.get(), self.timeout)
+                except asyncio.TimeoutError:
+                    if peer is None or master:
+                        retries += 1
+                        if retries > self.max_retries:
+                            raise TimeoutError(f"TFTP multicast transfer of {filename} timed out")
+                        self.retransmits += 1
+                        if peer is None:
+                            sock.sendto(request, self.server_addr)
+                        else:
+                            ack()
+                    continue
+
+                opcode = struct.unpack('!H', data[:2])[0]
+                if opcode == OP_ERROR:
+                    code = struct.unpack('!H', data[2:4])[0]
+                    raise RuntimeError(f"TFTP error {code}: {data[4:-1].decode(errors='replace')}")
+
+                if opcode == OP_OACK:
+                    peer = addr
+                    fields = data[2:].split(b'\0')[:-1]
+                    accepted = {fields[i].decode().lower(): fields[i + 1].decode()
+                                for i in range(0, len(fields) - 1, 2)}
+                    block_size = int(accepted.get('blksize', DEFAULT_BLKSIZE))
+                    window = int(accepted.get('windowsize', 1))
+                    total = int(accepted['tsize']) // block_size + 1
+                    group, port, mc = accepted['multicast'].split(',')
+
+                    if mcast_sock is None:
+                        mcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        mcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                        if hasattr(socket, 'SO_REUSEPORT'):
+                            mcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                        mcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+                        mcast_sock.bind((group, int(port)))
+                        mcast_sock.setsockopt(
+                            socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) + socket.inet_aton(self.bind_host)
+                        )
+                        mcast_sock.setblocking(False)
+                        loop.add_reader(mcast_sock.fileno(), on_readable, mcast_sock)
+
+                    master = mc == '1'
+                    retries = 0
+                    if master:
+                        since_ack = 0
+                        ack()
+                        if contiguous >= total:
+                            break
+                    continue
+
+                if opcode != OP_DATA or total is None:
+                    continue
+
+                block = struct.unpack('!H', data[2:4])[0]
+                if block == 0 or block > total or block in blocks:
+                    continue
+                blocks[block] = data[4:]
+                while contiguous + 1 in blocks:
+                    contiguous += 1
+                since_ack += 1
+                retries = 0
+
+                if master and (since_ack >= window or block == total or contiguous >= total):
+                    since_ack = 0
+                    ack()
+                    if contiguous >= total:
+                        break
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+            if mcast_sock is not None:
+                loop.remove_reader(mcast_sock.fileno())
+                mcast_sock.close()
+
+        received = 0
+        for block in range(1, total + 1):
+            received += len(blocks[block])
+            if sink:
+                sink(blocks[block])
+        return received
+
+
+async def run_profile(server, filename, blksize, windowsize, loss=0.0):
+    client = TFTPClient(('127.0.0.1', server.port), loss=loss)
+    started = time.perf_counter()
+    received = await client.fetch(
+        filename,
+        blksize=blksize if blksize != DEFAULT_BLKSIZE else None,
+        windowsize=windowsize if windowsize > 1 else None
+    )
+    elapsed = time.perf_counter() - started
+    return received, elapsed, client.retransmits
+
+
+async def run_concurrent(server, filename, blksize, windowsize, clients):
+    """Fetch the same file with several clients at once, as in a boot storm"""
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        TFTPClient(('127.0.0.1', server.port)).fetch(filename, blksize=blksize, windowsize=windowsize)
+        for _ in range(clients)
+    ])
+    return sum(results), time.perf_counter() - started
+
+
+async def run_multicast(server, filename, blksize, windowsize, clients, stagger):
+    """Start clients a little apart so late ones join the running transfer"""
+    async def one(delay):
+        await asyncio.sleep(delay)
+        client = TFTPClient(('127.0.0.1', server.port))
+        return await client.fetch_multicast(filename, blksize=blksize, windowsize=windowsize)
+
+    sent_before = server.stats['bytes_sent']
+    started = time.perf_counter()
+    results = await asyncio.gather(*[one(i * stagger) for i in range(clients)])
+    return sum(results), time.perf_counter() - started, server.stats['bytes_sent'] - sent_before
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as root:
+        filename = 'boot.wim'
+        with open(os.path.join(root, filename), 'wb') as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(chunk)
+
+        server = TFTPServer(root, host='127.0.0.1', port=0, max_windowsize=64,
+                            multicast_enabled=args.multicast)
+        await server.start()
+        try:
+            print(f"{'blksize':>8} {'window':>7} {'MB':>8} {'seconds':>8} {'MB/s':>9} {'retx':>5}")
+            for blksize, windowsize in DEFAULT_PROFILES:
+                received, elapsed, retransmits = await run_profile(server, filename, blksize, windowsize, args.loss / 100)
+                mb = received / (1024 * 1024)
+                print(f"{blksize:>8} {windowsize:>7} {mb:>8.1f} {elapsed:>8.2f} {mb / elapsed:>9.1f} {retransmits:>5}")
+
+            if args.clients > 1:
+                received, elapsed = await run_concurrent(server, filename, 8192, 8, args.clients)
+                mb = received / (1024 * 1024)
+                print(f"\n{args.clients} concurrent clients (8192/8): {mb:.1f} MB in {elapsed:.2f}s "
+                      f"= {mb / elapsed:.1f} MB/s aggregate")
+
+            if args.multicast:
+                received, elapsed, on_wire = await run_multicast(server, filename, 1428, 16,
+                                                                 max(args.clients, 2), 0.05)
+                mb = received / (1024 * 1024)
+                print(f"\n{max(args.clients, 2)} multicast clients (1428/16): {mb:.1f} MB delivered "
+                      f"in {elapsed:.2f}s, {on_wire / (1024 * 1024):.1f} MB on the wire")
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Loopback TFTP throughput benchmark")
+    parser.add_argument('--size-mb', type=int, default=64, help="Size of the generated boot image")
+    parser.add_argument('--clients', type=int, default=1, help="Also run a concurrent fetch with this many clients")
+    parser.add_argument('--multicast', action='store_true', help="Also run an RFC 2090 multicast boot storm")
+    parser.add_argument('--loss', type=float, default=0.0, help="Percentage of DATA packets the client drops")
+    asyncio.run(main(parser.parse_args()))
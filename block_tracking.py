@@ -0,0 +1,176 @@
+import os
+import json
+import uuid
+import array
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACKING_BLOCK_SIZE = 1024 * 1024
+TRACKER_SUFFIX = '.cbt'
+
+
+def image_identity(path):
+    """Inode, size and mtime of a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class ChangeTracker:
+    """
+    Changed-block tracking for one disk image
+
+    Kept in a sidecar file next to the image:
+
+        <image>.cbt     one JSON line, the dirty bitmap, then one uint32
+                        write generation per block
+
+    Every code path that writes the image marks the ranges it wrote and saves
+    the tracker, which also records the image's identity (inode, size,
+    mtime). If the image is changed by anything else the identity no longer
+    matches and the tracker is not continuous: the next save starts a new
+    epoch, and whatever was derived from the old epoch has to fall back to
+    comparing content.
+
+    The bitmap holds the blocks written since the base restoration point.
+    Block generations are never cleared; they tell other consumers (such as
+    the integrity manifest) which blocks were written after a given save.
+    """
+
+    def __init__(self, image_path, block_size=TRACKING_BLOCK_SIZE):
+        self.image_path = image_path
+        self.path = f"{image_path}{TRACKER_SUFFIX}"
+        self.block_size = block_size
+        self.base_manifest = None
+        self.base_epoch = None
+        self.identity = None
+        self.epoch = None
+        self.generation = 0
+        self.bitmap = bytearray()
+        self.block_generations = array.array('I')
+        self.continuous = False
+        self._marked = False
+
+    @classmethod
+    def load(cls, image_path):
+        """Read an image's tracker, or return an empty untrusted one"""
+        tracker = cls(image_path)
+        try:
+            with open(tracker.path, 'rb') as f:
+                header = json.loads(f.readline())
+                tracker.bitmap = bytearray(f.read(header.get('bitmap_bytes', 0)))
+                generations = f.read()
+        except FileNotFoundError:
+            return tracker
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable change tracker {tracker.path}: {e}")
+            return cls(image_path)
+        tracker.block_size = header['block_size']
+        tracker.base_manifest = header.get('base_manifest')
+        tracker.base_epoch = header.get('base_epoch')
+        tracker.identity = header.get('identity')
+        tracker.epoch = header.get('epoch')
+        tracker.generation = header.get('generation', 0)
+        tracker.block_generations.frombytes(generations[:len(generations) // 4 * 4])
+        tracker.continuous = tracker.identity is not None and tracker.identity == image_identity(image_path)
+        return tracker
+
+    @property
+    def trusted(self):
+        """Whether the bitmap covers every change since the base manifest"""
+        return (self.continuous and self.base_epoch == self.epoch
+                and self.base_manifest is not None and os.path.exists(self.base_manifest))
+
+    def mark(self, offset, length):
+        """Record that a byte range of the image was written"""
+        if length <= 0:
+            return
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        if len(self.bitmap) <= last >> 3:
+            self.bitmap.extend(bytes((last >> 3) + 1 - len(self.bitmap)))
+        if len(self.block_generations) <= last:
+            self.block_generations.extend([0] * (last + 1 - len(self.block_generations)))
+        for block in range(first, last + 1):
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+            self.block_generations[block] = self.generation + 1
+        self._marked = True
+
+    def changed_ranges(self):
+        """
+        Coalesced (offset, length) ranges written since the base manifest
+
+        Returns:
+            list: Ranges, clipped to the current image size
+        """
+        size = os.path.getsize(self.image_path)
+        ranges = []
+        start = None
+        blocks = len(self.bitmap) * 8
+        for block in range(blocks + 1):
+            dirty = block < blocks and self.bitmap[block >> 3] & (1 << (block & 7))
+            if dirty and start is None:
+                start = block
+            elif not dirty and start is not None:
+                offset = start * self.block_size
+                end = min(block * self.block_size, size)
+                if end > offset:
+                    ranges.append((offset, end - offset))
+                start = None
+        return ranges
+
+    def changed_bytes(self):
+        return sum(length for _offset, length in self.changed_ranges())
+
+    def blocks_written_since(self, generation):
+        """Indices of blocks written after the given generation"""
+        return [block for block, written in enumerate(self.block_generations) if written > generation]
+
+    def reset(self, base_manifest):
+        """Start tracking from a new restoration point and save"""
+        self.bitmap = bytearray()
+        self.save(base_manifest=base_manifest)
+
+    def save(self, base_manifest=None):
+        """
+        Persist the tracker along with the image's current identity
+
+        Args:
+            base_manifest (str, optional): Make this restoration point the new
+                base and clear nothing else
+        """
+        if not self.continuous:
+            # Writes were missed; nothing from the previous epoch can be trusted
+            self.epoch = uuid.uuid4().hex
+            self.continuous = True
+        if self._marked:
+            self.generation += 1
+            self._marked = False
+        if base_manifest is not None:
+            self.base_manifest = base_manifest
+            self.base_epoch = self.epoch
+        self.identity = image_identity(self.image_path)
+        header = {
+            'block_size': self.block_size,
+            'base_manifest': self.base_manifest,
+            'base_epoch': self.base_epoch,
+            'identity': self.identity,
+            'epoch': self.epoch,
+            'generation': self.generation,
+            'bitmap_bytes': len(self.bitmap),
+        }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(self.bitmap)
+            f.write(self.block_generations.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,175 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+class BlockCache:
+    """
+    Shared in-memory cache of boot file chunks
+
+    Files are cached in fixed-size chunks regardless of the block size each
+    client negotiated. Eviction is segmented LRU: new chunks enter a probation
+    segment and are promoted to the protected segment once a second reader
+    (another session) hits them, so a single client streaming a large image
+    cannot flush the boot files every client reads.
+    """
+
+    def __init__(self, capacity_bytes, chunk_size=DEFAULT_CHUNK_SIZE, protected_ratio=0.8):
+        self.capacity = capacity_bytes
+        self.chunk_size = chunk_size
+        self.protected_ratio = protected_ratio
+
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._probation_bytes = 0
+        self._protected_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0
+
+    @property
+    def size(self):
+        return self._probation_bytes + self._protected_bytes
+
+    def get_chunk(self, file_key, index, loader, reader=None):
+        """
+        Return a cached chunk, loading it on a miss
+
+        Args:
+            file_key (tuple): Identity of the file (path, inode, size, mtime)
+            index (int): Chunk number within the file
+            loader (callable): Called with (offset, length) to read the chunk
+            reader (hashable, optional): Identity of the session reading
+
+        Returns:
+            bytes: Chunk contents
+        """
+        key = (file_key, index)
+        with self._lock:
+            chunk = self._protected.get(key)
+            if chunk is not None:
+                self._protected.move_to_end(key)
+                self.hits += 1
+                return chunk
+
+            entry = self._probation.get(key)
+            if entry is not None:
+                chunk, owner = entry
+                self.hits += 1
+                if owner == reader:
+                    # Same session reading the next block of the chunk
+                    return chunk
+                del self._probation[key]
+                self._probation_bytes -= len(chunk)
+                self._protected[key] = chunk
+                self._protected_bytes += len(chunk)
+                self._demote()
+                return chunk
+
+            self.misses += 1
+
+        chunk = bytes(loader(index * self.chunk_size, self.chunk_size))
+
+        with self._lock:
+            self.bytes_read += len(chunk)
+            if len(chunk) <= self.capacity and key not in self._probation and key not in self._protected:
+                self._probation[key] = (chunk, reader)
+                self._probation_bytes += len(chunk)
+                self._evict()
+        return chunk
+
+    def _demote(self):
+        """Move the oldest protected chunks back to probation when over quota"""
+        limit = self.capacity * self.protected_ratio
+        while self._protected_bytes > limit and self._protected:
+            key, chunk = self._protected.popitem(last=False)
+            self._protected_bytes -= len(chunk)
+            self._probation[key] = (chunk, None)
+            self._probation_bytes += len(chunk)
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.capacity:
+            if self._probation:
+                _, (chunk, _) = self._probation.popitem(last=False)
+                self._probation_bytes -= len(chunk)
+            else:
+                _, chunk = self._protected.popitem(last=False)
+                self._protected_bytes -= len(chunk)
+            self.evictions += 1
+
+    def resize(self, capacity_bytes):
+        """Change the byte budget, evicting chunks if it shrank"""
+        with self._lock:
+            self.capacity = capacity_bytes
+            self._demote()
+        logger.info(f"Boot cache resized to {capacity_bytes // (1024 * 1024)} MB")
+
+    def clear(self):
+        with self._lock:
+            self._probation.clear()
+            self._protected.clear()
+            self._probation_bytes = 0
+            self._protected_bytes = 0
+
+    def status(self):
+        """Return cache counters for the status page"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'capacity_bytes': self.capacity,
+                'used_bytes': self.size,
+                'chunks': len(self._probation) + len(self._protected),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes_read_from_disk': self.bytes_read,
+            }
+
+
+class CachedSource:
+    """
+    Boot file source that reads through a BlockCache
+
+    Wraps any source exposing path, key, size, read() and close().
+    """
+
+    def __init__(self, source, cache):
+        self.source = source
+        self.cache = cache
+        self.path = source.path
+        self.key = source.key
+        self.size = source.size
+
+    def read(self, offset, length):
+        """Return up to length bytes starting at offset"""
+        chunk_size = self.cache.chunk_size
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b''
+
+        first = offset // chunk_size
+        last = (end - 1) // chunk_size
+        if first == last:
+            chunk = self.cache.get_chunk(self.key, first, self.source.read, self)
+            start = offset - first * chunk_size
+            return memoryview(chunk)[start:start + (end - offset)]
+
+        # Block straddles a chunk boundary
+        parts = []
+        for index in range(first, last + 1):
+            chunk = self.cache.get_chunk(self.key, index, self.source.read, self)
+            base = index * chunk_size
+            parts.append(memoryview(chunk)[max(offset, base) - base:min(end, base + chunk_size) - base])
+        return b''.join(parts)
+
+    def close(self):
+        self.source.close()
@@ -0,0 +1,179 @@
+import re
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# pxelinux.cfg/01-aa-bb-cc-dd-ee-ff, grub/grub.cfg-01-aa-bb-cc-dd-ee-ff, ipxe/aa-bb-cc-dd-ee-ff.ipxe
+MAC_PATTERN = r'([0-9a-f]{2}(?:[-:][0-9a-f]{2}){5})'
+PXELINUX_PATTERN = re.compile(r'^pxelinux\.cfg/01-' + MAC_PATTERN + r'$')
+GRUB_PATTERN = re.compile(r'^grub/grub\.cfg-01-' + MAC_PATTERN + r'$')
+IPXE_PATTERN = re.compile(r'^ipxe/(?:01-)?' + MAC_PATTERN + r'\.ipxe$')
+
+DEFAULT_PXELINUX = """DEFAULT winpe
+LABEL winpe
+    KERNEL /winpe/boot/pxeboot.com
+    APPEND /winpe/Boot/BCD /winpe/Boot/boot.sdi /winpe/sources/boot.wim
+"""
+
+
+def normalize_mac(mac):
+    """Return a MAC address as lowercase, colon separated"""
+    return mac.replace('-', ':').lower()
+
+
+class BootConfigProvider:
+    """
+    Per-client boot configurations rendered in memory
+
+    Keeps a snapshot of the client table keyed by MAC address, loaded on
+    first use through a callable so this module does not depend on the
+    database. Rendered configs are cached until invalidate() is called,
+    which the web app does whenever a client or its VHD is edited.
+    """
+
+    def __init__(self, loader, http_base=None):
+        """
+        Args:
+            loader (callable): Returns an iterable of dicts with mac, name,
+                boot_mode, vhd_id, vhd_name, vhd_path, is_persistent and
+                is_super_mode for every client
+            http_base (str, optional): URL of the HTTP boot endpoint; when set,
+                iPXE scripts fetch their payload over HTTP instead of TFTP
+        """
+        self.loader = loader
+        self.http_base = http_base
+        self.generation = 0
+        self._clients = None
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Drop the client snapshot and every rendered config"""
+        with self._lock:
+            self._clients = None
+            self._rendered.clear()
+            self.generation += 1
+        logger.debug("Boot configuration cache invalidated")
+
+    def _snapshot(self):
+        with self._lock:
+            if self._clients is not None:
+                return self._clients
+            generation = self.generation
+
+        try:
+            clients = {normalize_mac(c['mac']): c for c in self.loader()}
+        except Exception as e:
+            logger.error(f"Error loading clients for boot configuration: {e}")
+            return {}
+
+        with self._lock:
+            # Keep the snapshot only if nothing was invalidated while loading
+            if generation == self.generation:
+                self._clients = clients
+        return clients
+
+    def client(self, mac):
+        """Return the cached view of a client, or None if it is unknown"""
+        return self._snapshot().get(normalize_mac(mac))
+
+    def render(self, filename):
+        """
+        Render a boot configuration file
+
+        Args:
+            filename (str): Path requested by the client, relative to the boot root
+
+        Returns:
+            bytes: File contents, or None if the name is not a generated config
+        """
+        name = filename.replace('\\', '/').lstrip('/').lower()
+        with self._lock:
+            cached = self._rendered.get(name)
+            generation = self.generation
+        if cached is not None:
+            return cached
+
+        content = self._render(name)
+        if content is None:
+            return None
+
+        data = content.encode('utf-8')
+        with self._lock:
+            # A config rendered from settings invalidated meanwhile is served once, not cached
+            if generation == self.generation:
+                self._rendered[name] = data
+        return data
+
+    def _render(self, name):
+        if name == 'pxelinux.cfg/default':
+            return DEFAULT_PXELINUX
+
+        for pattern, renderer in ((PXELINUX_PATTERN, self.render_pxelinux),
+                                  (GRUB_PATTERN, self.render_grub),
+                                  (IPXE_PATTERN, self.render_ipxe)):
+            match = pattern.match(name)
+            if match:
+                client = self.client(match.group(1))
+                # Unknown clients fall through to the next config the loader tries
+                return renderer(client) if client else None
+        return None
+
+    def render_pxelinux(self, client):
+        """pxelinux / syslinux.efi menu for one client"""
+        lines = [f"# {client['name']} ({client['mac']})"]
+        if client.get('vhd_id'):
+            lines += [
+                "DEFAULT winpe",
+                "LABEL winpe",
+                f"    MENU LABEL {client['vhd_name']}",
+                "    KERNEL /winpe/boot/pxeboot.com",
+                "    APPEND /winpe/Boot/BCD /winpe/Boot/boot.sdi /winpe/sources/boot.wim",
+            ]
+        else:
+            lines += ["DEFAULT local", "LABEL local", "    LOCALBOOT 0"]
+        return '\n'.join(lines) + '\n'
+
+    def render_grub(self, client):
+        """GRUB configuration for UEFI clients"""
+        lines = [f"# {client['name']} ({client['mac']})", "set timeout=0"]
+        if client.get('vhd_id'):
+            lines += [
+                f"menuentry \"{client['vhd_name']}\" {{",
+                "    chainloader /winpe/boot/bootmgfw.efi",
+                "}",
+            ]
+        else:
+            lines += ["menuentry \"Local disk\" {", "    exit", "}"]
+        return '\n'.join(lines) + '\n'
+
+    def render_ipxe(self, client):
+        """iPXE script booting WinPE through wimboot, over HTTP when available"""
+        lines = ["#!ipxe", f"# {client['name']} ({client['mac']})"]
+        if not client.get('vhd_id'):
+            lines += ["exit"]
+            return '\n'.join(lines) + '\n'
+
+        # Absolute URLs: iPXE resolves relative paths against the script URI
+        base = self.http_base or 'tftp://${next-server}'
+        lines += [
+            f"set gnm-vhd-id {client['vhd_id']}",
+            f"set gnm-persistent {int(bool(client.get('is_persistent')))}",
+            f"set gnm-super-mode {int(bool(client.get('is_super_mode')))}",
+            f"set base {base}",
+            "kernel ${base}/wimboot",
+            "initrd ${base}/winpe/Boot/BCD BCD",
+            "initrd ${base}/winpe/Boot/boot.sdi boot.sdi",
+            "initrd ${base}/winpe/sources/boot.wim boot.wim",
+            "boot",
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def status(self):
+        with self._lock:
+            return {
+                'clients': len(self._clients) if self._clients is not None else None,
+                'rendered': len(self._rendered),
+                'generation': self.generation,
+            }
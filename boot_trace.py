@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from block_tracking import image_identity
+
+logger = logging.getLogger(__name__)
+
+TRACE_BLOCK_SIZE = 256 * 1024
+TRACE_SUFFIX = '.boottrace'
+# Reads in this long after a client attaches make up its boot
+BOOT_WINDOW = 180.0
+# Sessions reading less than this are probes (NBD_OPT_INFO, partition scans), not boots
+MIN_TRACE_BLOCKS = 64
+TRACES_KEPT = 8
+# Clients attaching within this long of a prefetch pass share it
+PREFETCH_INTERVAL = 300.0
+# Largest single read issued by a prefetch pass
+PREFETCH_RUN = 4 * 1024 * 1024
+
+
+def merge_traces(traces):
+    """
+    Merge boot traces into one prefetch list
+
+    A block makes the list when at least half of the traces read it. Blocks
+    are ordered by their average relative position in the traces that read
+    them, so the list follows the order a typical boot asks for them.
+
+    Args:
+        traces (list): Traces, each a list of block numbers in first-read order
+
+    Returns:
+        list: Block numbers to prefetch, in order
+    """
+    counts = {}
+    positions = {}
+    for trace in traces:
+        for index, block in enumerate(trace):
+            counts[block] = counts.get(block, 0) + 1
+            positions[block] = positions.get(block, 0.0) + index / len(trace)
+    quorum = (len(traces) + 1) // 2
+    blocks = [block for block, count in counts.items() if count >= quorum]
+    blocks.sort(key=lambda block: positions[block] / counts[block])
+    return blocks
+
+
+class BootTrace:
+    """
+    Recorded boots of one image and the prefetch list merged from them
+
+    Kept in a sidecar file next to the image:
+
+        <image>.boottrace   JSON with the last TRACES_KEPT traces, each the
+                            blocks one boot read, in first-read order
+
+    Traces are dropped when the image is replaced (inode or size change).
+    Smaller edits such as committed super mode changes keep them; newer
+    boots push the old traces out.
+
+    Besides the traces it holds the state of the current prefetch pass:
+    which listed blocks were warmed, and how often a booting client found
+    a listed block already warm (a hit) or had to wait for the disk (a miss).
+    """
+
+    def __init__(self, image_path, block_size=TRACE_BLOCK_SIZE):
+        self.image_path = image_path
+        self.path = f"{image_path}{TRACE_SUFFIX}"
+        self.block_size = block_size
+        self.identity = None
+        self.traces = []
+        self.coverage = []
+        self.prefetch = []
+        self.lock = threading.Lock()
+
+        self.prefetching = False
+        self.prefetched_at = None
+        self.listed = frozenset()
+        self.warmed = set()
+        self.demanded = set()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, image_path):
+        """
+        Read an image's traces
+
+        Returns:
+            BootTrace: The traces; empty if there are none or they are stale
+        """
+        trace = cls(image_path)
+        identity = image_identity(image_path)
+        trace.identity = identity[:2] if identity else None
+        try:
+            with open(trace.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return trace
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable boot trace {trace.path}: {e}")
+            return trace
+        if data.get('identity') != trace.identity:
+            logger.info(f"Discarding boot traces of replaced image {image_path}")
+            return trace
+        trace.block_size = data['block_size']
+        trace.traces = data['traces']
+        trace.coverage = data.get('coverage', [])
+        trace.prefetch = merge_traces(trace.traces)
+        return trace
+
+    def add(self, blocks):
+        """
+        Add one boot's trace and merge a new prefetch list
+
+        How much of the boot the previous list predicted is kept as the
+        list's coverage.
+
+        Args:
+            blocks (list): Block numbers the boot read, in first-read order
+        """
+        with self.lock:
+            if self.prefetch:
+                listed = set(self.prefetch)
+                covered = sum(1 for block in blocks if block in listed) / len(blocks)
+                self.coverage = (self.coverage + [covered])[-TRACES_KEPT:]
+            self.traces = (self.traces + [blocks])[-TRACES_KEPT:]
+            self.prefetch = merge_traces(self.traces)
+
+    def save(self):
+        with self.lock:
+            data = {
+                'identity': self.identity,
+                'block_size': self.block_size,
+                'traces': self.traces,
+                'coverage': self.coverage,
+            }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def start_pass(self):
+        """Reset the warm state for a new prefetch pass"""
+        self.prefetching = True
+        self.prefetched_at = time.monotonic()
+        self.listed = frozenset(self.prefetch)
+        self.warmed = set()
+        self.demanded = set()
+
+    def demand(self, block):
+        """Note that a booting client read a block for the first time"""
+        if block in self.listed:
+            self.demanded.add(block)
+            if block in self.warmed:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def status(self):
+        """Return trace and prefetch counters for this image"""
+        lookups = self.hits + self.misses
+        return {
+            'image': self.image_path,
+            'traces': len(self.traces),
+            'prefetch_bytes': len(self.prefetch) * self.block_size,
+            'trace_coverage': sum(self.coverage) / len(self.coverage) if self.coverage else None,
+            'prefetch_hits': self.hits,
+            'prefetch_misses': self.misses,
+            'prefetch_hit_rate': self.hits / lookups if lookups else None,
+        }
+
+
+class TraceSession:
+    """
+    The golden image reads of one client boot
+
+    Records the blocks read in the first BOOT_WINDOW seconds after the
+    client attached, each block once, in the order they were first read.
+    """
+
+    def __init__(self, store, trace):
+        self.store = store
+        self.trace = trace
+        self.block_size = trace.block_size
+        self.started = time.monotonic()
+        self.blocks = []
+        self.recording = True
+        self._seen = set()
+
+    def record(self, offset, length):
+        """Note a read of the image"""
+        if not self.recording or not length:
+            return
+        if time.monotonic() - self.started > BOOT_WINDOW:
+            self.finish()
+            return
+        for block in range(offset // self.block_size, (offset + length - 1) // self.block_size + 1):
+            if block not in self._seen:
+                self._seen.add(block)
+                self.blocks.append(block)
+                self.trace.demand(block)
+
+    def finish(self):
+        """Stop recording and hand the trace over if it looks like a boot"""
+        if not self.recording:
+            return
+        self.recording = False
+        if len(self.blocks) >= MIN_TRACE_BLOCKS:
+            self.store.add_trace(self.trace, self.blocks)
+
+
+class BootTraceStore:
+    """
+    Boot traces and prefetching for every image the server exports
+
+    Each client attaching to an image starts a TraceSession. When the image
+    has a prefetch list and no pass ran in the last PREFETCH_INTERVAL, a
+    background thread reads the listed blocks in boot order, so a boot
+    storm finds them in the page cache instead of queueing on the disk.
+    """
+
+    def __init__(self):
+        self._traces = {}
+        self._lock = threading.Lock()
+        self.passes = 0
+        self.prefetched_bytes = 0
+
+    def _trace(self, image_path):
+        identity = image_identity(image_path)
+        identity = identity[:2] if identity else None
+        with self._lock:
+            trace = self._traces.get(image_path)
+            if trace is None or trace.identity != identity:
+                trace = BootTrace.load(image_path)
+                self._traces[image_path] = trace
+            return trace
+
+    def session(self, image_path):
+        """
+        Start recording a client boot, prefetching the image if it is due
+
+        Args:
+            image_path (str): Image the client attached to
+
+        Returns:
+            TraceSession: Feed it the client's reads; finish() it on detach
+        """
+        trace = self._trace(image_path)
+        with self._lock:
+            due = (trace.prefetch and not trace.prefetching and
+                   (trace.prefetched_at is None or time.monotonic() - trace.prefetched_at > PREFETCH_INTERVAL))
+            if due:
+                trace.start_pass()
+                self.passes += 1
+        if due:
+            thread = threading.Thread(target=self._prefetch, args=(trace,), name='boot-prefetch')
+            thread.daemon = True
+            thread.start()
+        return TraceSession(self, trace)
+
+    def add_trace(self, trace, blocks):
+        """Merge a finished boot into its image's traces; saved off the serving thread"""
+        def save():
+            trace.add(blocks)
+            try:
+                trace.save()
+            except OSError as e:
+                logger.error(f"Failed to save boot trace {trace.path}: {e}")
+
+        thread = threading.Thread(target=save, name='boot-trace-save')
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch(self, trace):
+        """Read the listed blocks in boot order, skipping blocks clients already read"""
+        started = time.monotonic()
+        bs = trace.block_size
+        blocks = trace.prefetch
+        max_run = max(1, PREFETCH_RUN // bs)
+        buffer = memoryview(bytearray(max_run * bs))
+        warmed = 0
+        try:
+            fd = os.open(trace.image_path, os.O_RDONLY)
+        except OSError as e:
+            logger.error(f"Cannot prefetch {trace.image_path}: {e}")
+            trace.prefetching = False
+            return
+        try:
+            index = 0
+            while index < len(blocks):
+                first = blocks[index]
+                index += 1
+                if first in trace.demanded:
+                    continue
+                count = 1
+                while (count < max_run and index < len(blocks) and blocks[index] == first + count
+                       and blocks[index] not in trace.demanded):
+                    count += 1
+                    index += 1
+                read = os.preadv(fd, [buffer[:count * bs]], first * bs)
+                trace.warmed.update(range(first, first + count))
+                warmed += read
+                self.prefetched_bytes += read
+        except OSError as e:
+            logger.error(f"Prefetch of {trace.image_path} failed: {e}")
+        finally:
+            os.close(fd)
+            trace.prefetching = False
+        logger.info(f"Prefetched {warmed / (1024 * 1024):.0f} MB of {trace.image_path} "
+                    f"in {time.monotonic() - started:.1f}s")
+
+    def status(self):
+        """Return trace coverage and prefetch hit rate for the status page"""
+        with self._lock:
+            traces = list(self._traces.values())
+        hits = sum(trace.hits for trace in traces)
+        lookups = hits + sum(trace.misses for trace in traces)
+        coverage = [value for trace in traces for value in trace.coverage]
+        return {
+            'images': [trace.status() for trace in traces],
+            'prefetch_passes': self.passes,
+            'prefetched_bytes': self.prefetched_bytes,
+            'trace_coverage': sum(coverage) / len(coverage) if coverage else None,
+            'prefetch_hit_rate': hits / lookups if lookups else None,
+        }
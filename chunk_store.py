@@ -0,0 +1,754 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from file_clone import data_segments
+from io_throttle import CopyThrottle
+
+# The rolling hash is vectorized when numpy is available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Chunk sizes: the cut point is searched between MIN and MAX, aiming for AVG
+MIN_CHUNK = 64 * 1024
+AVG_CHUNK = 256 * 1024
+MAX_CHUNK = 1024 * 1024
+# Files are chunked in independent segments so several processes can share
+# the work; each segment boundary costs at most one extra chunk of dedup
+SEGMENT_SIZE = 64 * 1024 * 1024
+GC_GRACE_SECONDS = 3600
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Gear table for the rolling hash; seeded so every process cuts identically
+_rng = random.Random(0x47454152)
+GEAR = [_rng.getrandbits(32) for _ in range(256)]
+del _rng
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy else None
+# The Gear hash only depends on this many trailing bytes
+GEAR_WINDOW = 32
+_ZEROS = bytes(MAX_CHUNK)
+# Throttled segments are read in steps of this size
+READ_STEP = 4 * 1024 * 1024
+# Set in chunking worker processes when the store was given a throttle
+_worker_throttle = None
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+def _zeros(size):
+    return _ZEROS[:size] if size <= MAX_CHUNK else bytes(size)
+
+
+def _masks(avg):
+    # Normalized chunking (FastCDC): a harder mask before the average size and
+    # an easier one after it pull chunk sizes towards the average
+    bits = avg.bit_length() - 1
+    return (1 << (bits + 2)) - 1, (1 << (bits - 2)) - 1
+
+
+def _find_cut_python(data, position, limit, min_size, avg_size, masks):
+    """Cut point of one chunk, hashing byte by byte (about 6 MB/s per core)"""
+    mask_small, mask_large = masks
+    gear = GEAR
+    h = 0
+    normal = position + min(avg_size, limit)
+    for i in range(position + min_size, normal):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        if not h & mask_small:
+            return i + 1
+    for i in range(normal, position + limit):
+        h = ((h << 1) + gear[data[i]]) & 0xFFFFFFFF
+        if not h & mask_large:
+            return i + 1
+    return position + limit
+
+
+def _gear_hashes(data, origin, begin, end):
+    """
+    Gear hash after each byte of data[begin:end], hashing from origin on
+
+    The hash after byte i is the sum of GEAR[data[i - k]] << k over the
+    last GEAR_WINDOW bytes, so it is built for a whole window at once by
+    doubling: log2(GEAR_WINDOW) shifted adds instead of one step per byte.
+    uint32 arithmetic wraps like the & 0xFFFFFFFF of the byte loop.
+    """
+    context = max(origin, begin - (GEAR_WINDOW - 1))
+    h = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8, count=end - context, offset=context)]
+    span = 1
+    while span < GEAR_WINDOW:
+        # Bytes before origin count as absent, exactly as the byte loop starts from h = 0
+        h[span:] += h[:-span] << numpy.uint32(span)
+        span *= 2
+    return h[begin - context:]
+
+
+def _find_cut_numpy(data, position, limit, min_size, avg_size, masks):
+    """Cut point of one chunk, hashing min_size-byte windows with numpy"""
+    origin = position + min_size
+    normal = position + min(avg_size, limit)
+    stop = position + limit
+    for mask, begin, end in ((masks[0], origin, normal), (masks[1], normal, stop)):
+        while begin < end:
+            window_end = min(end, begin + min_size)
+            hits = numpy.flatnonzero((_gear_hashes(data, origin, begin, window_end) & numpy.uint32(mask)) == 0)
+            if len(hits):
+                return begin + int(hits[0]) + 1
+            begin = window_end
+    return stop
+
+
+_find_cut = _find_cut_numpy if numpy is not None else _find_cut_python
+
+
+def cut_points(data, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """
+    Split a buffer into content-defined chunks
+
+    A Gear rolling hash is updated byte by byte from min_size into the chunk;
+    a chunk ends where the hash has enough trailing zero bits. Because the
+    hash only depends on the last 32 bytes, the same content produces the
+    same cut points wherever it sits in the file. With numpy the hash is
+    computed a window at once, about 200 MB/s per core instead of 6; the
+    cut points are the same either way.
+
+    Args:
+        data (bytes): Buffer to split
+        min_size, avg_size, max_size (int): Chunk size bounds
+
+    Returns:
+        list: Chunk lengths, summing to len(data)
+    """
+    masks = _masks(avg_size)
+    lengths = []
+    position = 0
+    total = len(data)
+    while position < total:
+        remaining = total - position
+        if remaining <= min_size:
+            lengths.append(remaining)
+            break
+
+        # Unwritten and zeroed areas are common in disk images; skip hashing them
+        limit = min(max_size, remaining)
+        if data[position:position + limit] == _zeros(limit):
+            lengths.append(limit)
+            position += limit
+            continue
+
+        cut = _find_cut(data, position, limit, min_size, avg_size, masks)
+        lengths.append(cut - position)
+        position = cut
+    return lengths
+
+
+def _object_path(objects_dir, digest):
+    return os.path.join(objects_dir, digest[:2], digest)
+
+
+def _store_object(objects_dir, digest, data):
+    """Write a chunk unless it is already stored; returns the bytes added"""
+    path = _object_path(objects_dir, digest)
+    if os.path.exists(path):
+        # Refresh the mtime so a concurrent gc treats it as recently referenced
+        try:
+            os.utime(path)
+            return 0
+        except FileNotFoundError:
+            pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+
+def _init_worker(throttle_settings, shared, share):
+    """Give a chunking worker process its share of the parent's throttle"""
+    global _worker_throttle
+    _worker_throttle = CopyThrottle.worker(throttle_settings, shared, share)
+    if _worker_throttle.low_priority:
+        _worker_throttle.priority().__enter__()  # for the life of the worker
+
+
+def _read_segment(path, offset, length, throttle):
+    with open(path, 'rb') as f:
+        if throttle is None:
+            f.seek(offset)
+            return f.read(length)
+        data = bytearray()
+        fd = f.fileno()
+        throttle.open_source(fd)
+        while len(data) < length:
+            position = offset + len(data)
+            step = min(READ_STEP, length - len(data))
+            resident = throttle.before_read(fd, position, step)
+            piece = os.pread(fd, step, position)
+            if not piece:
+                break
+            data += piece
+            throttle.copied(fd, None, position, len(piece), resident)
+        throttle.forget(fd)
+        return bytes(data)
+
+
+def _chunk_segment(path, objects_dir, offset, length, bounds, throttle=None):
+    """
+    Chunk one segment of a file and store its new chunks
+
+    Runs in a worker process. Returns the segment's manifest entries and the
+    number of bytes newly written to the store.
+    """
+    data = _read_segment(path, offset, length, throttle or _worker_throttle)
+
+    entries = []
+    added = 0
+    position = 0
+    view = memoryview(data)
+    for size in cut_points(data, *bounds):
+        chunk = view[position:position + size]
+        position += size
+        if chunk == _zeros(size):
+            # All-zero chunks are not stored; restore leaves them as holes
+            entries.append([None, size])
+            continue
+        digest = hashlib.sha256(chunk).hexdigest()
+        added += _store_object(objects_dir, digest, chunk)
+        entries.append([digest, size])
+    return entries, added
+
+
+def _hole_entries(length):
+    entries = []
+    while length > 0:
+        size = min(length, MAX_CHUNK)
+        entries.append([None, size])
+        length -= size
+    return entries
+
+
+def is_manifest(path):
+    """Whether a restoration point path refers to a chunk store manifest"""
+    return bool(path) and path.endswith(MANIFEST_SUFFIX)
+
+
+def store_for_manifest(path):
+    """Open the chunk store a manifest belongs to"""
+    return ChunkStore(os.path.dirname(os.path.dirname(os.path.abspath(path))))
+
+
+class ChunkStore:
+    """
+    Content-addressed, deduplicating store for disk images
+
+    Files are cut into variable-size chunks at content-defined boundaries,
+    and each chunk is stored once under its SHA-256 digest:
+
+        <root>/objects/ab/abcdef...     chunk data
+        <root>/manifests/<name>.manifest.json
+
+    A manifest lists the chunks of one file in order, so storing another
+    restoration point of the same image, or another image installed from
+    the same template, only adds the chunks that differ. Chunks no manifest
+    references are removed by gc().
+    """
+
+    def __init__(self, root, workers=None, min_size=MIN_CHUNK, avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+        """
+        Args:
+            root (str): Store directory, normally <vhd_storage_dir>/chunks
+            workers (int, optional): Processes used to chunk a file; defaults
+                to the number of CPUs, 1 chunks in the calling process
+            min_size, avg_size, max_size (int): Chunk size bounds
+        """
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.manifests_dir = os.path.join(root, 'manifests')
+        self.workers = workers or os.cpu_count() or 1
+        self.bounds = (min_size, avg_size, max_size)
+        self._lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+
+    def manifest_path(self, name):
+        safe = name.replace('/', '_').replace('\\', '_')
+        return os.path.join(self.manifests_dir, f"{safe}{MANIFEST_SUFFIX}")
+
+    def _segments(self, path, size):
+        """Split a file into segments, skipping holes without reading them"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            position = 0
+            for offset, length in data_segments(fd, size):
+                if offset > position:
+                    yield 'hole', position, offset - position
+                end = offset + length
+                # Align segment starts so unchanged regions chunk the same way every time
+                start = offset
+                while start < end:
+                    stop = min(end, (start // SEGMENT_SIZE + 1) * SEGMENT_SIZE)
+                    yield 'data', start, stop - start
+                    start = stop
+                position = end
+            if position < size:
+                yield 'hole', position, size - position
+        finally:
+            os.close(fd)
+
+    def _run(self, path, segments, progress=None, throttle=None):
+        """
+        Chunk the data segments of a file, in parallel when there are several
+
+        Args:
+            path (str): File being stored
+            segments (list): ('data', offset, length), ('hole', offset, length)
+                or ('keep', entries) items, in file order
+            progress (callable, optional): Called with (bytes done, total bytes)
+                as segments complete; an exception it raises aborts the run
+            throttle (CopyThrottle, optional): Pace the reads of the file
+
+        Returns:
+            tuple: (manifest entries, bytes newly stored)
+        """
+        results = [None] * len(segments)
+        work = []
+        done = total = 0
+        for i, segment in enumerate(segments):
+            if segment[0] == 'hole':
+                results[i] = (_hole_entries(segment[2]), 0)
+                done += segment[2]
+            elif segment[0] == 'keep':
+                results[i] = (segment[1], 0)
+                done += sum(size for _digest, size in segment[1])
+            else:
+                work.append((i, segment[1], segment[2]))
+                total += segment[2]
+        total += done
+        if progress:
+            progress(done, total)
+
+        if throttle is not None and not throttle.active:
+            throttle = None
+        if self.workers > 1 and len(work) > 1:
+            methods = multiprocessing.get_all_start_methods()
+            # forkserver avoids forking a threaded web server
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+            workers = min(self.workers, len(work))
+            pool_args = {}
+            shared = None
+            if throttle:
+                # Workers pace themselves by the rate the throttle keeps adapting here
+                shared = context.Array('d', [throttle.adapt(), 0.0])
+                pool_args = {'initializer': _init_worker, 'initargs': (throttle.settings(), shared, workers)}
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, **pool_args) as pool:
+                futures = {pool.submit(_chunk_segment, path, self.objects_dir, offset, length, self.bounds): (i, length)
+                           for i, offset, length in work}
+                pending = set(futures)
+                seen = 0
+                try:
+                    while pending:
+                        finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                        if shared is not None:
+                            throttle.bytes_done += int(shared[1]) - seen
+                            seen = int(shared[1])
+                            shared[0] = throttle.adapt()
+                        for future in finished:
+                            i, length = futures[future]
+                            results[i] = future.result()
+                            done += length
+                        if progress:
+                            progress(done, total)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        else:
+            with throttle.priority() if throttle else nullcontext():
+                for i, offset, length in work:
+                    results[i] = _chunk_segment(path, self.objects_dir, offset, length, self.bounds, throttle)
+                    done += length
+                    if progress:
+                        progress(done, total)
+
+        chunks = [entry for entries, _added in results for entry in entries]
+        return chunks, sum(added for _entries, added in results)
+
+    def _write_manifest(self, path, name, kind, meta, size, chunks, base=None):
+        manifest = {
+            'version': 1,
+            'name': name,
+            'kind': kind,
+            'source': os.path.abspath(path),
+            'size': size,
+            'created': datetime.now().isoformat(),
+            'chunks': chunks,
+        }
+        if base:
+            # Informational only: every manifest lists all of its chunks
+            manifest['base'] = os.path.basename(base)
+        if meta:
+            manifest['meta'] = meta
+
+        manifest_path = self.manifest_path(name)
+        tmp = f"{manifest_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, manifest_path)
+        return manifest_path
+
+    def put(self, path, name, kind='image', meta=None, progress=None, throttle=None):
+        """
+        Store a file and write its manifest
+
+        Args:
+            path (str): File to store
+            name (str): Manifest name, unique within the store
+            kind (str): 'image' or 'restoration_point'
+            meta (dict, optional): Extra fields kept in the manifest
+            progress (callable, optional): Called with (bytes done, total bytes)
+            throttle (CopyThrottle, optional): Pace the reads of the file
+
+        Returns:
+            str: Path of the manifest
+        """
+        start = time.time()
+        size = os.path.getsize(path)
+        chunks, added = self._run(path, list(self._segments(path, size)), progress, throttle)
+        manifest_path = self._write_manifest(path, name, kind, meta, size, chunks)
+
+        logger.info(f"Stored {path} as {name}: {size / (1024**2):.1f} MB in {len(chunks)} chunks, "
+                    f"{added / (1024**2):.1f} MB new, in {time.time() - start:.1f}s")
+        return manifest_path
+
+    def put_incremental(self, path, name, base_manifest_path, changed_ranges, kind='image', meta=None,
+                        progress=None, throttle=None):
+        """
+        Store a file that is known to differ from a stored one only in some ranges
+
+        Chunks of the base manifest that do not overlap a changed range are
+        reused without reading the file; the chunks that do are read and cut
+        again. The result is a complete manifest, independent of the base.
+
+        Args:
+            path (str): File to store
+            name (str): Manifest name
+            base_manifest_path (str): Manifest the file matched before the changes
+            changed_ranges (list): (offset, length) ranges written since then
+            kind (str): 'image' or 'restoration_point'
+            meta (dict, optional): Extra fields kept in the manifest
+            progress (callable, optional): Called with (bytes done, total bytes)
+            throttle (CopyThrottle, optional): Pace the reads of the file
+
+        Returns:
+            str: Path of the manifest
+        """
+        start = time.time()
+        size = os.path.getsize(path)
+        base = self.load_manifest(base_manifest_path)
+        if base['size'] != size:
+            logger.info(f"{path} changed size since {base['name']}; storing it in full")
+            return self.put(path, name, kind, meta, progress, throttle)
+
+        ranges = sorted(changed_ranges)
+        segments = []
+        keep = []
+        dirty_start = None
+        offset = 0
+        r = 0
+        for entry in base['chunks']:
+            end = offset + entry[1]
+            while r < len(ranges) and ranges[r][0] + ranges[r][1] <= offset:
+                r += 1
+            dirty = r < len(ranges) and ranges[r][0] < end
+            if dirty:
+                if keep:
+                    segments.append(('keep', keep))
+                    keep = []
+                if dirty_start is None:
+                    dirty_start = offset
+            else:
+                if dirty_start is not None:
+                    segments.extend(self._data_segments(dirty_start, offset))
+                    dirty_start = None
+                keep.append(entry)
+            offset = end
+        if dirty_start is not None:
+            segments.extend(self._data_segments(dirty_start, offset))
+        if keep:
+            segments.append(('keep', keep))
+
+        chunks, added = self._run(path, segments, progress, throttle)
+        manifest_path = self._write_manifest(path, name, kind, meta, size, chunks, base=base_manifest_path)
+
+        changed = sum(length for _offset, length in ranges)
+        logger.info(f"Stored {path} as {name} from {base['name']}: {changed / (1024**2):.1f} MB changed, "
+                    f"{added / (1024**2):.1f} MB new, in {time.time() - start:.1f}s")
+        return manifest_path
+
+    @staticmethod
+    def _data_segments(start, end):
+        segments = []
+        while start < end:
+            stop = min(end, start + SEGMENT_SIZE)
+            segments.append(('data', start, stop - start))
+            start = stop
+        return segments
+
+    @staticmethod
+    def _offsets(manifest):
+        offset = 0
+        for digest, size in manifest['chunks']:
+            yield offset, size, digest
+            offset += size
+
+    def diff_ranges(self, manifest_path, other_manifest_path):
+        """
+        Ranges where the file of one manifest differs from another's
+
+        Returns:
+            list: (offset, length) of every chunk of the first manifest that
+                the second does not have at the same place
+        """
+        other = set(self._offsets(self.load_manifest(other_manifest_path)))
+        return [(offset, size) for offset, size, digest in self._offsets(self.load_manifest(manifest_path))
+                if (offset, size, digest) not in other]
+
+    @staticmethod
+    def load_manifest(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def restore(self, manifest_path, target_path, verify=True, progress=None, throttle=None):
+        """
+        Rebuild a file from its manifest
+
+        Zero chunks are left as holes. The file is written next to the target
+        and renamed over it once complete.
+
+        Args:
+            manifest_path (str): Manifest to restore
+            target_path (str): File to write
+            verify (bool): Check each chunk against its digest
+            progress (callable, optional): Called with (bytes done, total bytes)
+            throttle (CopyThrottle, optional): Pace the writes
+        """
+        manifest = self.load_manifest(manifest_path)
+        tmp = f"{target_path}.restore.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            offset = 0
+            for digest, size in manifest['chunks']:
+                if digest is not None:
+                    with open(_object_path(self.objects_dir, digest), 'rb') as f:
+                        data = f.read()
+                    if len(data) != size or (verify and hashlib.sha256(data).hexdigest() != digest):
+                        raise ChunkStoreError(f"chunk {digest} is corrupt")
+                    os.pwrite(fd, data, offset)
+                    if throttle:
+                        throttle.copied(None, fd, offset, size)
+                offset += size
+                if progress:
+                    progress(offset, manifest['size'])
+            os.ftruncate(fd, manifest['size'])
+            os.fsync(fd)
+            if throttle:
+                throttle.finish(fd)
+        except Exception:
+            if throttle:
+                throttle.forget(fd)
+            os.close(fd)
+            os.remove(tmp)
+            raise
+        os.close(fd)
+        os.replace(tmp, target_path)
+
+    def restore_in_place(self, manifest_path, target_path, ranges=None, verify=True, progress=None,
+                         throttle=None):
+        """
+        Bring an existing file back to a manifest, rewriting only what differs
+
+        Args:
+            manifest_path (str): Manifest to restore
+            target_path (str): File to update in place
+            ranges (list, optional): (offset, length) ranges known to differ;
+                when omitted, every chunk is read and compared with its digest
+            verify (bool): Check chunks read from the store against their digests
+            progress (callable, optional): Called with (bytes done, total bytes)
+            throttle (CopyThrottle, optional): Pace the reads and writes
+
+        Returns:
+            int: Bytes written to the target
+        """
+        manifest = self.load_manifest(manifest_path)
+        ranges = sorted(ranges) if ranges is not None else None
+        written = 0
+        r = 0
+        fd = os.open(target_path, os.O_RDWR)
+        try:
+            for offset, size, digest in self._offsets(manifest):
+                if progress:
+                    progress(offset, manifest['size'])
+                if ranges is not None:
+                    while r < len(ranges) and ranges[r][0] + ranges[r][1] <= offset:
+                        r += 1
+                    if r >= len(ranges) or ranges[r][0] >= offset + size:
+                        continue
+                else:
+                    current = os.pread(fd, size, offset)
+                    if throttle:
+                        throttle.consume(size)
+                    if digest is None:
+                        if current == _zeros(size):
+                            continue
+                    elif len(current) == size and hashlib.sha256(current).hexdigest() == digest:
+                        continue
+
+                if digest is None:
+                    data = _zeros(size)
+                else:
+                    with open(_object_path(self.objects_dir, digest), 'rb') as f:
+                        data = f.read()
+                    if len(data) != size or (verify and hashlib.sha256(data).hexdigest() != digest):
+                        raise ChunkStoreError(f"chunk {digest} is corrupt")
+                os.pwrite(fd, data, offset)
+                written += size
+                if throttle:
+                    throttle.copied(None, fd, offset, size)
+            os.ftruncate(fd, manifest['size'])
+            os.fsync(fd)
+            if throttle:
+                throttle.finish(fd)
+            if progress:
+                progress(manifest['size'], manifest['size'])
+        finally:
+            if throttle:
+                throttle.forget(fd)
+            os.close(fd)
+        return written
+
+    def delete(self, manifest_path):
+        """Remove a manifest; its chunks go away on the next gc()"""
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    def _manifests(self):
+        for entry in os.scandir(self.manifests_dir):
+            if entry.name.endswith(MANIFEST_SUFFIX):
+                try:
+                    yield entry.path, self.load_manifest(entry.path)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Unreadable manifest {entry.path}: {e}")
+                    raise ChunkStoreError(f"unreadable manifest {entry.path}")
+
+    def _objects(self):
+        for directory in os.scandir(self.objects_dir):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                yield entry
+
+    def gc(self, grace_seconds=GC_GRACE_SECONDS):
+        """
+        Delete chunks no manifest references
+
+        Chunks touched within the grace period are kept, so a file being
+        stored while gc runs does not lose chunks its manifest is about to
+        reference.
+
+        Returns:
+            dict: Number of chunks and bytes removed, and chunks kept
+        """
+        with self._lock:
+            # An unreadable manifest aborts the sweep instead of freeing its chunks
+            referenced = set()
+            for _path, manifest in self._manifests():
+                referenced.update(digest for digest, _size in manifest['chunks'] if digest)
+
+            cutoff = time.time() - grace_seconds
+            removed = freed = kept = 0
+            for entry in self._objects():
+                if entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    if stat.st_mtime < cutoff:
+                        os.remove(entry.path)
+                    continue
+                if entry.name in referenced:
+                    kept += 1
+                    continue
+                stat = entry.stat()
+                if stat.st_mtime >= cutoff:
+                    kept += 1
+                    continue
+                os.remove(entry.path)
+                removed += 1
+                freed += stat.st_size
+
+        logger.info(f"Chunk store gc removed {removed} chunks ({freed / (1024**2):.1f} MB), kept {kept}")
+        return {'removed_chunks': removed, 'freed_bytes': freed, 'kept_chunks': kept}
+
+    def report(self):
+        """
+        Deduplication report
+
+        Returns:
+            dict: Logical size of everything stored, bytes actually stored,
+                the dedup ratio between the two, and per-manifest sizes with
+                the bytes only that manifest references
+        """
+        owners = {}
+        sizes = {}
+        manifests = []
+        logical = zero = 0
+        for path, manifest in self._manifests():
+            logical += manifest['size']
+            for digest, size in manifest['chunks']:
+                if digest is None:
+                    zero += size
+                    continue
+                sizes[digest] = size
+                holders = owners.setdefault(digest, set())
+                holders.add(manifest['name'])
+            manifests.append(manifest)
+
+        stored = sum(sizes.values())
+        exclusive = {}
+        for digest, holders in owners.items():
+            if len(holders) == 1:
+                holder = next(iter(holders))
+                exclusive[holder] = exclusive.get(holder, 0) + sizes[digest]
+
+        on_disk = sum(entry.stat().st_size for entry in self._objects() if not entry.name.endswith('.tmp'))
+        return {
+            'manifests': len(manifests),
+            'chunks': len(sizes),
+            'logical_bytes': logical,
+            'zero_bytes': zero,
+            'stored_bytes': stored,
+            'on_disk_bytes': on_disk,
+            'unreferenced_bytes': max(0, on_disk - stored),
+            'dedup_ratio': round((logical - zero) / stored, 2) if stored else None,
+            'space_saving_ratio': round(logical / on_disk, 2) if on_disk else None,
+            'items': [{
+                'name': m['name'],
+                'kind': m.get('kind'),
+                'created': m.get('created'),
+                'size_bytes': m['size'],
+                'exclusive_bytes': exclusive.get(m['name'], 0),
+            } for m in sorted(manifests, key=lambda m: m.get('created') or '')],
+        }
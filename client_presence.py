@@ -0,0 +1,189 @@
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, or_
+
+from app import app, db
+from models import Client
+
+logger = logging.getLogger(__name__)
+
+# Changed clients are written back this often
+FLUSH_INTERVAL = 5.0
+# Three missed heartbeats (sent every 60 s) and a client counts as offline
+OFFLINE_AFTER = timedelta(seconds=180)
+
+
+class PresenceTable:
+    """
+    In-memory online state of clients, written behind to the database
+
+    Heartbeats only update this table. Every FLUSH_INTERVAL seconds the
+    clients that changed are handed to the flush function in one batch, so
+    database writes grow with the flush rate, not with the heartbeat rate.
+    The flush also returns the MAC address each row has now, so a client
+    edited through another worker process is forgotten here and has to
+    pass the lookup again on its next heartbeat.
+    Readers ask the table first and fall back to the database row for
+    clients that have not sent a heartbeat since the server started, or
+    whose row is newer because another worker process took the heartbeat.
+    """
+
+    def __init__(self, flusher, flush_interval=FLUSH_INTERVAL, offline_after=OFFLINE_AFTER):
+        """
+        Args:
+            flusher (callable): Called with a list of dicts with 'client_id',
+                'mac_address', 'is_online', 'ip_address' and 'last_seen';
+                returns {client_id: current MAC address} for the rows that
+                still exist, raises if they could not be written
+            flush_interval (float): Seconds between flushes
+            offline_after (timedelta): Silence after which a client is offline
+        """
+        self.flusher = flusher
+        self.flush_interval = flush_interval
+        self.offline_after = offline_after
+        self._clients = {}
+        self._macs = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, client_id, mac_address):
+        """Remember which MAC address a client id belongs to"""
+        with self._lock:
+            self._macs[client_id] = mac_address
+
+    def forget(self, client_id):
+        """Drop a client that was edited or deleted; reads go to its row again"""
+        with self._lock:
+            self._macs.pop(client_id, None)
+            self._clients.pop(client_id, None)
+            self._dirty.discard(client_id)
+
+    def heartbeat(self, client_id, mac_address, ip_address):
+        """
+        Record a heartbeat
+
+        Args:
+            client_id (int): Client id
+            mac_address (str): MAC address the client reported
+            ip_address (str): Current IP address
+
+        Returns:
+            bool: False if the client is not tracked or the MAC address does
+                not match; look it up and track() it first
+        """
+        with self._lock:
+            if self._macs.get(client_id) != mac_address:
+                return False
+            self._clients[client_id] = {
+                'is_online': True,
+                'ip_address': ip_address,
+                'last_seen': datetime.utcnow(),
+            }
+            self._dirty.add(client_id)
+        self._start()
+        return True
+
+    def _entry(self, client):
+        """The local entry of a client, or None if its row is newer"""
+        entry = self._clients.get(client.id)
+        if entry is None or (client.last_seen and client.last_seen > entry['last_seen']):
+            return None
+        return entry
+
+    def is_online(self, client):
+        """Whether a client is online, from memory if it sent a heartbeat"""
+        entry = self._entry(client)
+        if entry is None:
+            return bool(client.is_online) and (
+                client.last_seen is None or datetime.utcnow() - client.last_seen < self.offline_after)
+        return entry['is_online'] and datetime.utcnow() - entry['last_seen'] < self.offline_after
+
+    def get(self, client):
+        """Online state, IP address and last heartbeat of a client"""
+        entry = self._entry(client)
+        if entry is None:
+            return {'is_online': self.is_online(client), 'ip_address': client.ip_address,
+                    'last_seen': client.last_seen}
+        return dict(entry, is_online=self.is_online(client))
+
+    def flush(self):
+        """Write every changed client; failed ones are retried next time"""
+        expired = datetime.utcnow() - self.offline_after
+        with self._lock:
+            for client_id, entry in self._clients.items():
+                if entry['is_online'] and entry['last_seen'] < expired:
+                    entry['is_online'] = False
+                    self._dirty.add(client_id)
+            dirty, self._dirty = self._dirty, set()
+            rows = [dict(self._clients[client_id], client_id=client_id, mac_address=self._macs.get(client_id))
+                    for client_id in dirty if client_id in self._clients]
+        if not rows:
+            return 0
+        try:
+            current = self.flusher(rows)
+        except Exception as e:
+            logger.error(f"Failed to write client presence: {e}")
+            with self._lock:
+                self._dirty.update(row['client_id'] for row in rows)
+            return 0
+        with self._lock:
+            for row in rows:
+                client_id = row['client_id']
+                if current.get(client_id) != row['mac_address'] and self._macs.get(client_id) == row['mac_address']:
+                    # Edited or deleted elsewhere: look the client up again
+                    self._macs.pop(client_id, None)
+                    self._clients.pop(client_id, None)
+                    self._dirty.discard(client_id)
+        return len(rows)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='presence-flush')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+def write_presence(rows):
+    """
+    Write the presence of many clients in one batched UPDATE
+
+    A row whose last_seen is newer than the written one was updated by
+    another worker process from a later heartbeat and is left alone, as
+    is a row whose MAC address was changed since the client was tracked.
+
+    Returns:
+        dict: Current MAC address of every written client that still exists
+    """
+    table = Client.__table__
+    statement = table.update().where(
+        table.c.id == bindparam('client_id'),
+        table.c.mac_address == bindparam('mac'),
+        or_(table.c.last_seen.is_(None), table.c.last_seen <= bindparam('seen'))
+    ).values(
+        is_online=bindparam('online'),
+        ip_address=bindparam('ip'),
+        last_seen=bindparam('seen'))
+    with app.app_context():
+        db.session.execute(statement, [
+            {'client_id': row['client_id'], 'mac': row['mac_address'], 'online': row['is_online'],
+             'ip': row['ip_address'], 'seen': row['last_seen']}
+            for row in rows])
+        db.session.commit()
+        return dict(db.session.query(table.c.id, table.c.mac_address).filter(
+            table.c.id.in_([row['client_id'] for row in rows])))
+
+
+presence = PresenceTable(write_presence)
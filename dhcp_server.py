@@ -0,0 +1,717 @@
+import os
+import json
+import time
+import heapq
+import socket
+import struct
+import asyncio
+import logging
+import ipaddress
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+BOOTREQUEST = 1
+BOOTREPLY = 2
+
+# DHCP message types (RFC 2132 option 53)
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+DHCPINFORM = 8
+
+# DHCP options
+OPT_PAD = 0
+OPT_SUBNET_MASK = 1
+OPT_ROUTER = 3
+OPT_DNS = 6
+OPT_HOSTNAME = 12
+OPT_VENDOR_SPECIFIC = 43
+OPT_REQUESTED_IP = 50
+OPT_LEASE_TIME = 51
+OPT_MESSAGE_TYPE = 53
+OPT_SERVER_ID = 54
+OPT_PARAM_REQUEST = 55
+OPT_RENEWAL_TIME = 58
+OPT_REBINDING_TIME = 59
+OPT_VENDOR_CLASS = 60
+OPT_TFTP_SERVER = 66
+OPT_BOOTFILE = 67
+OPT_USER_CLASS = 77
+OPT_CLIENT_ARCH = 93
+OPT_CLIENT_UUID = 97
+OPT_END = 255
+
+MAGIC_COOKIE = b'\x63\x82\x53\x63'
+BOOTP_FORMAT = '!BBBBIHH4s4s4s4s16s64s128s'
+BOOTP_SIZE = struct.calcsize(BOOTP_FORMAT)
+BROADCAST_FLAG = 0x8000
+
+# PXE client architectures (RFC 4578 option 93) that boot EFI images
+EFI_ARCHITECTURES = {6, 7, 9, 10, 11, 16}
+
+# Renewals only hit the journal once a lease has moved this far past the persisted expiry
+JOURNAL_SLACK = 0.5
+
+
+class DHCPPacket:
+    """A BOOTP/DHCP message"""
+
+    def __init__(self):
+        self.op = BOOTREQUEST
+        self.htype = 1
+        self.hlen = 6
+        self.hops = 0
+        self.xid = 0
+        self.secs = 0
+        self.flags = 0
+        self.ciaddr = '0.0.0.0'
+        self.yiaddr = '0.0.0.0'
+        self.siaddr = '0.0.0.0'
+        self.giaddr = '0.0.0.0'
+        self.chaddr = b'\0' * 16
+        self.sname = b''
+        self.file = b''
+        self.options = {}
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Parse a DHCP message
+
+        Args:
+            data (bytes): Raw UDP payload
+
+        Returns:
+            DHCPPacket: Parsed message
+        """
+        if len(data) < BOOTP_SIZE + 4 or data[BOOTP_SIZE:BOOTP_SIZE + 4] != MAGIC_COOKIE:
+            raise ValueError("Not a DHCP packet")
+
+        packet = cls()
+        (packet.op, packet.htype, packet.hlen, packet.hops, packet.xid, packet.secs,
+         packet.flags, ciaddr, yiaddr, siaddr, giaddr, packet.chaddr, sname, file) = \
+            struct.unpack(BOOTP_FORMAT, data[:BOOTP_SIZE])
+        packet.ciaddr = socket.inet_ntoa(ciaddr)
+        packet.yiaddr = socket.inet_ntoa(yiaddr)
+        packet.siaddr = socket.inet_ntoa(siaddr)
+        packet.giaddr = socket.inet_ntoa(giaddr)
+        packet.sname = sname.rstrip(b'\0')
+        packet.file = file.rstrip(b'\0')
+
+        i = BOOTP_SIZE + 4
+        while i < len(data):
+            code = data[i]
+            if code == OPT_END:
+                break
+            if code == OPT_PAD:
+                i += 1
+                continue
+            if i + 1 >= len(data):
+                break
+            length = data[i + 1]
+            # Long options may be split over several instances (RFC 3396)
+            packet.options[code] = packet.options.get(code, b'') + data[i + 2:i + 2 + length]
+            i += 2 + length
+        return packet
+
+    def to_bytes(self):
+        """Serialize the message"""
+        header = struct.pack(
+            BOOTP_FORMAT, self.op, self.htype, self.hlen, self.hops, self.xid, self.secs,
+            self.flags, socket.inet_aton(self.ciaddr), socket.inet_aton(self.yiaddr),
+            socket.inet_aton(self.siaddr), socket.inet_aton(self.giaddr),
+            self.chaddr.ljust(16, b'\0'), self.sname.ljust(64, b'\0')[:64],
+            self.file.ljust(128, b'\0')[:128]
+        )
+        body = bytearray(MAGIC_COOKIE)
+        for code, value in self.options.items():
+            for i in range(0, max(len(value), 1), 255):
+                chunk = value[i:i + 255]
+                body += bytes((code, len(chunk))) + chunk
+        body.append(OPT_END)
+        # Some PXE ROMs drop replies shorter than a BOOTP message
+        packet = header + bytes(body)
+        return packet.ljust(300, b'\0')
+
+    @property
+    def mac(self):
+        return ':'.join(f'{b:02x}' for b in self.chaddr[:self.hlen or 6])
+
+    @property
+    def message_type(self):
+        value = self.options.get(OPT_MESSAGE_TYPE)
+        return value[0] if value else None
+
+    @property
+    def is_pxe_client(self):
+        return self.options.get(OPT_VENDOR_CLASS, b'').startswith(b'PXEClient')
+
+    @property
+    def is_http_client(self):
+        """UEFI HTTP Boot firmware"""
+        return self.options.get(OPT_VENDOR_CLASS, b'').startswith(b'HTTPClient')
+
+    @property
+    def is_ipxe(self):
+        """Second stage: iPXE identifies itself with user class "iPXE" """
+        return self.options.get(OPT_USER_CLASS, b'') == b'iPXE'
+
+    @property
+    def client_arch(self):
+        value = self.options.get(OPT_CLIENT_ARCH)
+        return struct.unpack('!H', value[:2])[0] if value and len(value) >= 2 else 0
+
+    def option_ip(self, code):
+        value = self.options.get(code)
+        return socket.inet_ntoa(value[:4]) if value and len(value) >= 4 else None
+
+
+class Lease:
+    """A DHCP lease; offers are leases in state 'offered' with a short expiry"""
+
+    __slots__ = ('mac', 'ip', 'expires', 'hostname', 'state', 'journaled_expires')
+
+    def __init__(self, mac, ip, expires, hostname=None, state='offered'):
+        self.mac = mac
+        self.ip = ip
+        self.expires = expires
+        self.hostname = hostname
+        self.state = state
+        self.journaled_expires = 0
+
+
+class LeaseTable:
+    """
+    DHCP lease table indexed by MAC and by IP
+
+    Addresses are integers. Free addresses come from a cursor over the pool
+    that is never materialised, a queue of released addresses and a heap of
+    expiry times, so allocation and renewal are O(1) (O(log n) when an
+    expired lease has to be reclaimed). Bindings are persisted to an
+    append-only journal that is compacted on load.
+    """
+
+    def __init__(self, pool_start, pool_end, lease_time=3600, offer_time=60,
+                 path=None, excluded=()):
+        self.pool_start = int(pool_start)
+        self.pool_end = int(pool_end)
+        self.lease_time = lease_time
+        self.offer_time = offer_time
+        self.path = path
+        self.excluded = {int(ip) for ip in excluded}
+
+        self.by_mac = {}
+        self.by_ip = {}
+        self._cursor = self.pool_start
+        self._released = deque()
+        self._expiry = []
+        self._journal = None
+
+    def __len__(self):
+        return len(self.by_mac)
+
+    def in_pool(self, ip):
+        return self.pool_start <= ip <= self.pool_end and ip not in self.excluded
+
+    def lookup_mac(self, mac):
+        return self.by_mac.get(mac)
+
+    def lookup_ip(self, ip):
+        return self.by_ip.get(int(ip))
+
+    def _is_free(self, ip, now):
+        lease = self.by_ip.get(ip)
+        return lease is None or lease.expires <= now
+
+    def _remove(self, lease):
+        if self.by_mac.get(lease.mac) is lease:
+            del self.by_mac[lease.mac]
+        if self.by_ip.get(lease.ip) is lease:
+            del self.by_ip[lease.ip]
+
+    def _store(self, lease):
+        old = self.by_ip.get(lease.ip)
+        if old is not None and old is not lease:
+            self._remove(old)
+        self.by_mac[lease.mac] = lease
+        self.by_ip[lease.ip] = lease
+        heapq.heappush(self._expiry, (lease.expires, lease.ip, lease.mac))
+        if len(self._expiry) > 4 * len(self.by_ip) + 64:
+            # Renewals leave stale heap entries behind; rebuild occasionally
+            self._expiry = [(l.expires, l.ip, l.mac) for l in self.by_ip.values()]
+            heapq.heapify(self._expiry)
+
+    def _allocate(self, now):
+        while self._released:
+            ip = self._released.popleft()
+            if self.in_pool(ip) and self._is_free(ip, now):
+                return ip
+
+        while self._cursor <= self.pool_end:
+            ip = self._cursor
+            self._cursor += 1
+            if ip not in self.excluded and self._is_free(ip, now):
+                return ip
+
+        # Pool handed out once already: reclaim the oldest expired lease
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, ip, mac = heapq.heappop(self._expiry)
+            lease = self.by_ip.get(ip)
+            if lease is None or (lease.mac == mac and lease.expires == expires):
+                if lease is not None:
+                    self._remove(lease)
+                return ip
+        return None
+
+    def offer(self, mac, requested_ip=None, now=None):
+        """
+        Pick an address to offer to a client
+
+        Args:
+            mac (str): Client hardware address
+            requested_ip (int, optional): Address the client asked for
+            now (float, optional): Current time
+
+        Returns:
+            Lease: The offered (or existing) lease, or None if the pool is exhausted
+        """
+        now = now or time.time()
+        lease = self.by_mac.get(mac)
+        if lease is not None:
+            # Returning client keeps its address, even if the lease lapsed
+            if lease.expires < now + self.offer_time:
+                lease.expires = now + self.offer_time
+                self._store(lease)
+            return lease
+
+        ip = None
+        if requested_ip is not None and self.in_pool(requested_ip) and self._is_free(requested_ip, now):
+            ip = requested_ip
+        if ip is None:
+            ip = self._allocate(now)
+        if ip is None:
+            return None
+
+        lease = Lease(mac, ip, now + self.offer_time)
+        self._store(lease)
+        return lease
+
+    def bind(self, mac, ip, hostname=None, now=None):
+        """
+        Bind (or renew) a lease after a DHCPREQUEST
+
+        Args:
+            mac (str): Client hardware address
+            ip (int): Address the client requested
+            hostname (str, optional): Client hostname
+            now (float, optional): Current time
+
+        Returns:
+            Lease: The bound lease, or None if the address is not available
+        """
+        now = now or time.time()
+        if not self.in_pool(ip):
+            return None
+
+        holder = self.by_ip.get(ip)
+        if holder is not None and holder.mac != mac and holder.expires > now:
+            return None
+
+        lease = self.by_mac.get(mac)
+        if lease is None or lease.ip != ip:
+            if lease is not None:
+                # The client moved to another address; its old one is free again
+                self._remove(lease)
+                self._released.append(lease.ip)
+            lease = Lease(mac, ip, 0)
+
+        lease.expires = now + self.lease_time
+        lease.state = 'bound'
+        if hostname:
+            lease.hostname = hostname
+        self._store(lease)
+
+        if lease.expires - lease.journaled_expires > self.lease_time * JOURNAL_SLACK:
+            self._append({'op': 'bind', 'mac': mac, 'ip': str(ipaddress.IPv4Address(ip)),
+                          'expires': int(lease.expires), 'hostname': lease.hostname})
+            lease.journaled_expires = lease.expires
+        return lease
+
+    def release(self, mac, ip=None):
+        """Return a client's address to the pool"""
+        lease = self.by_mac.get(mac)
+        if lease is None or (ip is not None and lease.ip != ip):
+            return
+        self._remove(lease)
+        self._released.append(lease.ip)
+        if lease.state == 'bound':
+            self._append({'op': 'release', 'mac': mac})
+
+    def decline(self, mac, ip, now=None):
+        """Quarantine an address a client found to be in use"""
+        now = now or time.time()
+        lease = self.by_mac.get(mac)
+        if lease is not None and lease.ip == ip:
+            self._remove(lease)
+        self._store(Lease(f'declined:{ip}', ip, now + self.lease_time, state='declined'))
+
+    def expire_offer(self, mac):
+        """Drop an outstanding offer the client did not take"""
+        lease = self.by_mac.get(mac)
+        if lease is not None and lease.state == 'offered':
+            self._remove(lease)
+            self._released.append(lease.ip)
+
+    def _append(self, record):
+        if not self.path:
+            return
+        try:
+            if self._journal is None:
+                self._journal = open(self.path, 'a')
+            self._journal.write(json.dumps(record) + '\n')
+            self._journal.flush()
+        except OSError as e:
+            logger.error(f"Failed to write DHCP lease journal {self.path}: {e}")
+
+    def load(self, now=None):
+        """Replay the lease journal and rewrite it with only the live leases"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        now = now or time.time()
+
+        leases = {}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn write at the end of the journal
+                if record.get('op') == 'bind':
+                    leases[record['mac']] = record
+                elif record.get('op') == 'release':
+                    leases.pop(record.get('mac'), None)
+
+        for record in leases.values():
+            ip = int(ipaddress.IPv4Address(record['ip']))
+            if record['expires'] <= now or not self.in_pool(ip):
+                continue
+            lease = Lease(record['mac'], ip, record['expires'], record.get('hostname'), 'bound')
+            lease.journaled_expires = lease.expires
+            self._store(lease)
+
+        self.compact()
+        logger.info(f"Loaded {len(self.by_mac)} DHCP leases from {self.path}")
+
+    def compact(self):
+        """Rewrite the journal as one record per bound lease"""
+        if not self.path:
+            return
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for lease in self.by_mac.values():
+                if lease.state == 'bound':
+                    f.write(json.dumps({'op': 'bind', 'mac': lease.mac,
+                                        'ip': str(ipaddress.IPv4Address(lease.ip)),
+                                        'expires': int(lease.expires),
+                                        'hostname': lease.hostname}) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class DHCPServer:
+    """
+    DHCP and ProxyDHCP responder for PXE boot
+
+    In 'server' mode it hands out addresses from the lease table and adds
+    the boot server and file for PXE clients. In 'proxy' mode another DHCP
+    server owns addressing, and PXE clients only get boot information, both
+    on port 67 and on the PXE boot server port 4011.
+    """
+
+    def __init__(self, server_ip, subnet='192.168.1.0/24', gateway='192.168.1.1',
+                 dns_server='8.8.8.8', mode='server', interface=None, host='0.0.0.0',
+                 port=67, proxy_port=4011, client_port=68, broadcast_address='255.255.255.255',
+                 lease_time=3600, pool_offset=10, pool_size=40, lease_file=None,
+                 boot_files=None, boot_file_selector=None):
+        self.server_ip = server_ip
+        self.network = ipaddress.ip_network(subnet, strict=False)
+        self.gateway = gateway
+        self.dns_server = dns_server
+        self.mode = mode
+        self.interface = interface
+        self.host = host
+        self.port = port
+        self.proxy_port = proxy_port
+        self.client_port = client_port
+        self.broadcast_address = broadcast_address
+        self.lease_time = lease_time
+        self.boot_files = boot_files or {'bios': 'pxelinux.0', 'efi': 'bootx64.efi'}
+        self.boot_file_selector = boot_file_selector
+
+        pool_start = int(self.network.network_address) + pool_offset + 1
+        pool_end = min(pool_start + pool_size - 1, int(self.network.broadcast_address) - 1)
+        excluded = [ipaddress.IPv4Address(a) for a in (server_ip, gateway) if a]
+        self.leases = LeaseTable(pool_start, pool_end, lease_time=lease_time,
+                                 path=lease_file, excluded=excluded)
+
+        self.loop = None
+        self.sock = None
+        self.proxy_sock = None
+        self._stop_event = None
+        self._stop_requested = False
+        self.stats = {
+            'discovers': 0,
+            'offers': 0,
+            'requests': 0,
+            'acks': 0,
+            'naks': 0,
+            'releases': 0,
+            'declines': 0,
+            'proxy_offers': 0,
+        }
+
+    def _open_socket(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if self.interface and hasattr(socket, 'SO_BINDTODEVICE'):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.interface.encode())
+            except OSError as e:
+                logger.debug(f"Cannot bind DHCP socket to {self.interface}: {e}")
+        sock.setblocking(False)
+        sock.bind((self.host, port))
+        return sock
+
+    async def start(self):
+        """Bind the DHCP sockets on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        if self.mode == 'server':
+            self.leases.load()
+
+        self.sock = self._open_socket(self.port)
+        self.port = self.sock.getsockname()[1]
+        self.loop.add_reader(self.sock.fileno(), self._on_readable, self.sock)
+
+        if self.proxy_port is not None:
+            self.proxy_sock = self._open_socket(self.proxy_port)
+            self.proxy_port = self.proxy_sock.getsockname()[1]
+            self.loop.add_reader(self.proxy_sock.fileno(), self._on_readable, self.proxy_sock)
+
+        logger.info(f"DHCP server started on port {self.port} in {self.mode} mode")
+
+    def close(self):
+        """Close the sockets and the lease journal"""
+        for sock in (self.sock, self.proxy_sock):
+            if sock is not None:
+                self.loop.remove_reader(sock.fileno())
+                sock.close()
+        self.sock = None
+        self.proxy_sock = None
+        self.leases.close()
+        logger.info("DHCP server stopped")
+
+    def serve_forever(self):
+        """Run the server on a new event loop until stop() is called"""
+        async def _serve():
+            self._stop_event = asyncio.Event()
+            await self.start()
+            try:
+                if not self._stop_requested:
+                    await self._stop_event.wait()
+            finally:
+                self.close()
+
+        asyncio.run(_serve())
+
+    def stop(self):
+        """Stop a server running in serve_forever() from another thread"""
+        self._stop_requested = True
+        if self.loop and self._stop_event and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+
+    def _on_readable(self, sock):
+        while True:
+            try:
+                data, addr = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"DHCP server error: {e}")
+                return
+            try:
+                packet = DHCPPacket.from_bytes(data)
+            except (ValueError, struct.error):
+                continue
+            if packet.op != BOOTREQUEST:
+                continue
+            try:
+                self._handle(packet, addr, sock is self.proxy_sock)
+            except Exception as e:
+                logger.error(f"Error handling DHCP packet from {packet.mac}: {e}")
+
+    def _handle(self, packet, addr, on_proxy_port):
+        msg_type = packet.message_type
+        if on_proxy_port:
+            # PXE boot server discovery on port 4011 is answered directly
+            if msg_type in (DHCPREQUEST, DHCPINFORM) and (packet.is_pxe_client or packet.is_http_client):
+                # PXE clients only accept the reply from the port they sent to
+                self._send(self._proxy_reply(packet, DHCPACK), addr, self.proxy_sock)
+            return
+
+        if self.mode == 'proxy':
+            if msg_type == DHCPDISCOVER and (packet.is_pxe_client or packet.is_http_client):
+                self.stats['proxy_offers'] += 1
+                self._send(self._proxy_reply(packet, DHCPOFFER), self._destination(packet))
+            return
+
+        if msg_type == DHCPDISCOVER:
+            self._handle_discover(packet)
+        elif msg_type == DHCPREQUEST:
+            self._handle_request(packet)
+        elif msg_type == DHCPRELEASE:
+            self.stats['releases'] += 1
+            self.leases.release(packet.mac, int(ipaddress.IPv4Address(packet.ciaddr)))
+        elif msg_type == DHCPDECLINE:
+            self.stats['declines'] += 1
+            requested = packet.option_ip(OPT_REQUESTED_IP)
+            if requested:
+                logger.warning(f"Client {packet.mac} declined {requested}, address quarantined")
+                self.leases.decline(packet.mac, int(ipaddress.IPv4Address(requested)))
+        elif msg_type == DHCPINFORM:
+            reply = self._reply(packet, DHCPACK, packet.ciaddr, include_lease=False)
+            self._send(reply, (packet.ciaddr, self.client_port))
+
+    def _handle_discover(self, packet):
+        self.stats['discovers'] += 1
+        requested = packet.option_ip(OPT_REQUESTED_IP)
+        requested_ip = int(ipaddress.IPv4Address(requested)) if requested else None
+
+        lease = self.leases.offer(packet.mac, requested_ip)
+        if lease is None:
+            logger.warning(f"DHCP pool exhausted, no offer for {packet.mac}")
+            return
+
+        self.stats['offers'] += 1
+        reply = self._reply(packet, DHCPOFFER, str(ipaddress.IPv4Address(lease.ip)))
+        self._send(reply, self._destination(packet))
+
+    def _handle_request(self, packet):
+        self.stats['requests'] += 1
+        server_id = packet.option_ip(OPT_SERVER_ID)
+        if server_id and server_id != self.server_ip:
+            # The client chose another server's offer
+            self.leases.expire_offer(packet.mac)
+            return
+
+        requested = packet.option_ip(OPT_REQUESTED_IP)
+        if not requested and packet.ciaddr != '0.0.0.0':
+            requested = packet.ciaddr  # renewing or rebinding
+        if not requested:
+            return
+
+        ip = int(ipaddress.IPv4Address(requested))
+        hostname = packet.options.get(OPT_HOSTNAME, b'').decode('ascii', errors='replace') or None
+        lease = self.leases.bind(packet.mac, ip, hostname)
+
+        if lease is None:
+            if server_id or ipaddress.IPv4Address(requested) in self.network:
+                self.stats['naks'] += 1
+                nak = self._reply(packet, DHCPNAK, '0.0.0.0', include_lease=False)
+                nak.options = {OPT_MESSAGE_TYPE: bytes([DHCPNAK]),
+                               OPT_SERVER_ID: socket.inet_aton(self.server_ip)}
+                self._send(nak, self._destination(packet, force_broadcast=True))
+            return
+
+        self.stats['acks'] += 1
+        reply = self._reply(packet, DHCPACK, requested)
+        self._send(reply, self._destination(packet))
+
+    def _boot_file(self, packet):
+        arch = packet.client_arch
+        if self.boot_file_selector:
+            boot_file = self.boot_file_selector(packet.mac, arch, packet)
+            if boot_file:
+                return boot_file
+        return self.boot_files['efi' if arch in EFI_ARCHITECTURES else 'bios']
+
+    def _reply(self, packet, msg_type, yiaddr, include_lease=True):
+        reply = DHCPPacket()
+        reply.op = BOOTREPLY
+        reply.htype = packet.htype
+        reply.hlen = packet.hlen
+        reply.xid = packet.xid
+        reply.flags = packet.flags
+        reply.ciaddr = packet.ciaddr
+        reply.yiaddr = yiaddr
+        reply.siaddr = self.server_ip
+        reply.giaddr = packet.giaddr
+        reply.chaddr = packet.chaddr
+
+        options = {
+            OPT_MESSAGE_TYPE: bytes([msg_type]),
+            OPT_SERVER_ID: socket.inet_aton(self.server_ip),
+            OPT_SUBNET_MASK: socket.inet_aton(str(self.network.netmask)),
+        }
+        if self.gateway:
+            options[OPT_ROUTER] = socket.inet_aton(self.gateway)
+        if self.dns_server:
+            options[OPT_DNS] = socket.inet_aton(self.dns_server)
+        if include_lease:
+            options[OPT_LEASE_TIME] = struct.pack('!I', self.lease_time)
+            options[OPT_RENEWAL_TIME] = struct.pack('!I', self.lease_time // 2)
+            options[OPT_REBINDING_TIME] = struct.pack('!I', self.lease_time * 7 // 8)
+        if packet.is_pxe_client or packet.is_http_client:
+            boot_file = self._boot_file(packet)
+            reply.file = boot_file.encode('ascii')
+            # HTTP Boot firmware ignores offers that do not echo its vendor class
+            options[OPT_VENDOR_CLASS] = b'HTTPClient' if packet.is_http_client else b'PXEClient'
+            options[OPT_TFTP_SERVER] = self.server_ip.encode('ascii')
+            options[OPT_BOOTFILE] = boot_file.encode('ascii')
+            if OPT_CLIENT_UUID in packet.options:
+                options[OPT_CLIENT_UUID] = packet.options[OPT_CLIENT_UUID]
+        reply.options = options
+        return reply
+
+    def _proxy_reply(self, packet, msg_type):
+        """Boot-information-only reply for ProxyDHCP (PXE spec 2.1)"""
+        reply = self._reply(packet, msg_type, '0.0.0.0', include_lease=False)
+        for code in (OPT_SUBNET_MASK, OPT_ROUTER, OPT_DNS):
+            reply.options.pop(code, None)
+        # PXE_DISCOVERY_CONTROL: boot from the file in this reply, skip discovery
+        reply.options[OPT_VENDOR_SPECIFIC] = bytes((6, 1, 0x08, OPT_END))
+        return reply
+
+    def _destination(self, packet, force_broadcast=False):
+        """Where to send a reply, per RFC 2131 section 4.1"""
+        if packet.giaddr != '0.0.0.0':
+            return (packet.giaddr, self.port)
+        if not force_broadcast and packet.ciaddr != '0.0.0.0':
+            return (packet.ciaddr, self.client_port)
+        return (self.broadcast_address, self.client_port)
+
+    def _send(self, reply, addr, sock=None):
+        try:
+            (sock or self.sock).sendto(reply.to_bytes(), addr)
+        except OSError as e:
+            logger.error(f"Failed to send DHCP reply to {addr}: {e}")
+
+    def status(self):
+        """Return DHCP counters for the status page"""
+        status = dict(self.stats)
+        status['mode'] = self.mode
+        status['leases'] = len(self.leases)
+        return status
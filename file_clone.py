@@ -0,0 +1,271 @@
+import os
+import json
+import errno
+import shutil
+import logging
+from contextlib import nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# _IOW(0x94, 9, int): share the source's extents with the target (XFS, Btrfs, OCFS2)
+FICLONE = 0x40049409
+COPY_CHUNK = 8 * 1024 * 1024
+ZERO_CHUNK = bytes(COPY_CHUNK)
+# How much an interrupted copy can lose: progress is made durable this often
+CHECKPOINT_BYTES = 256 * 1024 * 1024
+
+# Strategies, fastest first
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_COPY_FILE_RANGE = 'copy_file_range'
+STRATEGY_SPARSE = 'sparse'
+STRATEGY_COPY = 'copy'
+
+# errno values meaning "not possible here", as opposed to real I/O errors
+_UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS,
+                errno.EBADF, errno.EPERM, errno.ETXTBSY}
+
+
+def data_segments(fd, size):
+    """
+    Yield (offset, length) for every data region of a file, skipping holes
+
+    Falls back to a single segment covering the file when the filesystem
+    does not support SEEK_DATA/SEEK_HOLE.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return  # only a hole is left
+            if offset == 0 and e.errno in _UNSUPPORTED:
+                yield 0, size
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def _reflink(src, dst, size, start, report, throttle):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        report(size)
+        return True
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+
+
+def _remaining_segments(src, size, start):
+    """Data segments from an offset on, for resuming an interrupted copy"""
+    for offset, length in data_segments(src, size):
+        if offset + length <= start:
+            continue
+        if offset < start:
+            offset, length = start, offset + length - start
+        yield offset, length
+
+
+def _copy_file_range(src, dst, size, start, report, throttle):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    # A throttled copy moves smaller steps so the pacing stays smooth
+    step = COPY_CHUNK if throttle else COPY_CHUNK * 8
+    for offset, length in _remaining_segments(src, size, start):
+        done = 0
+        while done < length:
+            position = offset + done
+            resident = throttle.before_read(src, position, min(length - done, step)) if throttle else None
+            try:
+                copied = os.copy_file_range(src, dst, min(length - done, step), position, position)
+            except OSError as e:
+                # The fallback restarts from start, so this is safe until a segment is under way
+                if e.errno in _UNSUPPORTED and done == 0:
+                    return False
+                raise
+            if copied == 0:
+                break  # source shrank underneath us
+            if throttle:
+                throttle.copied(src, dst, position, copied, resident)
+            done += copied
+            report(offset + done)
+    report(size)
+    return True
+
+
+def _sparse_copy(src, dst, size, start, report, throttle):
+    """Copy data regions through userspace, leaving zero-filled chunks as holes"""
+    for offset, length in _remaining_segments(src, size, start):
+        done = 0
+        while done < length:
+            position = offset + done
+            resident = throttle.before_read(src, position, min(COPY_CHUNK, length - done)) if throttle else None
+            chunk = os.pread(src, min(COPY_CHUNK, length - done), position)
+            if not chunk:
+                break
+            written = chunk != ZERO_CHUNK[:len(chunk)]
+            if written:
+                os.pwrite(dst, chunk, position)
+            if throttle:
+                throttle.copied(src, dst if written else None, position, len(chunk), resident)
+            done += len(chunk)
+            report(offset + done)
+    report(size)
+    return True
+
+
+class _Checkpoint:
+    """
+    Durable progress of a copy into a temporary file
+
+    Kept next to the temporary file as <tmp>.checkpoint. Every
+    CHECKPOINT_BYTES the copied data is synced and the offset recorded, so a
+    copy interrupted by a crash or restart continues from there, provided
+    the source has not changed in between.
+    """
+
+    def __init__(self, tmp_path, source_stat, progress):
+        self.path = f"{tmp_path}.checkpoint"
+        self.source = [source_stat.st_ino, source_stat.st_size, source_stat.st_mtime_ns]
+        self.progress = progress
+        self.strategy = None
+        self.dst = None
+        self.saved = 0
+
+    def load(self, tmp_path):
+        """Return (strategy, offset) to resume from, or (None, 0)"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None, 0
+        if state.get('source') != self.source or not os.path.exists(tmp_path):
+            return None, 0
+        self.saved = state['offset']
+        return state['strategy'], state['offset']
+
+    def report(self, offset):
+        if self.progress:
+            self.progress(offset, self.source[1])
+        if self.strategy in (STRATEGY_COPY_FILE_RANGE, STRATEGY_SPARSE) and offset - self.saved >= CHECKPOINT_BYTES:
+            os.fdatasync(self.dst)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'source': self.source, 'strategy': self.strategy, 'offset': offset}, f)
+            os.replace(tmp, self.path)
+            self.saved = offset
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def clone_file(source_path, target_path, strategies=None, progress=None, throttle=None):
+    """
+    Copy a file as cheaply as the filesystem allows
+
+    Tries, in order: a reflink (FICLONE), which shares extents and takes
+    constant time; copy_file_range over the data regions only, which keeps
+    the copy in the kernel and preserves holes; and a userspace copy that
+    skips holes and zero-filled chunks. The target is written to a
+    temporary file and renamed into place, and keeps the source's
+    permissions and timestamps like shutil.copy2. A copy interrupted by a
+    crash resumes from its last checkpoint when called again.
+
+    Args:
+        source_path (str): File to copy
+        target_path (str): Destination path
+        strategies (list, optional): Restrict the strategies to try
+        progress (callable, optional): Called with (bytes done, total bytes);
+            an exception it raises aborts the copy
+        throttle (CopyThrottle, optional): Pace the copy and keep it out of
+            the page cache
+
+    Returns:
+        str: The strategy that produced the copy
+    """
+    strategies = strategies or [STRATEGY_REFLINK, STRATEGY_COPY_FILE_RANGE, STRATEGY_SPARSE]
+    attempts = {
+        STRATEGY_REFLINK: _reflink,
+        STRATEGY_COPY_FILE_RANGE: _copy_file_range,
+        STRATEGY_SPARSE: _sparse_copy,
+    }
+
+    tmp_path = f"{target_path}.clone.tmp"
+    src = os.open(source_path, os.O_RDONLY)
+    checkpoint = None
+    try:
+        source_stat = os.fstat(src)
+        size = source_stat.st_size
+        checkpoint = _Checkpoint(tmp_path, source_stat, progress)
+        resume_strategy, start = checkpoint.load(tmp_path)
+        if resume_strategy in strategies:
+            strategies = [resume_strategy] + [s for s in strategies if s != resume_strategy]
+            dst = os.open(tmp_path, os.O_WRONLY)
+            logger.info(f"Resuming copy of {source_path} at {start / (1024**2):.0f} MB")
+        else:
+            start = 0
+            dst = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        checkpoint.dst = dst
+        try:
+            used = None
+            if throttle:
+                throttle.open_source(src)
+            with throttle.priority() if throttle else nullcontext():
+                for strategy in strategies:
+                    checkpoint.strategy = strategy
+                    if attempts[strategy](src, dst, size, start, checkpoint.report, throttle):
+                        used = strategy
+                        break
+                    # A failed attempt may have left partial data behind
+                    os.ftruncate(dst, 0)
+                    start = 0
+            if used is None:
+                os.close(dst)
+                dst = None
+                shutil.copyfile(source_path, tmp_path)
+                used = STRATEGY_COPY
+                if progress:
+                    progress(size, size)
+            else:
+                # Trailing holes are not written; restore the full length
+                os.ftruncate(dst, size)
+                os.fsync(dst)
+                if throttle:
+                    throttle.finish(dst)
+        finally:
+            if dst is not None:
+                if throttle:
+                    throttle.forget(dst)
+                os.close(dst)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if checkpoint:
+            checkpoint.remove()
+        raise
+    finally:
+        if throttle:
+            throttle.forget(src)
+        os.close(src)
+
+    shutil.copystat(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+    checkpoint.remove()
+    logger.debug(f"Cloned {source_path} to {target_path} using {used}")
+    return used
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from file_clone import data_segments
+from block_tracking import ChangeTracker, image_identity
+
+logger = logging.getLogger(__name__)
+
+INTEGRITY_BLOCK_SIZE = 1024 * 1024
+INTEGRITY_SUFFIX = '.hashes'
+ALGORITHM = 'sha256'
+DIGEST_SIZE = hashlib.new(ALGORITHM).digest_size
+# hashlib and os.pread drop the GIL for buffers this large, so threads scale
+DEFAULT_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+STATE_UNVERIFIED = 'unverified'
+STATE_VERIFIED = 'verified'
+STATE_STALE = 'stale'
+STATE_CORRUPT = 'corrupt'
+
+
+def hash_blocks(path, blocks, block_size=INTEGRITY_BLOCK_SIZE, workers=None):
+    """
+    Hash blocks of a file in parallel
+
+    Blocks that lie entirely in a hole are never read. At most a few blocks
+    per worker are in memory at once, so any number of blocks can be hashed.
+
+    Args:
+        path (str): File to read
+        blocks (list): Block indices to hash, in any order
+        block_size (int): Size of a block in bytes
+        workers (int, optional): Number of reader threads
+
+    Yields:
+        tuple: (block, digest) in the order of blocks
+    """
+    workers = workers or DEFAULT_WORKERS
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        data_blocks = set()
+        for offset, length in data_segments(fd, size):
+            data_blocks.update(range(offset // block_size, (offset + length - 1) // block_size + 1))
+        zero_digests = {}
+
+        def digest(block):
+            length = max(0, min(block_size, size - block * block_size))
+            if block not in data_blocks:
+                if length not in zero_digests:
+                    zero_digests[length] = hashlib.new(ALGORITHM, bytes(length)).digest()
+                return zero_digests[length]
+            return hashlib.new(ALGORITHM, os.pread(fd, length, block * block_size)).digest()
+
+        window = workers * 4
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(blocks), window):
+                batch = blocks[start:start + window]
+                yield from zip(batch, pool.map(digest, batch))
+    finally:
+        os.close(fd)
+
+
+class IntegrityManifest:
+    """
+    Per-block hashes of a disk image, used to detect silent corruption
+
+    Kept in a sidecar file next to the image:
+
+        <image>.hashes  one JSON line, then one digest per block
+
+    The manifest remembers the change tracker's epoch and generation at the
+    time it was last brought up to date. As long as the tracker has seen
+    every write since then, verifying only rehashes the blocks written in
+    later generations; anything else falls back to hashing the whole image.
+    """
+
+    def __init__(self, image_path, block_size=INTEGRITY_BLOCK_SIZE):
+        self.image_path = image_path
+        self.path = f"{image_path}{INTEGRITY_SUFFIX}"
+        self.block_size = block_size
+        self.header = None
+        self.digests = bytearray()
+
+    @classmethod
+    def load(cls, image_path, header_only=False):
+        """
+        Read an image's manifest
+
+        Args:
+            image_path (str): Path to the image
+            header_only (bool): Skip the digests, which is enough for status()
+
+        Returns:
+            IntegrityManifest: The manifest; header is None if there is none
+        """
+        manifest = cls(image_path)
+        try:
+            with open(manifest.path, 'rb') as f:
+                header = json.loads(f.readline())
+                if not header_only:
+                    manifest.digests = bytearray(f.read())
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable integrity manifest {manifest.path}: {e}")
+            return cls(image_path)
+        manifest.header = header
+        manifest.block_size = header['block_size']
+        return manifest
+
+    def _block_count(self, size):
+        return (size + self.block_size - 1) // self.block_size
+
+    def _digest(self, block):
+        return bytes(self.digests[block * DIGEST_SIZE:(block + 1) * DIGEST_SIZE])
+
+    def _set_digest(self, block, digest):
+        end = (block + 1) * DIGEST_SIZE
+        if len(self.digests) < end:
+            self.digests.extend(bytes(end - len(self.digests)))
+        self.digests[block * DIGEST_SIZE:end] = digest
+
+    def _tracker(self):
+        """The image's change tracker, starting a new epoch if writes were missed"""
+        tracker = ChangeTracker.load(self.image_path)
+        if not tracker.continuous:
+            tracker.save()
+        return tracker
+
+    def build(self, workers=None, progress=None):
+        """
+        Hash every block of the image and accept the result as correct
+
+        Args:
+            workers (int, optional): Number of reader threads
+            progress (callable, optional): Called with (bytes hashed, total bytes)
+
+        Returns:
+            dict: The new status
+        """
+        start = time.time()
+        tracker = self._tracker()
+        identity = image_identity(self.image_path)
+        blocks = list(range(self._block_count(identity[1])))
+        self.digests = bytearray()
+        for done, (block, digest) in enumerate(hash_blocks(self.image_path, blocks, self.block_size, workers), 1):
+            self._set_digest(block, digest)
+            if progress:
+                progress(done * self.block_size, len(blocks) * self.block_size)
+        self._save(tracker, identity, STATE_VERIFIED, [])
+        logger.info(f"Hashed {len(blocks)} blocks of {self.image_path} in {time.time() - start:.2f}s")
+        return self.status()
+
+    def verify(self, full=False, workers=None, progress=None):
+        """
+        Check the image against the manifest
+
+        When the change tracker covers every write since the manifest was
+        last updated, only the blocks written since then are rehashed and
+        their new hashes accepted. With full=True, or when writes were
+        missed, every block is rehashed; a mismatch in a block the tracker
+        did not see written marks the image corrupt.
+
+        Args:
+            full (bool): Rehash every block even if tracking is continuous
+            workers (int, optional): Number of reader threads
+            progress (callable, optional): Called with (bytes hashed, total bytes)
+
+        Returns:
+            dict: The new status
+        """
+        if self.header is None:
+            return self.build(workers, progress)
+
+        start = time.time()
+        identity = image_identity(self.image_path)
+        if identity == self.header['identity'] and not full:
+            return self.status()
+
+        tracker = ChangeTracker.load(self.image_path)
+        tracked = (tracker.continuous and tracker.epoch is not None
+                   and tracker.epoch == self.header['epoch'])
+        old_blocks = self._block_count(self.header['identity'][1])
+        new_blocks = self._block_count(identity[1])
+        # Blocks whose content legitimately changed since the last update
+        written = set()
+        if tracked:
+            written.update(tracker.blocks_written_since(self.header['generation']))
+        if new_blocks != old_blocks and old_blocks:
+            written.add(old_blocks - 1)  # a partial last block changes length
+        written.update(range(old_blocks, new_blocks))
+        written = {block for block in written if block < new_blocks}
+
+        if tracked and not full:
+            blocks = sorted(written)
+        else:
+            blocks = list(range(new_blocks))
+        bad = {block for block in self.header['bad_blocks'] if block < new_blocks and block not in written}
+        for done, (block, digest) in enumerate(hash_blocks(self.image_path, blocks, self.block_size, workers), 1):
+            if progress:
+                progress(done * self.block_size, len(blocks) * self.block_size)
+            if block in written:
+                self._set_digest(block, digest)
+                continue
+            if digest != self._digest(block):
+                bad.add(block)
+            else:
+                bad.discard(block)
+        del self.digests[new_blocks * DIGEST_SIZE:]
+
+        if image_identity(self.image_path) != identity:
+            # Written while we were reading; the result describes no real state
+            logger.warning(f"{self.image_path} changed during verification, try again")
+            return self.status()
+
+        tracker = self._tracker()
+        self._save(tracker, identity, STATE_CORRUPT if bad else STATE_VERIFIED, sorted(bad))
+        if bad:
+            logger.error(f"{self.image_path} failed verification in {len(bad)} blocks")
+        logger.info(f"Verified {len(blocks)} of {new_blocks} blocks of {self.image_path} "
+                    f"in {time.time() - start:.2f}s")
+        return self.status()
+
+    def _save(self, tracker, identity, state, bad_blocks):
+        self.header = {
+            'block_size': self.block_size,
+            'algorithm': ALGORITHM,
+            'identity': identity,
+            'epoch': tracker.epoch,
+            'generation': tracker.generation,
+            'state': state,
+            'bad_blocks': bad_blocks,
+            'verified_at': time.time(),
+        }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(self.header).encode('utf-8') + b'\n')
+            f.write(self.digests)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def status(self):
+        """
+        Verification state from the manifest header, without reading the image
+
+        Returns:
+            dict: 'state' (unverified, verified, stale or corrupt),
+                'verified_at', 'bad_blocks' and 'block_size'
+        """
+        if self.header is None:
+            return {'state': STATE_UNVERIFIED, 'verified_at': None, 'bad_blocks': [],
+                    'block_size': self.block_size}
+        state = self.header['state']
+        if state == STATE_VERIFIED and image_identity(self.image_path) != self.header['identity']:
+            state = STATE_STALE
+        return {
+            'state': state,
+            'verified_at': self.header['verified_at'],
+            'bad_blocks': self.header['bad_blocks'],
+            'block_size': self.block_size,
+        }
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def integrity_status(image_path):
+    """Verification state of an image; only the manifest header is read"""
+    return IntegrityManifest.load(image_path, header_only=True).status()
@@ -0,0 +1,468 @@
+import os
+import time
+import tempfile
+import ctypes
+import logging
+import platform
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from bandwidth import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# How far the copy rate can run ahead of the limit, as time at that rate
+BURST_SECONDS = 0.25
+# Rate changes at most this often, based on boot reads seen over a few intervals
+ADAPT_INTERVAL = 0.5
+LATENCY_WINDOW = 4 * ADAPT_INTERVAL
+MIN_RATE = 1 * MB
+# Written data is synced and dropped from the page cache in steps of this size
+WRITEBACK_BYTES = 64 * MB
+
+# ioprio_set(2); not wrapped by the os module
+_IOPRIO_SYSCALLS = {'x86_64': (251, 252), 'aarch64': (30, 31), 'i686': (289, 290), 'armv7l': (314, 315)}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+# Lowest best-effort level: yields to boot reads but is never starved like IDLE
+LOW_IOPRIO = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | 7
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.mmap.restype = ctypes.c_void_p
+        _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                               ctypes.c_int, ctypes.c_long]
+        _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    return _libc
+
+
+def resident_pages(fd, offset, length):
+    """
+    Which pages of a file range are in the page cache (mincore)
+
+    Args:
+        fd (int): Open file
+        offset (int): Start of the range, rounded down to a page
+        length (int): Length of the range
+
+    Returns:
+        bytes: One byte per page, non-zero if resident; None if unsupported
+    """
+    if platform.system() != 'Linux' or length <= 0:
+        return None
+    start = offset - offset % _PAGE_SIZE
+    size = offset + length - start
+    try:
+        libc = _get_libc()
+        address = libc.mmap(None, size, 1, 1, fd, start)  # PROT_READ, MAP_SHARED
+        if address in (None, ctypes.c_void_p(-1).value):
+            return None
+        try:
+            pages = (size + _PAGE_SIZE - 1) // _PAGE_SIZE
+            vec = (ctypes.c_ubyte * pages)()
+            if libc.mincore(address, size, vec) != 0:
+                return None
+            return bytes(b & 1 for b in vec)
+        finally:
+            libc.munmap(address, size)
+    except (OSError, AttributeError):
+        return None
+
+
+def _drop_pages(fd, offset, length, resident):
+    """Drop the pages of a range that were not cached before it was read"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    if resident is None:
+        return  # unknown: leave the cache alone rather than evict hot blocks
+    start = offset - offset % _PAGE_SIZE
+    page = 0
+    while page < len(resident):
+        if resident[page]:
+            page += 1
+            continue
+        run = page
+        while page < len(resident) and not resident[page]:
+            page += 1
+        os.posix_fadvise(fd, start + run * _PAGE_SIZE, (page - run) * _PAGE_SIZE, os.POSIX_FADV_DONTNEED)
+
+
+def set_io_priority(value):
+    """
+    Set the I/O priority of the calling thread
+
+    Only has an effect with an I/O scheduler that honours priorities (BFQ,
+    and mq-deadline for the class).
+
+    Returns:
+        int: The previous priority, or None if it could not be changed
+    """
+    calls = _IOPRIO_SYSCALLS.get(platform.machine())
+    if platform.system() != 'Linux' or not calls:
+        return None
+    try:
+        libc = _get_libc()
+        previous = libc.syscall(calls[1], IOPRIO_WHO_PROCESS, 0)
+        if previous < 0 or libc.syscall(calls[0], IOPRIO_WHO_PROCESS, 0, value) != 0:
+            return None
+        return previous
+    except (OSError, AttributeError):
+        return None
+
+
+def touch_pages(view):
+    """
+    Fault in every page of a view of a mapped file
+
+    A slice of an mmap costs nothing until it is sent, so the disk read
+    would happen outside any timing around it; reading one byte per page
+    moves it here.
+
+    Returns:
+        The view, unchanged
+    """
+    if isinstance(view, memoryview) and len(view):
+        bytes(view[::_PAGE_SIZE])
+        view[-1]
+    return view
+
+
+class LatencyMonitor:
+    """
+    Recent read latencies of the boot-serving path
+
+    The boot servers may run in a different worker process than the
+    copies that back off from them, so the process that records samples
+    also publishes its 95th percentile to a small file every
+    ADAPT_INTERVAL, and percentile() takes the worse of the local and the
+    published value.
+    """
+
+    def __init__(self, max_samples=4096, path=None):
+        """
+        Args:
+            max_samples (int): Most samples kept
+            path (str, optional): File shared with other processes; None
+                to keep the samples local (see share())
+        """
+        self.path = path
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self._published_at = 0.0
+
+    def share(self, path):
+        """Publish to and read from path, in a directory only this server writes"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+
+    def record(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, seconds))
+            publish = self.path and now - self._published_at >= ADAPT_INTERVAL
+            if publish:
+                self._published_at = now
+        if publish:
+            self._publish()
+
+    @contextmanager
+    def timed(self):
+        """Record how long the block takes"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(time.monotonic() - started)
+
+    def timed_chunks(self, chunks):
+        """Yield from an iterable, recording how long each chunk takes to produce"""
+        iterator = iter(chunks)
+        try:
+            while True:
+                started = time.monotonic()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                self.record(time.monotonic() - started)
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+    def _local_percentile(self, pct, window):
+        since = time.monotonic() - window
+        with self._lock:
+            recent = sorted(seconds for at, seconds in self._samples if at >= since)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, len(recent) * pct // 100)]
+
+    def _publish(self):
+        latency = self._local_percentile(95, LATENCY_WINDOW)
+        if latency is None:
+            return
+        temp = None
+        try:
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.boot-latency-')
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{time.time()} {latency}")
+            os.replace(temp, self.path)
+        except OSError as e:
+            logger.debug(f"Could not publish boot latency: {e}")
+            if temp:
+                try:
+                    os.unlink(temp)
+                except OSError:
+                    pass
+
+    def _published(self, window):
+        try:
+            with open(self.path) as f:
+                at, latency = (float(value) for value in f.read().split())
+        except (OSError, ValueError):
+            return None
+        if time.time() - at > window:
+            return None
+        return latency
+
+    def percentile(self, pct=95, window=LATENCY_WINDOW):
+        """
+        Latency percentile over the last window seconds
+
+        Returns:
+            float: Seconds, or None if nothing was read in the window
+        """
+        latency = self._local_percentile(pct, window)
+        published = self._published(window) if self.path and pct == 95 else None
+        if published is None:
+            return latency
+        return published if latency is None else max(latency, published)
+
+
+# Fed by the NBD, TFTP and HTTP boot paths; read by every CopyThrottle
+boot_latency = LatencyMonitor()
+
+
+class CopyThrottle:
+    """
+    Pacing for bulk image I/O that shares a disk with booting clients
+
+    Copies report every chunk they move. The throttle then:
+
+    - sleeps to keep the aggregate rate of all copies under the limit
+    - halves the rate whenever the 95th percentile of boot read latency
+      exceeds the target, and raises it again step by step while boot reads
+      are fast (AIMD)
+    - drops pages the copy pulled into the page cache, leaving pages that
+      were already cached (mincore) so hot boot blocks stay resident
+    - optionally lowers the copying thread's I/O priority
+
+    One instance is shared by all copies so the limit applies to their sum.
+    Chunk store worker processes get their share of the current rate
+    through a shared array (see worker()).
+    """
+
+    def __init__(self, limit_mb_s=0, latency_target_ms=0, low_priority=False, drop_cache=False,
+                 monitor=None, shared=None, share=1):
+        """
+        Args:
+            limit_mb_s (float): Rate ceiling in MB/s; 0 for none
+            latency_target_ms (float): Boot read latency to keep below; 0 to
+                not adapt
+            low_priority (bool): Copy at the lowest best-effort I/O priority
+            drop_cache (bool): Keep copies from filling the page cache
+            monitor (LatencyMonitor, optional): Defaults to boot_latency
+            shared (multiprocessing.Array, optional): [rate, bytes done] kept
+                by the parent process; used in chunk store workers
+            share (int): Number of processes splitting the shared rate
+        """
+        self.limit_mb_s = limit_mb_s or 0
+        self.latency_target_ms = latency_target_ms or 0
+        self.low_priority = low_priority
+        self.drop_cache = drop_cache
+        self.monitor = monitor or boot_latency
+        self.ceiling = self.limit_mb_s * MB or float('inf')
+        self.rate = self.ceiling
+        self.shared = shared
+        self.share = share
+        self.bytes_done = 0
+        self.slept = 0.0
+        self.congestion_events = 0
+        self._bucket = TokenBucket(self.rate, BURST_SECONDS)
+        self._adapted_at = time.monotonic()
+        self._adapted_bytes = 0
+        self._unsynced = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return bool(self.limit_mb_s or self.latency_target_ms or self.low_priority or self.drop_cache)
+
+    def settings(self):
+        """Constructor arguments, for building a worker's throttle"""
+        return {
+            'limit_mb_s': self.limit_mb_s,
+            'latency_target_ms': self.latency_target_ms,
+            'low_priority': self.low_priority,
+            'drop_cache': self.drop_cache,
+        }
+
+    @classmethod
+    def worker(cls, settings, shared, share):
+        """Throttle for a worker process, paced by the parent's shared rate"""
+        return cls(shared=shared, share=share, **settings)
+
+    def adapt(self):
+        """
+        Recompute the rate from recent boot read latency
+
+        Returns:
+            float: Current rate in bytes per second (inf when unlimited)
+        """
+        now = time.monotonic()
+        with self._lock:
+            interval = now - self._adapted_at
+            if interval < ADAPT_INTERVAL:
+                return self.rate
+            measured = (self.bytes_done - self._adapted_bytes) / interval
+            self._adapted_at = now
+            self._adapted_bytes = self.bytes_done
+            if not self.latency_target_ms:
+                return self.rate
+
+            latency = self.monitor.percentile(95)
+            if latency is not None and latency * 1000 > self.latency_target_ms:
+                current = self.rate if self.rate != float('inf') else measured
+                self.rate = max(MIN_RATE, current / 2)
+                self.congestion_events += 1
+            elif self.rate < self.ceiling:
+                step = self.ceiling / 10 if self.ceiling != float('inf') else self.rate / 10
+                self.rate = min(self.ceiling, self.rate + max(MIN_RATE, step))
+            self._bucket.rate = self.rate
+            return self.rate
+
+    def consume(self, nbytes):
+        """Account for bytes moved and sleep long enough to stay under the rate"""
+        if self.shared is not None and self.share:
+            # Worker process: the parent adapts, we follow its current rate
+            with self.shared.get_lock():
+                self.shared[1] += nbytes
+                rate = self.shared[0] / self.share
+        else:
+            self.bytes_done += nbytes
+            rate = self.adapt()
+        if rate == float('inf'):
+            return
+        with self._lock:
+            self._bucket.rate = rate
+            delay = self._bucket.reserve(nbytes, time.monotonic())
+        if delay > 0:
+            self.slept += delay
+            time.sleep(delay)
+
+    def open_source(self, fd):
+        """Prepare a file the copy reads from; readahead would only fill the cache"""
+        if self.drop_cache and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+
+    def before_read(self, fd, offset, length):
+        """
+        Which pages of a range were cached before the copy got to them
+
+        Pass the result to copied(). Readahead triggered by the copy's own
+        reads would make the next range look cached, so the state of the
+        pages just ahead of every read is recorded before the read happens.
+        """
+        if not self.drop_cache:
+            return None
+        first = offset // _PAGE_SIZE
+        last = -(-(offset + length) // _PAGE_SIZE)
+        ahead = last + 2 * (last - first)
+        known_first, known = self._snapshots.get(fd, (first, b''))
+        if not known_first <= first <= known_first + len(known):
+            known_first, known = first, b''  # first read, or the copy skipped ahead
+        known_last = known_first + len(known)
+        if ahead > known_last:
+            fresh = resident_pages(fd, known_last * _PAGE_SIZE, (ahead - known_last) * _PAGE_SIZE)
+            if fresh is None:
+                return None
+            known += fresh
+        self._snapshots[fd] = (last, known[last - known_first:])
+        return known[first - known_first:last - known_first]
+
+    def copied(self, src, dst, offset, length, resident=None):
+        """
+        Report a chunk read from src and/or written to dst at the same offset
+
+        Args:
+            src (int): Source fd, or None for a write-only chunk
+            dst (int): Destination fd, or None for a read-only chunk
+            offset (int): File offset of the chunk
+            length (int): Bytes moved
+            resident: Result of before_read() for the source range
+        """
+        if self.drop_cache:
+            if src is not None:
+                _drop_pages(src, offset, length, resident)
+            if dst is not None:
+                self._writeback(dst, length)
+        self.consume(length)
+
+    def _writeback(self, fd, length, force=False):
+        # Dirty pages cannot be dropped; sync them first, in bounded steps
+        pending = self._unsynced.get(fd, 0) + length
+        if pending >= WRITEBACK_BYTES or (force and pending):
+            os.fdatasync(fd)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            pending = 0
+        self._unsynced[fd] = pending
+
+    def finish(self, fd):
+        """Sync and drop whatever is left of a destination's writes"""
+        if self.drop_cache and fd in self._unsynced:
+            self._writeback(fd, 0, force=True)
+        self.forget(fd)
+
+    def forget(self, fd):
+        """Stop tracking a file that is about to be closed"""
+        self._unsynced.pop(fd, None)
+        self._snapshots.pop(fd, None)
+
+    @contextmanager
+    def priority(self):
+        """Run the block at low I/O priority if configured"""
+        previous = set_io_priority(LOW_IOPRIO) if self.low_priority else None
+        try:
+            yield
+        finally:
+            if previous is not None:
+                set_io_priority(previous)
+
+    def status(self):
+        latency = self.monitor.percentile(95)
+        return {
+            'limit_mb_s': self.limit_mb_s,
+            'latency_target_ms': self.latency_target_ms,
+            'rate_mb_s': None if self.rate == float('inf') else round(self.rate / MB, 1),
+            'boot_read_p95_ms': None if latency is None else round(latency * 1000, 2),
+            'bytes_done': self.bytes_done,
+            'seconds_slept': round(self.slept, 1),
+            'congestion_events': self.congestion_events,
+            'low_priority': self.low_priority,
+            'drop_cache': self.drop_cache,
+        }
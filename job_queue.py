@@ -0,0 +1,452 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import queue
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+# Progress is written to the job record, which status reads come from, at most this often
+PROGRESS_INTERVAL = 2.0
+FINISHED_JOBS_KEPT = 200
+# Workers look for jobs submitted by other processes, or orphaned by a dead one, this often
+SCAN_INTERVAL = 5.0
+_STOP = object()
+
+
+class JobError(Exception):
+    pass
+
+
+class JobCancelled(JobError):
+    pass
+
+
+class Job:
+    """
+    One long-running operation and its progress
+
+    Handlers receive the job, read their arguments from job.params and call
+    job.progress() as they go; progress() raises JobCancelled once the job
+    has been cancelled, which unwinds the handler at its next report.
+    """
+
+    FIELDS = ('id', 'kind', 'title', 'key', 'params', 'state', 'done_bytes', 'total_bytes',
+              'result', 'error', 'attempts', 'cancel_requested', 'created_at', 'started_at', 'finished_at')
+
+    def __init__(self, kind, params, title=None, key=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.title = title or kind
+        self.key = key
+        self.params = params
+        self.state = JOB_QUEUED
+        self.done_bytes = 0
+        self.total_bytes = 0
+        self.result = None
+        self.error = None
+        self.attempts = 0
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._queue = None
+        self._saved_at = 0
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['kind'], data['params'])
+        for field in cls.FIELDS:
+            if field in data:
+                setattr(job, field, data[field])
+        return job
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @property
+    def resumed(self):
+        """Whether an earlier run of this job was interrupted"""
+        return self.attempts > 1
+
+    def progress(self, done_bytes, total_bytes=None):
+        """
+        Report progress; raises JobCancelled if the job was cancelled
+
+        Args:
+            done_bytes (int): Bytes processed so far
+            total_bytes (int, optional): Total bytes, if known or changed
+        """
+        self.done_bytes = done_bytes
+        if total_bytes is not None:
+            self.total_bytes = total_bytes
+        if not self.cancel_requested and self._queue and self._queue._cancel_marked(self.id):
+            self.cancel_requested = True  # cancelled from another process
+        if self.cancel_requested:
+            raise JobCancelled(f"job {self.id} was cancelled")
+        if self._queue and time.time() - self._saved_at >= PROGRESS_INTERVAL:
+            self._queue._save(self)
+
+
+class JobQueue:
+    """
+    Persistent queue of long-running jobs served by a bounded thread pool
+
+    Every job is kept as a JSON file in the jobs directory, and those files
+    are the only shared state: the web app runs in several processes, each
+    with its own JobQueue on the same directory. A process runs a job only
+    while it holds an exclusive flock on the job's lock file, so each job
+    runs once. The kernel drops the lock when a process dies, and every
+    worker periodically scans for active jobs nobody holds, so jobs left
+    queued or running by a stopped process are picked up again. A resumed
+    job runs its handler again with job.resumed set; handlers are expected
+    to continue from whatever the interrupted run left behind.
+
+    Status is read from the records, so any process can answer for jobs
+    running in another. Cancellation is a marker file next to the record,
+    seen by the running process at the job's next progress report.
+
+    Jobs submitted with a key are exclusive: a second job with the same key
+    is refused while the first is queued or running, so two operations never
+    write the same image at once. The check and the new record are made
+    under a lock on the whole directory.
+    """
+
+    def __init__(self, directory, workers=2, scan_interval=SCAN_INTERVAL):
+        """
+        Args:
+            directory (str): Where job records are kept
+            workers (int): Jobs run concurrently by this process
+            scan_interval (float): Seconds between scans for unclaimed jobs
+        """
+        self.directory = directory
+        self.workers = workers
+        self.scan_interval = scan_interval
+        self.handlers = {}
+        self._jobs = {}
+        self._records_cache = {}
+        self._pending = queue.Queue()
+        self._threads = []
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+    def register(self, kind, handler):
+        """
+        Register the function that runs jobs of a kind
+
+        Args:
+            kind (str): Job kind
+            handler (callable): Called with the Job; returns a JSON-serializable
+                result or raises to fail the job
+        """
+        self.handlers[kind] = handler
+
+    def start(self):
+        """Start the workers; their first scan resumes unfinished jobs"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Job queue started with {self.workers} workers in {self.directory}")
+
+    def stop(self, timeout=None):
+        """Stop the workers after their current jobs; queued jobs stay persisted"""
+        for _ in self._threads:
+            self._pending.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, kind, params, title=None, key=None):
+        """
+        Queue a job
+
+        Args:
+            kind (str): Registered job kind
+            params (dict): JSON-serializable arguments for the handler
+            title (str, optional): Shown in the UI
+            key (str, optional): Resource the job needs exclusively
+
+        Returns:
+            Job: The queued job, or None if another job holds the key
+        """
+        if kind not in self.handlers:
+            raise JobError(f"no handler for job kind {kind}")
+        job = Job(kind, params, title, key)
+        with self._directory_lock():
+            if key and self._active_with_key(key):
+                return None
+            self._save(job)
+        self._pending.put(job.id)
+        logger.info(f"Queued job {job.id}: {job.title}")
+        return job
+
+    def _active_with_key(self, key):
+        return any(record.get('key') == key and record['state'] in ACTIVE_STATES
+                   for record in self._records())
+
+    def cancel(self, job_id):
+        """
+        Cancel a job; a running job stops at its next progress report
+
+        Returns:
+            bool: True if the job was queued or running
+        """
+        record = self.get(job_id)
+        if not record or record['state'] not in ACTIVE_STATES:
+            return False
+        # Seen by whichever process runs the job, at its next progress report
+        with open(self._cancel_path(job_id), 'w'):
+            pass
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancel_requested = True
+        else:
+            # Nobody has claimed it yet: finish it here
+            self._run_claimed(job_id)
+        logger.info(f"Cancellation requested for job {job_id}")
+        return True
+
+    def get(self, job_id):
+        """A job record, from whichever process runs it"""
+        for record in self._records():
+            if record['id'] == job_id:
+                return record
+        return None
+
+    def jobs(self, active_only=False, limit=50):
+        """
+        Job records, newest first, as every process sees them
+
+        Args:
+            active_only (bool): Only queued and running jobs
+            limit (int): Maximum number of records
+
+        Returns:
+            list: Job dictionaries
+        """
+        records = sorted(self._records(), key=lambda record: record['created_at'], reverse=True)
+        if active_only:
+            records = [record for record in records if record['state'] in ACTIVE_STATES]
+        return records[:limit]
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _lock_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.lock")
+
+    def _cancel_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.cancel")
+
+    def _cancel_marked(self, job_id):
+        return os.path.exists(self._cancel_path(job_id))
+
+    @contextlib.contextmanager
+    def _directory_lock(self):
+        """Serialize key checks and pruning across threads and processes"""
+        with self._lock:
+            fd = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _save(self, job):
+        job._saved_at = time.time()
+        path = self._path(job.id)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp, path)
+
+    def _read(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                return Job.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None  # pruned since it was listed
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable job record {job_id}: {e}")
+            return None
+
+    def _records(self):
+        """
+        Every job record in the directory
+
+        Records are rewritten with os.replace, so a record whose inode and
+        mtime are unchanged is served from the last parse.
+        """
+        records = []
+        seen = set()
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # pruned meanwhile
+                seen.add(entry.name)
+                version = (st.st_ino, st.st_mtime_ns)
+                cached = self._records_cache.get(entry.name)
+                if cached is None or cached[0] != version:
+                    try:
+                        with open(entry.path) as f:
+                            cached = (version, json.load(f))
+                    except (OSError, ValueError) as e:
+                        logger.warning(f"Ignoring unreadable job record {entry.path}: {e}")
+                        continue
+                    self._records_cache[entry.name] = cached
+                record = cached[1]
+                if record['state'] in ACTIVE_STATES and not record.get('cancel_requested') \
+                        and self._cancel_marked(record['id']):
+                    record = dict(record, cancel_requested=True)
+                records.append(record)
+            for name in set(self._records_cache) - seen:
+                del self._records_cache[name]
+        return records
+
+    def _claim(self, job_id):
+        """Lock a job for this process; returns the lock fd, or None if it is taken"""
+        fd = os.open(self._lock_path(job_id), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _run_claimed(self, job_id):
+        """
+        Claim a job and run it if it is still active
+
+        Returns:
+            bool: True if this process claimed and ran (or cancelled) the job
+        """
+        fd = self._claim(job_id)
+        if fd is None:
+            return False
+        try:
+            # Read under the lock: whoever held it before may have finished the job
+            job = self._read(job_id)
+            if job is None or job.state not in ACTIVE_STATES:
+                return False
+            job._queue = self
+            with self._lock:
+                self._jobs[job.id] = job
+            if job.cancel_requested or self._cancel_marked(job.id):
+                self._finish(job, JOB_CANCELLED)
+                return True
+            if job.state == JOB_RUNNING:
+                logger.info(f"Resuming interrupted job {job.id}: {job.title}")
+            job.state = JOB_RUNNING
+            self._run(job)
+            return True
+        finally:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            # The lock file stays: unlinking it while others may have it open would let
+            # two processes lock different files for one job. _prune() collects it.
+            os.close(fd)
+
+    def _run_next(self):
+        """Claim and run the oldest active job nobody holds; False if there is none"""
+        records = [record for record in self._records() if record['state'] in ACTIVE_STATES]
+        for record in sorted(records, key=lambda record: record['created_at']):
+            if self._run_claimed(record['id']):
+                return True
+        return False
+
+    def _worker(self):
+        while True:
+            # Jobs submitted elsewhere, or left behind by a stopped process
+            while self._run_next():
+                pass
+            try:
+                job_id = self._pending.get(timeout=self.scan_interval)
+            except queue.Empty:
+                continue
+            if job_id is _STOP:
+                return
+            self._run_claimed(job_id)
+
+    def _run(self, job):
+        handler = self.handlers.get(job.kind)
+        if handler is None:
+            self._finish(job, JOB_FAILED, error=f"no handler for job kind {job.kind}")
+            return
+
+        job.attempts += 1
+        job.started_at = time.time()
+        self._save(job)
+        try:
+            result = handler(job)
+        except Exception as e:
+            if job.cancel_requested:
+                self._finish(job, JOB_CANCELLED)
+            else:
+                logger.error(f"Job {job.id} ({job.title}) failed: {e}")
+                self._finish(job, JOB_FAILED, error=str(e))
+            return
+        # Work that completed before the cancellation was noticed still counts
+        self._finish(job, JOB_SUCCEEDED, result=result)
+
+    def _finish(self, job, state, result=None, error=None):
+        job.state = state
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        self._save(job)
+        self._prune()
+        logger.info(f"Job {job.id} ({job.title}) {state} after {job.finished_at - (job.started_at or job.created_at):.1f}s")
+
+    def _prune(self):
+        """
+        Delete the oldest finished job records beyond FINISHED_JOBS_KEPT
+
+        Lock and cancel files go with their record, and so do any left
+        behind by a record deleted earlier. A lock file is only removed by
+        the process holding it, and only once its job is finished, so a
+        process that opened it just before will read a final record and
+        never run the job on the strength of that lock.
+        """
+        with self._directory_lock():
+            records = self._records()
+            finished = sorted((record for record in records if record['state'] not in ACTIVE_STATES),
+                              key=lambda record: record.get('finished_at') or 0, reverse=True)
+            for record in finished[FINISHED_JOBS_KEPT:]:
+                self._remove(self._path(record['id']))
+            kept = {record['id'] for record in records} - {record['id'] for record in finished[FINISHED_JOBS_KEPT:]}
+            for entry in os.scandir(self.directory):
+                job_id, ext = os.path.splitext(entry.name)
+                if not job_id or job_id.startswith('.') or job_id in kept:
+                    continue
+                if ext == '.cancel':
+                    self._remove(entry.path)
+                elif ext == '.lock':
+                    fd = self._claim(job_id)
+                    if fd is not None:
+                        self._remove(entry.path)
+                        os.close(fd)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
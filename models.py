@@ -66,7 +66,15 @@ class RestorationPoint(db.Model):
 class NetworkSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     tftp_enabled = db.Column(db.Boolean, default=True)
+    mtftp_enabled = db.Column(db.Boolean, default=False)  # RFC 2090 multicast TFTP
+    mtftp_address = db.Column(db.String(15), default='239.255.69.1')  # First address of the group pool
+    mtftp_port = db.Column(db.Integer, default=1758)
     dhcp_enabled = db.Column(db.Boolean, default=True)
+    http_boot_enabled = db.Column(db.Boolean, default=False)  # Chainload iPXE and serve boot files over HTTP
+    http_boot_port = db.Column(db.Integer, default=5000)
+    dhcp_mode = db.Column(db.String(10), default='server')  # server or proxy (ProxyDHCP next to an existing DHCP server)
+    nbd_enabled = db.Column(db.Boolean, default=False)  # Export client VHDs as network block devices
+    nbd_port = db.Column(db.Integer, default=10809)
     network_interface = db.Column(db.String(32), default='eth0')
     subnet = db.Column(db.String(32), default='192.168.1.0/24')
     gateway = db.Column(db.String(15), default='192.168.1.1')
@@ -76,12 +84,17 @@ class NetworkSettings(db.Model):
     bandwidth_limit_mbps = db.Column(db.Integer, default=0)  # 0 means unlimited
     caching_enabled = db.Column(db.Boolean, default=True)
     cache_size_mb = db.Column(db.Integer, default=1024)
+    copy_limit_mb_s = db.Column(db.Integer, default=0)  # Clone/backup/restore ceiling, 0 means unlimited
+    copy_latency_target_ms = db.Column(db.Integer, default=50)  # Slow copies down while boot reads exceed this, 0 disables
+    copy_low_priority = db.Column(db.Boolean, default=True)  # Lowest I/O priority for copies
+    copy_drop_cache = db.Column(db.Boolean, default=True)  # Keep copies out of the page cache
+    stats_retention_days = db.Column(db.Integer, default=2)  # Raw client stats kept this long, rollups after that
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
 
 class ClientStats(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     cpu_usage = db.Column(db.Float)
     memory_usage_mb = db.Column(db.Float)
     network_rx_mbps = db.Column(db.Float)
@@ -89,6 +102,47 @@ class ClientStats(db.Model):
     
     # Relationship to Client
     client = db.relationship('Client', backref='stats')
+    
+    __table_args__ = (db.Index('ix_client_stats_client_time', 'client_id', 'timestamp'),)
+
+class ClientLatestStats(db.Model):
+    """Most recent stats sample of every client, kept current on ingest"""
+    __tablename__ = 'client_latest_stats'
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    cpu_usage = db.Column(db.Float)
+    memory_usage_mb = db.Column(db.Float)
+    network_rx_mbps = db.Column(db.Float)
+    network_tx_mbps = db.Column(db.Float)
+
+class ClientStatsRollup(db.Model):
+    """Client stats downsampled to one row per client and bucket (1m, 1h or 1d)"""
+    id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    resolution = db.Column(db.String(4), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    samples = db.Column(db.Integer, nullable=False)
+    cpu_usage_min = db.Column(db.Float)
+    cpu_usage_max = db.Column(db.Float)
+    cpu_usage_avg = db.Column(db.Float)
+    cpu_usage_p95 = db.Column(db.Float)
+    memory_usage_mb_min = db.Column(db.Float)
+    memory_usage_mb_max = db.Column(db.Float)
+    memory_usage_mb_avg = db.Column(db.Float)
+    memory_usage_mb_p95 = db.Column(db.Float)
+    network_rx_mbps_min = db.Column(db.Float)
+    network_rx_mbps_max = db.Column(db.Float)
+    network_rx_mbps_avg = db.Column(db.Float)
+    network_rx_mbps_p95 = db.Column(db.Float)
+    network_tx_mbps_min = db.Column(db.Float)
+    network_tx_mbps_max = db.Column(db.Float)
+    network_tx_mbps_avg = db.Column(db.Float)
+    network_tx_mbps_p95 = db.Column(db.Float)
+    
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'resolution', 'bucket_start'),
+        db.Index('ix_client_stats_rollup_resolution_time', 'resolution', 'bucket_start'),
+    )
 
 # New models for client-server communication
 
@@ -0,0 +1,356 @@
+import os
+import struct
+import asyncio
+import logging
+
+from tftp_server import FileMapRegistry
+from io_throttle import boot_latency, touch_pages
+
+logger = logging.getLogger(__name__)
+
+# Handshake (fixed newstyle negotiation)
+NBD_MAGIC = 0x4e42444d41474943  # "NBDMAGIC"
+IHAVEOPT = 0x49484156454f5054  # "IHAVEOPT"
+OPTION_REPLY_MAGIC = 0x3e889045565a9
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+
+# Options
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_LIST = 3
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+
+# Option replies
+NBD_REP_ACK = 1
+NBD_REP_SERVER = 2
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_REP_ERR_POLICY = (1 << 31) + 2
+NBD_REP_ERR_INVALID = (1 << 31) + 3
+NBD_REP_ERR_UNKNOWN = (1 << 31) + 6
+NBD_INFO_EXPORT = 0
+NBD_INFO_BLOCK_SIZE = 3
+
+# Transmission flags
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_FLAG_CAN_MULTI_CONN = 1 << 8
+
+# Transmission phase
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_TRIM = 4
+
+# Error values (Linux errno numbers, as the protocol requires)
+NBD_EPERM = 1
+NBD_EIO = 5
+NBD_EINVAL = 22
+NBD_ENOSPC = 28
+
+REQUEST_FORMAT = '!IHHQQI'
+REQUEST_SIZE = struct.calcsize(REQUEST_FORMAT)
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
+PREFERRED_BLOCK_SIZE = 4096
+
+
+class ImageExport:
+    """
+    Read-only view of a disk image
+
+    Backed by the shared FileMapRegistry, so every connection exporting the
+    same image reads one mapping and one set of page-cache pages. Given a
+    BootTraceStore, the reads of the client's boot are recorded as a trace.
+    """
+
+    read_only = True
+    multi_conn = True
+
+    def __init__(self, registry, path, boot_traces=None):
+        self.path = path
+        self.mapped = registry.acquire(path, sequential=False)
+        self.size = self.mapped.size
+        self.trace = boot_traces.session(path) if boot_traces else None
+
+    def read(self, offset, length):
+        """Return a view of length bytes starting at offset, paged in"""
+        if self.trace:
+            self.trace.record(offset, length)
+        return touch_pages(self.mapped.read(offset, length))
+
+    def write(self, offset, data):
+        raise PermissionError(self.path)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.trace:
+            self.trace.finish()
+        self.mapped.close()
+
+
+class NBDServer:
+    """
+    Network Block Device server exporting client disk images
+
+    Speaks the fixed newstyle handshake (NBD_OPT_EXPORT_NAME, LIST, INFO and
+    GO) and simple replies. Every connection runs on one asyncio loop;
+    requests on a connection are answered in order.
+    """
+
+    def __init__(self, resolver, host='0.0.0.0', port=10809, export_factory=None):
+        """
+        Args:
+            resolver (callable): Maps an export name to a dict with 'path'
+                (and optionally 'name' and 'client'), or None if there is no
+                such export
+            host (str): Address to listen on
+            port (int): TCP port (10809 is the IANA NBD port)
+            export_factory (callable, optional): Called with (registry, export)
+                to open the export; defaults to a read-only ImageExport
+        """
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.export_factory = export_factory or (lambda registry, export: ImageExport(registry, export['path']))
+
+        self.loop = None
+        self.server = None
+        self.file_maps = FileMapRegistry()
+        self.connections = set()
+        self._stop_event = None
+        self._stop_requested = False
+        self.stats = {
+            'connections': 0,
+            'requests': 0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'errors': 0,
+        }
+
+    async def start(self):
+        """Listen on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                 reuse_address=True)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"NBD server started on {self.host}:{self.port}")
+
+    async def close(self):
+        """Stop listening and drop all connections"""
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+        logger.info("NBD server stopped")
+
+    def serve_forever(self):
+        """Run the server on a new event loop until stop() is called"""
+        async def _serve():
+            self._stop_event = asyncio.Event()
+            await self.start()
+            try:
+                if not self._stop_requested:
+                    await self._stop_event.wait()
+            finally:
+                await self.close()
+
+        asyncio.run(_serve())
+
+    def stop(self):
+        """Stop a server running in serve_forever() from another thread"""
+        self._stop_requested = True
+        if self.loop and self._stop_event and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def _handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self.connections.add(writer)
+        self.stats['connections'] += 1
+        export = None
+        try:
+            export = await self._negotiate(reader, writer)
+            if export is not None:
+                logger.info(f"NBD client {peer} attached to {export.path}")
+                await self._transmit(reader, writer, export)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"NBD connection from {peer} failed: {e}")
+        finally:
+            if export is not None:
+                export.close()
+            self.connections.discard(writer)
+            writer.close()
+
+    def _open_export(self, name):
+        try:
+            export = self.resolver(name)
+        except Exception as e:
+            logger.error(f"Error resolving NBD export {name!r}: {e}")
+            return None
+        if not export or not os.path.isfile(export.get('path') or ''):
+            return None
+        return self.export_factory(self.file_maps, export)
+
+    @staticmethod
+    def _transmission_flags(export):
+        flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH
+        if export.read_only:
+            flags |= NBD_FLAG_READ_ONLY
+        if export.multi_conn:
+            # Nothing is cached per connection, so clients may open several
+            flags |= NBD_FLAG_CAN_MULTI_CONN
+        return flags
+
+    def _option_reply(self, writer, option, reply_type, data=b''):
+        writer.write(struct.pack('!QIII', OPTION_REPLY_MAGIC, option, reply_type, len(data)) + data)
+
+    async def _negotiate(self, reader, writer):
+        """Run the option haggling phase; returns the export to serve, or None"""
+        writer.write(struct.pack('!QQH', NBD_MAGIC, IHAVEOPT, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        client_flags, = struct.unpack('!I', await reader.readexactly(4))
+        no_zeroes = bool(client_flags & NBD_FLAG_C_NO_ZEROES)
+
+        while True:
+            magic, option, length = struct.unpack('!QII', await reader.readexactly(16))
+            if magic != IHAVEOPT or length > 65536:
+                return None
+            data = await reader.readexactly(length)
+
+            if option == NBD_OPT_EXPORT_NAME:
+                export = self._open_export(data.decode('utf-8', errors='replace'))
+                if export is None:
+                    return None  # this option has no error reply; just hang up
+                writer.write(struct.pack('!QH', export.size, self._transmission_flags(export)))
+                if not no_zeroes:
+                    writer.write(b'\0' * 124)
+                return export
+
+            if option == NBD_OPT_ABORT:
+                self._option_reply(writer, option, NBD_REP_ACK)
+                await writer.drain()
+                return None
+
+            if option == NBD_OPT_LIST:
+                # Exports are per client; listing them would leak client names
+                self._option_reply(writer, option, NBD_REP_ERR_POLICY)
+                continue
+
+            if option in (NBD_OPT_INFO, NBD_OPT_GO):
+                if length < 6:
+                    self._option_reply(writer, option, NBD_REP_ERR_INVALID)
+                    continue
+                name_length, = struct.unpack('!I', data[:4])
+                name = data[4:4 + name_length].decode('utf-8', errors='replace')
+                export = self._open_export(name)
+                if export is None:
+                    self._option_reply(writer, option, NBD_REP_ERR_UNKNOWN)
+                    continue
+                self._option_reply(writer, option, NBD_REP_INFO, struct.pack(
+                    '!HQH', NBD_INFO_EXPORT, export.size, self._transmission_flags(export)))
+                self._option_reply(writer, option, NBD_REP_INFO, struct.pack(
+                    '!HIII', NBD_INFO_BLOCK_SIZE, 1, PREFERRED_BLOCK_SIZE, MAX_REQUEST_SIZE))
+                self._option_reply(writer, option, NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    return export
+                export.close()
+                continue
+
+            self._option_reply(writer, option, NBD_REP_ERR_UNSUP)
+
+    def _reply(self, writer, handle, error=0, payload=None):
+        writer.write(struct.pack('!IIQ', NBD_SIMPLE_REPLY_MAGIC, error, handle))
+        if payload is not None:
+            writer.write(payload)
+        if error:
+            self.stats['errors'] += 1
+
+    @staticmethod
+    async def _discard(reader, length):
+        """Read and drop a request payload without buffering all of it"""
+        while length:
+            length -= len(await reader.readexactly(min(length, PREFERRED_BLOCK_SIZE * 16)))
+
+    async def _transmit(self, reader, writer, export):
+        while True:
+            magic, _flags, command, handle, offset, length = struct.unpack(
+                REQUEST_FORMAT, await reader.readexactly(REQUEST_SIZE))
+            if magic != NBD_REQUEST_MAGIC:
+                return
+            self.stats['requests'] += 1
+
+            if command == NBD_CMD_DISC:
+                return
+
+            if command == NBD_CMD_WRITE:
+                if length > MAX_REQUEST_SIZE:
+                    # The payload cannot be skipped safely; give up on the connection
+                    self._reply(writer, handle, NBD_EINVAL)
+                    await writer.drain()
+                    return
+                if offset + length > export.size:
+                    await self._discard(reader, length)
+                    self._reply(writer, handle, NBD_ENOSPC)
+                    await writer.drain()
+                    continue
+                data = await reader.readexactly(length)
+                try:
+                    export.write(offset, data)
+                except PermissionError:
+                    self._reply(writer, handle, NBD_EPERM)
+                except OSError:
+                    self._reply(writer, handle, NBD_EIO)
+                else:
+                    self.stats['bytes_written'] += length
+                    self._reply(writer, handle)
+
+            elif command == NBD_CMD_READ:
+                if length > MAX_REQUEST_SIZE or offset + length > export.size:
+                    self._reply(writer, handle, NBD_EINVAL)
+                else:
+                    try:
+                        # Background copies back off when this gets slow
+                        with boot_latency.timed():
+                            data = export.read(offset, length)
+                    except OSError:
+                        self._reply(writer, handle, NBD_EIO)
+                    else:
+                        self.stats['bytes_read'] += length
+                        self._reply(writer, handle, payload=data)
+
+            elif command == NBD_CMD_FLUSH:
+                try:
+                    export.flush()
+                except OSError:
+                    self._reply(writer, handle, NBD_EIO)
+                else:
+                    self._reply(writer, handle)
+
+            elif command == NBD_CMD_TRIM:
+                self._reply(writer, handle, NBD_EPERM if export.read_only else 0)
+
+            else:
+                self._reply(writer, handle, NBD_EINVAL)
+
+            # Pipelined requests keep flowing; only wait once the socket is backed up
+            await writer.drain()
+
+    def status(self):
+        """Return export counters for the status page"""
+        status = dict(self.stats)
+        status['active_connections'] = len(self.connections)
+        status.update(self.file_maps.status())
+        return status
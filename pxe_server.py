@@ -7,6 +7,18 @@ import struct
 import ipaddress
 from datetime import datetime
 
+from tftp_server import TFTPServer
+from dhcp_server import DHCPServer, EFI_ARCHITECTURES, DHCPDISCOVER
+from boot_cache import BlockCache
+from boot_config import BootConfigProvider, normalize_mac
+from bandwidth import BandwidthScheduler
+from nbd_server import NBDServer, ImageExport
+from write_overlay import OverlayStore
+from boot_trace import BootTraceStore
+from vhd_format import SharedDisks, DiskInUseError
+from vhd_manager import VHDManager
+from image_integrity import integrity_status, STATE_CORRUPT
+
 logger = logging.getLogger(__name__)
 
 class PXEServer:
@@ -20,103 +32,243 @@ class PXEServer:
     
     def __init__(self, interface='eth0', tftp_root='/tmp/tftp', 
                  dhcp_enabled=True, subnet='192.168.1.0/24', 
-                 gateway='192.168.1.1', dns_server='8.8.8.8'):
+                 gateway='192.168.1.1', dns_server='8.8.8.8', tftp_port=69,
+                 caching_enabled=True, cache_size_mb=1024, mtftp_enabled=False,
+                 mtftp_address='239.255.69.1', mtftp_port=1758, server_ip=None,
+                 dhcp_mode='server', dhcp_port=67, lease_time=3600, lease_file=None,
+                 client_loader=None, http_boot_enabled=False, http_boot_port=5000,
+                 bandwidth_limit_mbps=0, nbd_enabled=False, nbd_port=10809,
+                 overlay_dir=None):
         self.interface = interface
         self.tftp_root = tftp_root
+        self.tftp_port = tftp_port
         self.dhcp_enabled = dhcp_enabled
         self.subnet = subnet
         self.gateway = gateway
         self.dns_server = dns_server
+        self.mtftp_enabled = mtftp_enabled
+        self.mtftp_address = mtftp_address
+        self.mtftp_port = mtftp_port
+        self.server_ip = server_ip or self._default_server_ip()
+        self.dhcp_mode = dhcp_mode
+        self.dhcp_port = dhcp_port
+        self.lease_time = lease_time
+        # Leases live next to the TFTP root so they survive restarts
+        self.lease_file = lease_file or os.path.join(
+            os.path.dirname(os.path.abspath(self.tftp_root)), 'dhcp.leases')
+        
+        # iPXE fetches large payloads from the web app once chainloaded
+        self.http_boot_url = f"http://{self.server_ip}:{http_boot_port}/boot" if http_boot_enabled else None
+        
+        # Per-client boot configs are rendered in memory from the client table
+        self.boot_configs = BootConfigProvider(client_loader or (lambda: []), http_base=self.http_boot_url)
+        
+        # Egress limit shared by TFTP sessions and HTTP boot downloads
+        self.bandwidth = BandwidthScheduler(bandwidth_limit_mbps)
+        
+        # Block cache shared by every boot file the server hands out
+        self.block_cache = BlockCache(cache_size_mb * 1024 * 1024) if caching_enabled else None
         
         self.tftp_server = None
+        self.tftp_engine = None
         self.dhcp_server = None
+        self.dhcp_engine = None
+        self.nbd_enabled = nbd_enabled
+        self.nbd_port = nbd_port
+        self.nbd_server = None
+        self.nbd_engine = None
+        
+        # Client writes go to per-client overlays, never to the golden image
+        self.overlays = OverlayStore(overlay_dir or os.path.join(
+            os.path.dirname(os.path.abspath(self.tftp_root)), 'overlays'))
+        
+        # Super mode clients of one VHD all write through one differencing disk
+        self.shared_disks = SharedDisks()
+        
+        # Boot reads are recorded per image and prefetched for the next boot storm
+        self.boot_traces = BootTraceStore()
         self.running = False
         
         # Ensure TFTP root directory exists
         os.makedirs(self.tftp_root, exist_ok=True)
-        
-        # Generate boot files
-        self._generate_boot_files()
     
-    def _generate_boot_files(self):
-        """Generate PXE boot files in the TFTP root directory"""
-        # Create pxelinux.cfg directory
-        pxelinux_cfg_dir = os.path.join(self.tftp_root, 'pxelinux.cfg')
-        os.makedirs(pxelinux_cfg_dir, exist_ok=True)
+    def _default_server_ip(self):
+        """Pick the first address in the subnet that is not the gateway"""
+        for host in ipaddress.ip_network(self.subnet, strict=False).hosts():
+            if str(host) != self.gateway:
+                return str(host)
+        return '0.0.0.0'
+    
+    def _create_tftp_engine(self):
+        return TFTPServer(
+            self.tftp_root,
+            port=self.tftp_port,
+            block_cache=self.block_cache,
+            multicast_enabled=self.mtftp_enabled,
+            multicast_address=self.mtftp_address,
+            multicast_port=self.mtftp_port,
+            config_provider=self.boot_configs,
+            scheduler=self.bandwidth
+        )
+    
+    def start_tftp_server(self):
+        """Run the TFTP engine for PXE boot until the server is stopped"""
+        if self.tftp_engine is None:
+            self.tftp_engine = self._create_tftp_engine()
         
-        # Write default configuration file
-        default_cfg_path = os.path.join(pxelinux_cfg_dir, 'default')
-        with open(default_cfg_path, 'w') as f:
-            f.write("""DEFAULT winpe
-LABEL winpe
-    KERNEL /winpe/boot/pxeboot.com
-    APPEND /winpe/Boot/BCD /winpe/Boot/boot.sdi /winpe/sources/boot.wim
-""")
+        try:
+            self.tftp_engine.serve_forever()
+        except Exception as e:
+            logger.error(f"TFTP server error: {e}")
+    
+    def _create_dhcp_engine(self):
+        return DHCPServer(
+            self.server_ip,
+            subnet=self.subnet,
+            gateway=self.gateway,
+            dns_server=self.dns_server,
+            mode=self.dhcp_mode,
+            interface=self.interface,
+            port=self.dhcp_port,
+            lease_time=self.lease_time,
+            lease_file=self.lease_file,
+            boot_file_selector=self._select_boot_file
+        )
+    
+    def _select_boot_file(self, mac, arch, packet):
+        """
+        Chainload iPXE so the bulk of the boot moves from TFTP to HTTP
         
-        logger.info(f"Generated PXE boot files in {self.tftp_root}")
+        Args:
+            mac (str): Client MAC address
+            arch (int): Client architecture (DHCP option 93)
+            packet (DHCPPacket): The client's request
+            
+        Returns:
+            str: Boot file name or URL, or None for the default PXE loader
+        """
+        if packet.message_type == DHCPDISCOVER and not packet.is_ipxe:
+            # Boot firmware only discovers once per power-on
+            self._on_client_reboot(mac)
+        if not self.http_boot_url:
+            return None
+        if packet.is_ipxe:
+            # Second stage: hand iPXE its per-client script
+            return f"{self.http_boot_url}/ipxe/{mac.replace(':', '-')}.ipxe"
+        if packet.is_http_client:
+            return f"{self.http_boot_url}/ipxe.efi"
+        return 'ipxe.efi' if arch in EFI_ARCHITECTURES else 'undionly.kpxe'
     
-    def start_tftp_server(self):
-        """Start a simple TFTP server for PXE boot"""
-        tftp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        tftp_sock.bind(('0.0.0.0', 69))  # TFTP port
-        
-        logger.info("TFTP server started on port 69")
-        
-        while self.running:
-            try:
-                data, addr = tftp_sock.recvfrom(512)
-                # In a real implementation, we would handle TFTP requests here
-                # This is just a placeholder for the demo
-                logger.debug(f"Received TFTP request from {addr}")
-            except Exception as e:
-                logger.error(f"TFTP server error: {e}")
-                time.sleep(1)
+    def _on_client_reboot(self, mac):
+        """Give non-persistent clients a clean disk on every boot"""
+        client = self.boot_configs.client(mac)
+        if client and not client.get('is_persistent'):
+            self.discard_overlay(mac)
     
     def start_dhcp_server(self):
-        """Start a simple DHCP server for PXE boot"""
+        """Run the DHCP (or ProxyDHCP) responder until the server is stopped"""
         if not self.dhcp_enabled:
             return
         
-        dhcp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        dhcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        dhcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        dhcp_sock.bind(('0.0.0.0', 67))  # DHCP server port
+        if self.dhcp_engine is None:
+            self.dhcp_engine = self._create_dhcp_engine()
         
-        logger.info("DHCP server started on port 67")
+        try:
+            self.dhcp_engine.serve_forever()
+        except Exception as e:
+            logger.error(f"DHCP server error: {e}")
+    
+    def _create_nbd_engine(self):
+        return NBDServer(self._resolve_export, port=self.nbd_port, export_factory=self._open_export)
+    
+    def _resolve_export(self, name):
+        """
+        Map an NBD export name to the client's disk image
         
-        # Get IP range from subnet
-        subnet_obj = ipaddress.ip_network(self.subnet)
-        available_ips = list(subnet_obj.hosts())[10:50]  # Use a subset of IPs
+        Clients attach with their own MAC address as the export name, so
+        every client only ever sees the VHD assigned to it.
         
-        while self.running:
-            try:
-                data, addr = dhcp_sock.recvfrom(1024)
-                # In a real implementation, we would handle DHCP requests here
-                # This is just a placeholder for the demo
-                logger.debug(f"Received DHCP request from {addr}")
-            except Exception as e:
-                logger.error(f"DHCP server error: {e}")
-                time.sleep(1)
+        Args:
+            name (str): Export name sent by the client
+            
+        Returns:
+            dict: Export with 'path', 'name' and 'client', or None if unknown
+        """
+        client = self.boot_configs.client(name)
+        if not client or not client.get('vhd_path'):
+            return None
+        if integrity_status(client['vhd_path'])['state'] == STATE_CORRUPT:
+            logger.error(f"Refusing to export {client['vhd_path']} to {name}: image failed verification")
+            return None
+        return {'path': client['vhd_path'], 'name': normalize_mac(name), 'client': client}
+    
+    def _open_export(self, registry, export):
+        """Layer the client's write overlay over the shared golden image"""
+        if export['client'].get('is_super_mode'):
+            # Super mode writes go to the VHD's differencing disk so they can be committed
+            diff_path = VHDManager.get_differencing_disk(export['path'])
+            if diff_path:
+                try:
+                    return self.shared_disks.open(diff_path)
+                except DiskInUseError:
+                    logger.warning(f"Not exporting {diff_path} to {export['name']}: changes are being committed or discarded")
+                    return None
+        return self.overlays.open(export['name'], ImageExport(registry, export['path'], self.boot_traces))
+    
+    def discard_overlay(self, mac):
+        """
+        Throw away a client's disk changes
+        
+        Args:
+            mac (str): Client MAC address
+            
+        Returns:
+            bool: True if there was an overlay to discard
+        """
+        return self.overlays.discard(normalize_mac(mac))
+    
+    def start_nbd_server(self):
+        """Export client disk images over NBD until the server is stopped"""
+        if not self.nbd_enabled:
+            return
+        
+        if self.nbd_engine is None:
+            self.nbd_engine = self._create_nbd_engine()
+        
+        try:
+            self.nbd_engine.serve_forever()
+        except Exception as e:
+            logger.error(f"NBD server error: {e}")
     
     def start(self):
-        """Start both TFTP and DHCP servers in separate threads"""
+        """Start the TFTP, DHCP and NBD servers in separate threads"""
         if self.running:
             logger.warning("PXE server is already running")
             return
         
         self.running = True
+        self.start_time = datetime.now()
         
         # Start TFTP server in a thread
+        self.tftp_engine = self._create_tftp_engine()
         self.tftp_server = threading.Thread(target=self.start_tftp_server)
         self.tftp_server.daemon = True
         self.tftp_server.start()
         
         # Start DHCP server in a thread if enabled
         if self.dhcp_enabled:
+            self.dhcp_engine = self._create_dhcp_engine()
             self.dhcp_server = threading.Thread(target=self.start_dhcp_server)
             self.dhcp_server.daemon = True
             self.dhcp_server.start()
         
+        # Start the disk image export in a thread if enabled
+        if self.nbd_enabled:
+            self.nbd_engine = self._create_nbd_engine()
+            self.nbd_server = threading.Thread(target=self.start_nbd_server)
+            self.nbd_server.daemon = True
+            self.nbd_server.start()
+        
         logger.info(f"PXE server started on interface {self.interface}")
     
     def stop(self):
@@ -127,6 +279,15 @@ LABEL winpe
         
         self.running = False
         
+        if self.tftp_engine:
+            self.tftp_engine.stop()
+        
+        if self.dhcp_engine:
+            self.dhcp_engine.stop()
+        
+        if self.nbd_engine:
+            self.nbd_engine.stop()
+        
         # Wait for threads to terminate
         if self.tftp_server and self.tftp_server.is_alive():
             self.tftp_server.join(2)
@@ -134,8 +295,44 @@ LABEL winpe
         if self.dhcp_server and self.dhcp_server.is_alive():
             self.dhcp_server.join(2)
         
+        if self.nbd_server and self.nbd_server.is_alive():
+            self.nbd_server.join(2)
+        
         logger.info("PXE server stopped")
 
+    def invalidate_boot_configs(self):
+        """Re-render boot configs after a client or its VHD changed"""
+        self.boot_configs.invalidate()
+
+    def configure_bandwidth(self, bandwidth_limit_mbps):
+        """
+        Apply a new boot traffic limit without restarting the server
+        
+        Args:
+            bandwidth_limit_mbps (int): Aggregate limit in Mbps, 0 for unlimited
+        """
+        if bandwidth_limit_mbps != self.bandwidth.limit_mbps:
+            self.bandwidth.set_limit(bandwidth_limit_mbps)
+
+    def configure_cache(self, caching_enabled, cache_size_mb):
+        """
+        Apply cache settings without restarting the server
+        
+        Args:
+            caching_enabled (bool): Whether boot files are served through the cache
+            cache_size_mb (int): Cache budget in megabytes
+        """
+        if caching_enabled and self.block_cache:
+            self.block_cache.resize(cache_size_mb * 1024 * 1024)
+        elif caching_enabled:
+            self.block_cache = BlockCache(cache_size_mb * 1024 * 1024)
+        else:
+            self.block_cache = None
+        
+        # New sessions pick up the change; running transfers keep their source
+        if self.tftp_engine:
+            self.tftp_engine.block_cache = self.block_cache
+
     def status(self):
         """Return the current status of the PXE server"""
         return {
@@ -143,8 +340,21 @@ LABEL winpe
             'interface': self.interface,
             'tftp_root': self.tftp_root,
             'dhcp_enabled': self.dhcp_enabled,
+            'dhcp_mode': self.dhcp_mode,
+            'server_ip': self.server_ip,
+            'http_boot_url': self.http_boot_url,
+            'mtftp_enabled': self.mtftp_enabled,
             'subnet': self.subnet,
             'gateway': self.gateway,
             'dns_server': self.dns_server,
-            'start_time': self.start_time if hasattr(self, 'start_time') else None
+            'start_time': self.start_time if hasattr(self, 'start_time') else None,
+            'tftp': self.tftp_engine.status() if self.tftp_engine else None,
+            'dhcp': self.dhcp_engine.status() if self.dhcp_engine else None,
+            'nbd': self.nbd_engine.status() if self.nbd_engine else None,
+            'overlays': self.overlays.status(),
+            'shared_disks': self.shared_disks.status(),
+            'boot_traces': self.boot_traces.status(),
+            'cache': self.block_cache.status() if self.block_cache else None,
+            'boot_configs': self.boot_configs.status(),
+            'bandwidth': self.bandwidth.status()
         }
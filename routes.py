@@ -1,16 +1,23 @@
 import os
-from flask import render_template, redirect, url_for, flash, request, jsonify, session
+from flask import render_template, redirect, url_for, flash, request, jsonify, session, abort, send_from_directory, Response
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 import uuid
 import logging
 import threading
+from datetime import datetime, timedelta
 
 from app import app, db
-from models import User, Client, VHDImage, NetworkSettings, ClientStats
+from models import User, Client, VHDImage, NetworkSettings, ClientStats, ClientLatestStats, RestorationPoint
 from pxe_server import PXEServer
 from vhd_manager import VHDManager
+from chunk_store import ChunkStore
+from job_queue import JobQueue, JobError
+from io_throttle import boot_latency
+from client_presence import presence
+from stats_rollup import stats_series, start_stats_rollups
+from stats_ingest import stats_row, record_latest_stats
 from network_manager import NetworkManager
 from language_utils import get_user_language, set_user_language, get_direction, translate
 
@@ -18,11 +25,32 @@ from language_utils import get_user_language, set_user_language, get_direction,
 vhd_manager = VHDManager()
 network_manager = NetworkManager()
 pxe_server = None
+job_queue = None
 client_discovery_stop_event = None
 
 # Logger
 logger = logging.getLogger(__name__)
 
+def load_boot_clients():
+    """Return the client fields the PXE server needs to render boot configs"""
+    with app.app_context():
+        rows = db.session.query(Client, VHDImage).outerjoin(VHDImage, Client.vhd_id == VHDImage.id).all()
+        return [{
+            'mac': client.mac_address,
+            'name': client.name,
+            'boot_mode': client.boot_mode,
+            'is_persistent': client.is_persistent,
+            'vhd_id': client.vhd_id,
+            'vhd_name': vhd.name if vhd else None,
+            'vhd_path': vhd.file_path if vhd else None,
+            'is_super_mode': vhd.is_super_mode if vhd else False
+        } for client, vhd in rows]
+
+def invalidate_boot_configs():
+    """Make the PXE server re-render boot configs on the next request"""
+    if pxe_server:
+        pxe_server.invalidate_boot_configs()
+
 # Start PXE server in a separate thread
 def start_pxe_server():
     global pxe_server
@@ -31,13 +59,27 @@ def start_pxe_server():
         settings = NetworkSettings.query.first()
         if settings and settings.tftp_enabled:
             logger.info(f"Starting PXE server with settings: {settings.network_interface}, {settings.tftp_root_dir}")
+            interface_info = network_manager.get_interface_info(settings.network_interface)
             pxe_server = PXEServer(
                 interface=settings.network_interface,
                 tftp_root=settings.tftp_root_dir,
                 dhcp_enabled=settings.dhcp_enabled,
+                dhcp_mode=settings.dhcp_mode,
+                server_ip=interface_info['ipv4'] if interface_info else None,
                 subnet=settings.subnet,
                 gateway=settings.gateway,
-                dns_server=settings.dns_server
+                dns_server=settings.dns_server,
+                caching_enabled=settings.caching_enabled,
+                cache_size_mb=settings.cache_size_mb,
+                mtftp_enabled=settings.mtftp_enabled,
+                mtftp_address=settings.mtftp_address,
+                mtftp_port=settings.mtftp_port,
+                client_loader=load_boot_clients,
+                http_boot_enabled=settings.http_boot_enabled,
+                http_boot_port=settings.http_boot_port,
+                bandwidth_limit_mbps=settings.bandwidth_limit_mbps,
+                nbd_enabled=settings.nbd_enabled,
+                nbd_port=settings.nbd_port
             )
             pxe_server_thread = threading.Thread(target=pxe_server.start)
             pxe_server_thread.daemon = True
@@ -83,6 +125,7 @@ def handle_discovered_clients(clients_list):
                 db.session.add(new_client)
             
             db.session.commit()
+            invalidate_boot_configs()
             logger.info(f"Processed {len(clients_list)} discovered clients")
     except Exception as e:
         logger.error(f"Error processing discovered clients: {e}")
@@ -111,9 +154,122 @@ def start_client_discovery():
                 interval=60  # Check every minute
             )
 
+# Background jobs for long-running VHD operations
+def run_clone_job(job):
+    """Copy a VHD and register the copy once it is complete"""
+    params = job.params
+    strategy = vhd_manager.clone_vhd(params['source_path'], params['target_path'], progress=job.progress)
+    if not strategy:
+        raise JobError(f"could not clone {params['source_path']}")
+    
+    with app.app_context():
+        clone = VHDImage(
+            name=params['name'],
+            description=params['description'],
+            file_path=params['target_path'],
+            size_gb=params['size_gb'],
+            windows_version=params['windows_version'],
+            is_template=False,
+            is_super_mode=params['is_super_mode'],  # Copy super mode setting
+            created_by_id=params['user_id']
+        )
+        db.session.add(clone)
+        db.session.commit()
+        return {'vhd_id': clone.id, 'strategy': strategy}
+
+def run_restoration_point_job(job):
+    """Save a restoration point and record it once it is complete"""
+    params = job.params
+    chunk_store = ChunkStore(params['chunk_store'])
+    backup_path = vhd_manager.create_restoration_point(params['vhd_path'], params['name'], params['description'],
+                                                       params['backup_dir'], chunk_store, progress=job.progress)
+    if not backup_path:
+        raise JobError(f"could not create restoration point {params['name']}")
+    
+    with app.app_context():
+        if not VHDImage.query.get(params['vhd_id']):
+            logger.warning(f"VHD {params['vhd_id']} no longer exists; restoration point kept at {backup_path}")
+            return {'backup_path': backup_path}
+        point = RestorationPoint(
+            vhd_id=params['vhd_id'],
+            name=params['name'],
+            description=params['description'],
+            backup_path=backup_path,
+            created_by_id=params['user_id']
+        )
+        db.session.add(point)
+        db.session.commit()
+        return {'point_id': point.id, 'backup_path': backup_path}
+
+def run_restore_job(job):
+    """Restore a VHD from a restoration point"""
+    params = job.params
+    # The job id lets a resumed restore continue instead of starting over
+    if not vhd_manager.restore_from_point(params['backup_path'], params['vhd_path'],
+                                          progress=job.progress, restore_id=job.id):
+        raise JobError(f"could not restore {params['vhd_path']}")
+    
+    with app.app_context():
+        vhd = VHDImage.query.get(params['vhd_id'])
+        if vhd:
+            vhd.last_modified = db.func.now()
+            db.session.commit()
+    return {'vhd_id': params['vhd_id']}
+
+def run_verify_job(job):
+    """Verify a VHD against its hash manifest, or accept its contents as correct"""
+    params = job.params
+    if params['accept']:
+        status = vhd_manager.accept_vhd_contents(params['vhd_path'], progress=job.progress)
+    else:
+        status = vhd_manager.verify_vhd(params['vhd_path'], full=params['full'], progress=job.progress)
+    if status is None:
+        raise JobError(f"could not verify {params['vhd_path']}")
+    if status['state'] == 'corrupt':
+        raise JobError(f"{len(status['bad_blocks'])} blocks failed verification; "
+                       f"clients will not be able to attach the image")
+    if status['state'] != 'verified':
+        raise JobError("the image changed during verification, try again")
+    return {'vhd_id': params['vhd_id'], 'state': status['state']}
+
+def job_queue_unavailable():
+    """Flash an error if background jobs cannot be queued yet"""
+    if job_queue:
+        return False
+    flash('Background jobs are not available: the job queue has not been started with a VHD storage directory', 'danger')
+    return True
+
+def configure_copy_throttle(settings):
+    """Apply the image copy limits from the settings to the VHD manager"""
+    vhd_manager.configure_copy_throttle(
+        limit_mb_s=settings.copy_limit_mb_s,
+        latency_target_ms=settings.copy_latency_target_ms,
+        low_priority=settings.copy_low_priority,
+        drop_cache=settings.copy_drop_cache
+    )
+
+def start_job_queue():
+    global job_queue
+    
+    with app.app_context():
+        settings = NetworkSettings.query.first()
+        if settings:
+            configure_copy_throttle(settings)
+        if settings and not job_queue:
+            job_queue = JobQueue(os.path.join(settings.vhd_storage_dir, 'jobs'))
+            job_queue.register('clone', run_clone_job)
+            job_queue.register('restoration_point', run_restoration_point_job)
+            job_queue.register('restore', run_restore_job)
+            job_queue.register('verify', run_verify_job)
+            job_queue.start()
+
 # Start the PXE server when the application starts
 # Initialize services on startup
 def initialize_services():
+    # Copies in every worker back off from boot reads served by any of them
+    boot_latency.share(os.path.join(app.instance_path, 'boot-latency'))
+    start_job_queue()
+    start_stats_rollups()
     start_pxe_server()
     start_client_discovery()
     
@@ -143,6 +299,11 @@ def inject_language_utilities():
         't': translate  # Shorter alias for convenience
     }
 
+@app.context_processor
+def inject_client_presence():
+    """Let templates read client online state from the presence table"""
+    return {'client_online': presence.is_online}
+
 # Login and Authentication Routes
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -180,8 +341,9 @@ def logout():
 @login_required
 def dashboard():
     # Get summary statistics
-    total_clients = Client.query.count()
-    online_clients = Client.query.filter_by(is_online=True).count()
+    all_clients = Client.query.all()
+    total_clients = len(all_clients)
+    online_clients = sum(1 for client in all_clients if presence.is_online(client))
     total_vhds = VHDImage.query.count()
     
     # Get recent activities
@@ -203,6 +365,15 @@ def clients():
     vhds = VHDImage.query.all()
     return render_template('clients.html', clients=clients_list, vhds=vhds)
 
+# Time windows offered on the client page
+STATS_WINDOWS = {
+    '1h': timedelta(hours=1),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+    '30d': timedelta(days=30),
+    '1y': timedelta(days=365),
+}
+
 @app.route('/clients/view/<int:client_id>')
 @login_required
 def view_client(client_id):
@@ -217,13 +388,20 @@ def view_client(client_id):
         except:
             hardware_specs = {"error": "Could not parse system information"}
     
-    # Get client statistics
-    stats = ClientStats.query.filter_by(client_id=client.id).order_by(ClientStats.timestamp.desc()).limit(20).all()
+    # Get client statistics at the resolution that suits the window
+    stats_window = request.args.get('window', '1h')
+    if stats_window not in STATS_WINDOWS:
+        stats_window = '1h'
+    since = datetime.utcnow() - STATS_WINDOWS[stats_window]
+    stats_resolution, stats = stats_series(client.id, since)
     
     return render_template('client_detail.html', 
                           client=client, 
                           hardware_specs=hardware_specs, 
-                          stats=stats)
+                          stats=stats,
+                          stats_window=stats_window,
+                          stats_windows=list(STATS_WINDOWS),
+                          stats_resolution=stats_resolution)
 
 @app.route('/clients/add', methods=['POST'])
 @login_required
@@ -258,6 +436,7 @@ def add_client():
     
     db.session.add(new_client)
     db.session.commit()
+    invalidate_boot_configs()
     
     flash(f'Client {name} added successfully', 'success')
     return redirect(url_for('clients'))
@@ -275,6 +454,8 @@ def edit_client(client_id):
     client.post_boot_script = request.form.get('post_boot_script')
     
     db.session.commit()
+    presence.forget(client.id)
+    invalidate_boot_configs()
     flash(f'Client {client.name} updated successfully', 'success')
     return redirect(url_for('clients'))
 
@@ -282,8 +463,13 @@ def edit_client(client_id):
 @login_required
 def delete_client(client_id):
     client = Client.query.get_or_404(client_id)
+    ClientLatestStats.query.filter_by(client_id=client.id).delete()
     db.session.delete(client)
     db.session.commit()
+    presence.forget(client_id)
+    invalidate_boot_configs()
+    if pxe_server:
+        pxe_server.discard_overlay(client.mac_address)
     flash(f'Client {client.name} deleted successfully', 'success')
     return redirect(url_for('clients'))
 
@@ -292,7 +478,7 @@ def delete_client(client_id):
 def reboot_client(client_id):
     client = Client.query.get_or_404(client_id)
     
-    if not client.is_online:
+    if not presence.is_online(client):
         flash(f'Cannot reboot offline client {client.name}', 'danger')
     else:
         # In a real implementation, we would send a reboot command to the client
@@ -363,6 +549,7 @@ def edit_vhd(vhd_id):
     vhd.last_modified = db.func.now()
     
     db.session.commit()
+    invalidate_boot_configs()
     flash(f'VHD {vhd.name} updated successfully', 'success')
     return redirect(url_for('vhd_management'))
 
@@ -382,6 +569,7 @@ def delete_vhd(vhd_id):
     
     db.session.delete(vhd)
     db.session.commit()
+    invalidate_boot_configs()
     flash(f'VHD {vhd.name} deleted successfully', 'success')
     return redirect(url_for('vhd_management'))
 
@@ -394,28 +582,25 @@ def clone_vhd(vhd_id):
     settings = NetworkSettings.query.first()
     new_file_path = os.path.join(settings.vhd_storage_dir, f"{secure_filename(new_name)}.vhd")
     
-    # Create clone record
-    clone_vhd = VHDImage(
-        name=new_name,
-        description=f"Clone of {source_vhd.name}: {source_vhd.description}",
-        file_path=new_file_path,
-        size_gb=source_vhd.size_gb,
-        windows_version=source_vhd.windows_version,
-        is_template=False,
-        is_super_mode=source_vhd.is_super_mode,  # Copy super mode setting
-        created_by_id=current_user.id
-    )
-    
-    db.session.add(clone_vhd)
-    db.session.commit()
-    
-    # In a real implementation, we would actually clone the VHD file here
-    success = vhd_manager.clone_vhd(source_vhd.file_path, new_file_path)
+    if job_queue_unavailable():
+        return redirect(url_for('vhd_management'))
     
-    if success:
-        flash(f'VHD cloned successfully as {new_name}', 'success')
+    # The clone record is created by the job once the copy is complete
+    job = job_queue.submit('clone', {
+        'source_path': source_vhd.file_path,
+        'target_path': new_file_path,
+        'name': new_name,
+        'description': f"Clone of {source_vhd.name}: {source_vhd.description}",
+        'size_gb': source_vhd.size_gb,
+        'windows_version': source_vhd.windows_version,
+        'is_super_mode': source_vhd.is_super_mode,
+        'user_id': current_user.id
+    }, title=f"Clone {source_vhd.name} to {new_name}", key=new_file_path)
+    
+    if job:
+        flash(f'Cloning {source_vhd.name} as {new_name} in the background', 'info')
     else:
-        flash(f'Error cloning VHD to {new_file_path}', 'danger')
+        flash(f'{new_file_path} is already being written by another job', 'warning')
     
     return redirect(url_for('vhd_management'))
 
@@ -426,12 +611,17 @@ def toggle_super_mode(vhd_id):
     
     if vhd.is_super_mode:
         # Disable super mode
+        if vhd_manager.super_mode_in_use(vhd.file_path):
+            flash(f'Super mode cannot be disabled for {vhd.name} while clients are attached', 'warning')
+            return redirect(url_for('vhd_management'))
+        
         commit_changes = 'commit_changes' in request.form
         success = vhd_manager.disable_super_mode(vhd.file_path, commit_changes)
         
         if success:
             vhd.is_super_mode = False
             db.session.commit()
+            invalidate_boot_configs()
             
             if commit_changes:
                 flash(f'Super mode disabled for {vhd.name} and changes committed', 'success')
@@ -448,6 +638,7 @@ def toggle_super_mode(vhd_id):
         if success:
             vhd.is_super_mode = True
             db.session.commit()
+            invalidate_boot_configs()
             flash(f'Super mode enabled for {vhd.name}', 'success')
         else:
             flash(f'Error enabling super mode for {vhd.name}', 'danger')
@@ -463,6 +654,10 @@ def commit_vhd_changes(vhd_id):
         flash(f'VHD {vhd.name} is not in super mode', 'warning')
         return redirect(url_for('vhd_management'))
     
+    if vhd_manager.super_mode_in_use(vhd.file_path):
+        flash(f'Changes for {vhd.name} cannot be committed while clients are attached', 'warning')
+        return redirect(url_for('vhd_management'))
+    
     success = vhd_manager.commit_changes(vhd.file_path)
     
     if success:
@@ -483,6 +678,10 @@ def discard_vhd_changes(vhd_id):
         flash(f'VHD {vhd.name} is not in super mode', 'warning')
         return redirect(url_for('vhd_management'))
     
+    if vhd_manager.super_mode_in_use(vhd.file_path):
+        flash(f'Changes for {vhd.name} cannot be discarded while clients are attached', 'warning')
+        return redirect(url_for('vhd_management'))
+    
     success = vhd_manager.discard_changes(vhd.file_path)
     
     if success:
@@ -492,6 +691,30 @@ def discard_vhd_changes(vhd_id):
     
     return redirect(url_for('vhd_management'))
 
+@app.route('/vhd/verify/<int:vhd_id>', methods=['POST'])
+@login_required
+def verify_vhd(vhd_id):
+    vhd = VHDImage.query.get_or_404(vhd_id)
+    
+    if job_queue_unavailable():
+        return redirect(url_for('vhd_management'))
+    
+    # Hashing a whole image takes far longer than a request may
+    accept = request.form.get('accept') == 'true'
+    job = job_queue.submit('verify', {
+        'vhd_id': vhd.id,
+        'vhd_path': vhd.file_path,
+        'full': request.form.get('full') == 'true',
+        'accept': accept
+    }, title=f"{'Rehash' if accept else 'Verify'} {vhd.name}", key=vhd.file_path)
+    
+    if job:
+        flash(f'Verifying {vhd.name} in the background', 'info')
+    else:
+        flash(f'Another operation is already running on {vhd.name}', 'warning')
+    
+    return redirect(url_for('vhd_management'))
+
 @app.route('/vhd/create_restoration_point/<int:vhd_id>', methods=['POST'])
 @login_required
 def create_restoration_point(vhd_id):
@@ -507,24 +730,23 @@ def create_restoration_point(vhd_id):
     settings = NetworkSettings.query.first()
     backup_dir = os.path.join(settings.vhd_storage_dir, 'backups', str(vhd_id))
     
-    backup_path = vhd_manager.create_restoration_point(vhd.file_path, name, description, backup_dir)
+    if job_queue_unavailable():
+        return redirect(url_for('vhd_management'))
     
-    if backup_path:
-        # Create restoration point record
-        new_point = RestorationPoint(
-            vhd_id=vhd.id,
-            name=name,
-            description=description,
-            backup_path=backup_path,
-            created_by_id=current_user.id
-        )
-        
-        db.session.add(new_point)
-        db.session.commit()
-        
-        flash(f'Restoration point "{name}" created for {vhd.name}', 'success')
+    job = job_queue.submit('restoration_point', {
+        'vhd_id': vhd.id,
+        'vhd_path': vhd.file_path,
+        'name': name,
+        'description': description,
+        'backup_dir': backup_dir,
+        'chunk_store': os.path.join(settings.vhd_storage_dir, 'chunks'),
+        'user_id': current_user.id
+    }, title=f"Restoration point {name} of {vhd.name}", key=vhd.file_path)
+    
+    if job:
+        flash(f'Creating restoration point "{name}" for {vhd.name} in the background', 'info')
     else:
-        flash(f'Error creating restoration point for {vhd.name}', 'danger')
+        flash(f'Another operation is already running on {vhd.name}', 'warning')
     
     return redirect(url_for('vhd_management'))
 
@@ -542,20 +764,25 @@ def restore_from_point(point_id):
     point = RestorationPoint.query.get_or_404(point_id)
     vhd = VHDImage.query.get_or_404(point.vhd_id)
     
-    # Check if any clients are currently using this VHD
-    clients_using_vhd = Client.query.filter_by(vhd_id=vhd.id, is_online=True).count()
+    # Check if any clients are currently using this VHD; the column lags heartbeats
+    clients_using_vhd = sum(1 for client in Client.query.filter_by(vhd_id=vhd.id) if presence.is_online(client))
     if clients_using_vhd > 0:
         flash(f'Cannot restore VHD {vhd.name} because it is in use by {clients_using_vhd} online clients', 'danger')
         return redirect(url_for('restoration_points', vhd_id=vhd.id))
     
-    success = vhd_manager.restore_from_point(point.backup_path, vhd.file_path)
+    if job_queue_unavailable():
+        return redirect(url_for('restoration_points', vhd_id=vhd.id))
     
-    if success:
-        vhd.last_modified = db.func.now()
-        db.session.commit()
-        flash(f'VHD {vhd.name} restored to point "{point.name}"', 'success')
+    job = job_queue.submit('restore', {
+        'vhd_id': vhd.id,
+        'vhd_path': vhd.file_path,
+        'backup_path': point.backup_path
+    }, title=f"Restore {vhd.name} to {point.name}", key=vhd.file_path)
+    
+    if job:
+        flash(f'Restoring VHD {vhd.name} to point "{point.name}" in the background', 'info')
     else:
-        flash(f'Error restoring VHD from point "{point.name}"', 'danger')
+        flash(f'Another operation is already running on {vhd.name}', 'warning')
     
     return redirect(url_for('restoration_points', vhd_id=vhd.id))
 
@@ -575,6 +802,32 @@ def delete_restoration_point(point_id):
     flash(f'Restoration point "{point.name}" deleted', 'success')
     return redirect(url_for('restoration_points', vhd_id=vhd_id))
 
+# HTTP Boot Routes
+@app.route('/boot/<path:filename>')
+def http_boot(filename):
+    """
+    Serve boot files over HTTP for iPXE and UEFI HTTP Boot
+    
+    Generated configs come from memory; files below the TFTP root are
+    streamed with Range and ETag support, never read whole into memory.
+    """
+    if not pxe_server or not pxe_server.http_boot_url:
+        abort(404)
+    
+    data = pxe_server.boot_configs.render(filename)
+    if data is not None:
+        response = Response(data, mimetype='text/plain')
+        response.add_etag()
+        return response.make_conditional(request)
+    
+    response = send_from_directory(pxe_server.tftp_root, filename, conditional=True, etag=True, max_age=0)
+    # Background copies back off when boot file reads get slow
+    response.response = boot_latency.timed_chunks(response.response)
+    if pxe_server.bandwidth.limited:
+        # Share the boot traffic limit with the TFTP sessions
+        response.response = pxe_server.bandwidth.throttled(response.response, request.remote_addr)
+    return response
+
 # Network Settings Routes
 @app.route('/network')
 @login_required
@@ -591,7 +844,15 @@ def update_network_settings():
     
     # Check if critical settings have changed
     if (settings.tftp_enabled != ('tftp_enabled' in request.form) or
+        settings.mtftp_enabled != ('mtftp_enabled' in request.form) or
+        settings.mtftp_address != request.form.get('mtftp_address', settings.mtftp_address) or
+        settings.mtftp_port != int(request.form.get('mtftp_port', settings.mtftp_port)) or
         settings.dhcp_enabled != ('dhcp_enabled' in request.form) or
+        settings.dhcp_mode != request.form.get('dhcp_mode', settings.dhcp_mode) or
+        settings.http_boot_enabled != ('http_boot_enabled' in request.form) or
+        settings.http_boot_port != int(request.form.get('http_boot_port', settings.http_boot_port)) or
+        settings.nbd_enabled != ('nbd_enabled' in request.form) or
+        settings.nbd_port != int(request.form.get('nbd_port', settings.nbd_port)) or
         settings.network_interface != request.form.get('network_interface') or
         settings.subnet != request.form.get('subnet') or
         settings.gateway != request.form.get('gateway') or
@@ -600,7 +861,15 @@ def update_network_settings():
     
     # Update settings
     settings.tftp_enabled = 'tftp_enabled' in request.form
+    settings.mtftp_enabled = 'mtftp_enabled' in request.form
+    settings.mtftp_address = request.form.get('mtftp_address', settings.mtftp_address)
+    settings.mtftp_port = int(request.form.get('mtftp_port', settings.mtftp_port))
     settings.dhcp_enabled = 'dhcp_enabled' in request.form
+    settings.dhcp_mode = request.form.get('dhcp_mode', settings.dhcp_mode)
+    settings.http_boot_enabled = 'http_boot_enabled' in request.form
+    settings.http_boot_port = int(request.form.get('http_boot_port', settings.http_boot_port))
+    settings.nbd_enabled = 'nbd_enabled' in request.form
+    settings.nbd_port = int(request.form.get('nbd_port', settings.nbd_port))
     settings.network_interface = request.form.get('network_interface')
     settings.subnet = request.form.get('subnet')
     settings.gateway = request.form.get('gateway')
@@ -610,9 +879,20 @@ def update_network_settings():
     settings.bandwidth_limit_mbps = int(request.form.get('bandwidth_limit_mbps', 0))
     settings.caching_enabled = 'caching_enabled' in request.form
     settings.cache_size_mb = int(request.form.get('cache_size_mb', 1024))
+    settings.copy_limit_mb_s = int(request.form.get('copy_limit_mb_s', 0))
+    settings.copy_latency_target_ms = int(request.form.get('copy_latency_target_ms', 0))
+    settings.copy_low_priority = 'copy_low_priority' in request.form
+    settings.copy_drop_cache = 'copy_drop_cache' in request.form
+    settings.stats_retention_days = max(2, int(request.form.get('stats_retention_days', 2)))
     settings.last_updated = db.func.now()
     
     db.session.commit()
+    configure_copy_throttle(settings)
+    
+    # Cache and bandwidth settings apply to a running server without a restart
+    if pxe_server and not restart_required:
+        pxe_server.configure_cache(settings.caching_enabled, settings.cache_size_mb)
+        pxe_server.configure_bandwidth(settings.bandwidth_limit_mbps)
     
     # Restart PXE server if necessary
     if restart_required and pxe_server:
@@ -731,8 +1011,8 @@ def client_status():
         'id': client.id,
         'name': client.name,
         'mac_address': client.mac_address,
-        'ip_address': client.ip_address,
-        'is_online': client.is_online,
+        'ip_address': presence.get(client)['ip_address'],
+        'is_online': presence.is_online(client),
         'vhd_name': client.vhd.name if client.vhd else "No VHD assigned"
     } for client in clients]
     
@@ -741,8 +1021,8 @@ def client_status():
 @app.route('/api/clients/stats/<int:client_id>', methods=['GET'])
 @login_required
 def client_stats(client_id):
-    # Get the most recent stats for this client
-    stats = ClientStats.query.filter_by(client_id=client_id).order_by(ClientStats.timestamp.desc()).first()
+    # Get the most recent stats for this client, kept current on ingest
+    stats = ClientLatestStats.query.get(client_id)
     
     if stats:
         return jsonify({
@@ -757,6 +1037,36 @@ def client_stats(client_id):
             'error': 'No stats available for this client'
         }), 404
 
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    """Background jobs and their progress, from the job records every worker shares"""
+    active_only = request.args.get('active') == '1'
+    return jsonify(job_queue.jobs(active_only=active_only) if job_queue else [])
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    job = job_queue.get(job_id) if job_queue else None
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    if not job_queue or not job_queue.cancel(job_id):
+        return jsonify({'error': 'Job is not queued or running'}), 404
+    return jsonify({'success': True})
+
+@app.route('/api/boot_traces', methods=['GET'])
+@login_required
+def boot_trace_metrics():
+    """Boot trace coverage and prefetch hit rate per exported image"""
+    if not pxe_server:
+        return jsonify({'error': 'PXE server is not running'}), 503
+    return jsonify(pxe_server.boot_traces.status())
+
 @app.route('/api/clients/update_status', methods=['POST'])
 def update_client_status():
     """API endpoint for clients to update their status"""
@@ -783,6 +1093,8 @@ def update_client_status():
         client.last_shutdown = db.func.now()
     
     db.session.commit()
+    # The row is current again; drop any heartbeat state that would override it
+    presence.forget(client.id)
     
     return jsonify({'success': True})
 
@@ -804,6 +1116,7 @@ def submit_client_stats():
     # Create new stats record
     stats = ClientStats(
         client_id=client.id,
+        timestamp=datetime.utcnow(),
         cpu_usage=data.get('cpu_usage'),
         memory_usage_mb=data.get('memory_usage_mb'),
         network_rx_mbps=data.get('network_rx_mbps'),
@@ -811,6 +1124,7 @@ def submit_client_stats():
     )
     
     db.session.add(stats)
+    record_latest_stats([stats_row(stats)])
     db.session.commit()
     
     return jsonify({'success': True})
@@ -7,13 +7,19 @@ import os
 import uuid
 import logging
 import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import request, jsonify, Blueprint
+from sqlalchemy import bindparam
 from flask_login import login_required, current_user
 from werkzeug.security import check_password_hash
 from app import app, db
-from models import Client, ClientStats, ClientCommand, ApiToken
+from models import Client, ClientStats, ClientLatestStats, ClientCommand, ApiToken, NetworkSettings
+from chunk_store import ChunkStore
+from api_tokens import TokenCache
+from client_presence import presence
+from stats_ingest import stats_queue, STAT_FIELDS, stats_row, record_latest_stats
+from stats_rollup import stats_series, earliest_sample_time
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -21,6 +27,22 @@ logger = logging.getLogger(__name__)
 # Create Blueprint
 api = Blueprint('api', __name__)
 
+def load_api_token(token):
+    """Look up a token that is not revoked; returns (token_id, client_id) or None"""
+    token_record = ApiToken.query.filter_by(token=token, is_revoked=False).first()
+    return (token_record.id, token_record.client_id) if token_record else None
+
+def flush_token_usage(last_used):
+    """Write coalesced last_used times of many tokens in one batched UPDATE"""
+    table = ApiToken.__table__
+    statement = table.update().where(table.c.id == bindparam('token_id')).values(last_used=bindparam('used_at'))
+    with app.app_context():
+        db.session.execute(statement, [{'token_id': token_id, 'used_at': used_at}
+                                       for token_id, used_at in last_used.items()])
+        db.session.commit()
+
+token_cache = TokenCache(load_api_token, flush_token_usage)
+
 # Helper function to validate API token
 def require_api_token(func):
     @wraps(func)
@@ -32,14 +54,9 @@ def require_api_token(func):
             
         token = auth_header.replace('Bearer ', '')
         
-        # Check if token exists in database
-        token_record = ApiToken.query.filter_by(token=token).first()
-        if not token_record or token_record.is_revoked:
+        # Cached lookup; last_used is written back in batches
+        if token_cache.validate(token) is None:
             return jsonify({'error': 'Invalid token'}), 401
-            
-        # Update last used timestamp
-        token_record.last_used = db.func.now()
-        db.session.commit()
         
         return func(*args, **kwargs)
     return decorated_function
@@ -126,19 +143,22 @@ def client_heartbeat():
         
         if not client_id or not mac_address:
             return jsonify({'error': 'Client ID and MAC address are required'}), 400
-            
-        # Find client
-        client = Client.query.get(client_id)
         
-        if not client or client.mac_address != mac_address:
-            return jsonify({'error': 'Client not found or MAC address mismatch'}), 404
+        try:
+            client_id = int(client_id)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid client ID'}), 400
             
-        # Update client status
-        client.is_online = True
-        client.ip_address = ip_address
-        client.last_seen = db.func.now()
-        
-        db.session.commit()
+        # Presence is kept in memory and written back in batches
+        if not presence.heartbeat(client_id, mac_address, ip_address):
+            # First heartbeat since startup: check the client once
+            client = Client.query.get(client_id)
+            
+            if not client or client.mac_address != mac_address:
+                return jsonify({'error': 'Client not found or MAC address mismatch'}), 404
+                
+            presence.track(client.id, client.mac_address)
+            presence.heartbeat(client_id, mac_address, ip_address)
         
         return jsonify({'status': 'ok'}), 200
         
@@ -170,7 +190,8 @@ def submit_client_stats():
             
         # Create stats record
         stats = ClientStats(
-            client_id=client_id,
+            client_id=client.id,
+            timestamp=datetime.utcnow(),
             cpu_usage=data.get('cpu_usage'),
             memory_usage_mb=data.get('memory_usage_mb'),
             network_rx_mbps=data.get('network_rx_mbps'),
@@ -178,6 +199,7 @@ def submit_client_stats():
         )
         
         db.session.add(stats)
+        record_latest_stats([stats_row(stats)])
         db.session.commit()
         
         return jsonify({'status': 'ok'}), 200
@@ -186,6 +208,76 @@ def submit_client_stats():
         logger.error(f"Error submitting stats: {e}")
         return jsonify({'error': 'Server error'}), 500
 
+# Most samples accepted in one batch request
+MAX_BATCH_SAMPLES = 5000
+# Samples stamped this far ahead of the server clock are still accepted
+MAX_CLOCK_SKEW = timedelta(minutes=1)
+
+def parse_stats_sample(sample):
+    """Turn one submitted sample into a ClientStats row; raises ValueError if malformed"""
+    row = {'client_id': int(sample['client_id'])}
+    timestamp = sample.get('timestamp')
+    # Samples are batched on the client, so keep the time they were taken
+    if timestamp:
+        taken = datetime.fromisoformat(timestamp)
+        if taken.tzinfo is not None:
+            # Stored timestamps are naive UTC
+            taken = taken.astimezone(timezone.utc).replace(tzinfo=None)
+        row['timestamp'] = taken
+    else:
+        row['timestamp'] = datetime.utcnow()
+    for field in STAT_FIELDS:
+        value = sample.get(field)
+        row[field] = float(value) if value is not None else None
+    return row
+
+# Clients or relays submit many stats samples at once
+@api.route('/client/stats/batch', methods=['POST'])
+@require_api_token
+def submit_client_stats_batch():
+    """Queue a batch of stats samples, possibly from many clients"""
+    try:
+        data = request.json
+        samples = data.get('samples') if isinstance(data, dict) else None
+        
+        if not isinstance(samples, list) or not samples:
+            return jsonify({'error': 'A non-empty samples list is required'}), 400
+            
+        if len(samples) > MAX_BATCH_SAMPLES:
+            return jsonify({'error': f'At most {MAX_BATCH_SAMPLES} samples per request'}), 413
+            
+        try:
+            rows = [parse_stats_sample(sample) for sample in samples]
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid sample: {e}'}), 400
+            
+        # One query checks every client the batch mentions
+        client_ids = {row['client_id'] for row in rows}
+        known = {client_id for client_id, in db.session.query(Client.id).filter(Client.id.in_(client_ids))}
+        # Future samples would pin the latest stats; old ones would never be rolled up
+        now = datetime.utcnow()
+        earliest = earliest_sample_time(now)
+        latest = now + MAX_CLOCK_SKEW
+        accepted = [row for row in rows
+                    if row['client_id'] in known and earliest <= row['timestamp'] <= latest]
+        
+        if accepted and not stats_queue.offer(accepted):
+            # Backpressure: the writer is behind, try again later
+            retry_after = stats_queue.retry_after()
+            response = jsonify({'error': 'Stats queue is full', 'retry_after': retry_after})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+            
+        return jsonify({
+            'status': 'queued',
+            'accepted': len(accepted),
+            'ignored': len(rows) - len(accepted)
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error queueing stats batch: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
 # Get commands for client
 @api.route('/client/commands', methods=['GET'])
 @require_api_token
@@ -260,30 +352,48 @@ def list_client_stats():
     try:
         client_id = request.args.get('client_id')
         limit = int(request.args.get('limit', 100))
+        hours = request.args.get('hours')
         
-        if client_id:
-            # Get stats for specific client
-            stats = ClientStats.query.filter_by(client_id=client_id).order_by(
-                ClientStats.timestamp.desc()).limit(limit).all()
-            
+        if client_id and hours:
+            # A time window is served from raw samples or rollups, whichever fits its length
             client = Client.query.get(client_id)
             if not client:
                 return jsonify({'error': 'Client not found'}), 404
                 
-            client_name = client.name
-        else:
-            # Get most recent stats for all clients
-            stats = []
-            clients = Client.query.all()
+            since = datetime.utcnow() - timedelta(hours=float(hours))
+            resolution, points = stats_series(client.id, since)
             
-            for client in clients:
-                recent_stat = ClientStats.query.filter_by(client_id=client.id).order_by(
-                    ClientStats.timestamp.desc()).first()
-                    
-                if recent_stat:
-                    stats.append(recent_stat)
+            return jsonify({
+                'client_id': client.id,
+                'client_name': client.name,
+                'resolution': resolution,
+                'stats': [dict(point, timestamp=point['timestamp'].isoformat()) for point in points]
+            }), 200
+        
+        if not client_id:
+            # Latest sample of every client: one read of client_latest_stats
+            latest = ClientLatestStats.query.join(Client, Client.id == ClientLatestStats.client_id).all()
             
-            client_name = None
+            return jsonify({
+                'client_id': None,
+                'client_name': None,
+                'stats': [
+                    dict({field: getattr(stat, field) for field in STAT_FIELDS},
+                         client_id=stat.client_id,
+                         timestamp=stat.timestamp.isoformat())
+                    for stat in latest
+                ]
+            }), 200
+        
+        # Get stats for specific client
+        stats = ClientStats.query.filter_by(client_id=client_id).order_by(
+            ClientStats.timestamp.desc()).limit(limit).all()
+        
+        client = Client.query.get(client_id)
+        if not client:
+            return jsonify({'error': 'Client not found'}), 404
+            
+        client_name = client.name
         
         result = {
             'client_id': client_id,
@@ -307,6 +417,13 @@ def list_client_stats():
         logger.error(f"Error listing client stats: {e}")
         return jsonify({'error': 'Server error'}), 500
 
+# Stats ingestion queue counters
+@api.route('/admin/stats_queue', methods=['GET'])
+@login_required
+def stats_queue_status():
+    """Depth, backpressure and write rate of the stats ingestion queue"""
+    return jsonify(stats_queue.status()), 200
+
 # Send command to client
 @api.route('/admin/client_commands', methods=['POST'])
 @login_required
@@ -352,5 +469,53 @@ def send_client_command():
         logger.error(f"Error sending command: {e}")
         return jsonify({'error': 'Server error'}), 500
 
+# Revoke a client's API tokens
+@api.route('/admin/clients/<int:client_id>/revoke_tokens', methods=['POST'])
+@login_required
+def revoke_client_tokens(client_id):
+    """Revoke every API token of a client; it has to register again"""
+    try:
+        tokens = ApiToken.query.filter_by(client_id=client_id, is_revoked=False).all()
+        for token_record in tokens:
+            token_record.is_revoked = True
+            token_record.revoked_at = db.func.now()
+        db.session.commit()
+        token_cache.invalidate(client_id=client_id)
+        
+        return jsonify({'status': 'ok', 'revoked': len(tokens)}), 200
+        
+    except Exception as e:
+        logger.error(f"Error revoking tokens: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+def get_chunk_store():
+    """Open the chunk store under the configured VHD storage directory"""
+    settings = NetworkSettings.query.first()
+    return ChunkStore(os.path.join(settings.vhd_storage_dir, 'chunks'))
+
+# Deduplication report for the chunk store
+@api.route('/admin/chunk_store', methods=['GET'])
+@login_required
+def chunk_store_report():
+    """Report logical vs stored size of images and restoration points"""
+    try:
+        return jsonify(get_chunk_store().report()), 200
+    except Exception as e:
+        logger.error(f"Error building chunk store report: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
+# Remove chunks no manifest references
+@api.route('/admin/chunk_store/gc', methods=['POST'])
+@login_required
+def chunk_store_gc():
+    """Run a garbage collection pass over the chunk store"""
+    try:
+        data = request.json or {}
+        result = get_chunk_store().gc(grace_seconds=int(data.get('grace_seconds', 3600)))
+        return jsonify({'status': 'ok', **result}), 200
+    except Exception as e:
+        logger.error(f"Error collecting chunk store garbage: {e}")
+        return jsonify({'error': 'Server error'}), 500
+
 # Register the blueprint
 app.register_blueprint(api, url_prefix='/api')
\ No newline at end of file
@@ -91,10 +91,29 @@ def copy_files():
             'models.py',
             'routes.py',
             'routes_api.py',
+            'api_tokens.py',
+            'client_presence.py',
+            'stats_ingest.py',
+            'stats_rollup.py',
             'translations.py',
             'language_utils.py',
             'network_manager.py',
             'pxe_server.py',
+            'tftp_server.py',
+            'dhcp_server.py',
+            'boot_cache.py',
+            'boot_config.py',
+            'bandwidth.py',
+            'io_throttle.py',
+            'nbd_server.py',
+            'write_overlay.py',
+            'vhd_format.py',
+            'file_clone.py',
+            'chunk_store.py',
+            'block_tracking.py',
+            'image_integrity.py',
+            'boot_trace.py',
+            'job_queue.py',
             'vhd_manager.py',
         ]
         
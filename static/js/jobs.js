@@ -0,0 +1,101 @@
+// Background job progress for long-running VHD operations
+
+document.addEventListener('DOMContentLoaded', function() {
+    if (document.getElementById('jobsPanel')) {
+        refreshJobs();
+    }
+});
+
+let jobsTimer = null;
+let jobsWereActive = false;
+let watchedJobIds = [];
+
+// Poll the job list while anything is queued or running
+function refreshJobs() {
+    fetch('/api/jobs?active=1')
+        .then(response => response.json())
+        .then(jobs => {
+            renderJobs(jobs);
+            watchedJobIds = [...new Set(watchedJobIds.concat(jobs.map(job => job.id)))];
+            if (jobs.length > 0) {
+                jobsWereActive = true;
+                jobsTimer = setTimeout(refreshJobs, 2000);
+            } else if (jobsWereActive) {
+                // Report failures, then show the records the finished jobs created
+                reportFinishedJobs().finally(() => window.location.reload());
+            }
+        })
+        .catch(error => {
+            console.error('Error fetching jobs:', error);
+            jobsTimer = setTimeout(refreshJobs, 10000);
+        });
+}
+
+// Render progress bars for active jobs
+function renderJobs(jobs) {
+    const panel = document.getElementById('jobsPanel');
+    const list = document.getElementById('jobsList');
+    panel.classList.toggle('d-none', jobs.length === 0);
+
+    list.innerHTML = jobs.map(job => {
+        const percent = job.total_bytes ? Math.floor(job.done_bytes * 100 / job.total_bytes) : 0;
+        const done = formatJobBytes(job.done_bytes);
+        const total = job.total_bytes ? formatJobBytes(job.total_bytes) : '?';
+        const label = job.state === 'queued' ? 'Queued' :
+            job.cancel_requested ? 'Cancelling...' : `${done} of ${total}`;
+        return `
+            <div class="mb-3">
+                <div class="d-flex justify-content-between align-items-center mb-1">
+                    <span>${escapeJobText(job.title)}${job.attempts > 1 ? ' <span class="badge bg-info">Resumed</span>' : ''}</span>
+                    <span>
+                        <small class="text-muted me-2">${label}</small>
+                        <button type="button" class="btn btn-sm btn-outline-danger" onclick="cancelJob('${job.id}')"
+                                ${job.cancel_requested ? 'disabled' : ''} title="Cancel">
+                            <i class="fas fa-times"></i>
+                        </button>
+                    </span>
+                </div>
+                <div class="progress">
+                    <div class="progress-bar ${job.state === 'running' ? 'progress-bar-striped progress-bar-animated' : ''}"
+                         role="progressbar" style="width: ${percent}%">${percent}%</div>
+                </div>
+            </div>
+        `;
+    }).join('');
+}
+
+// Tell the user about watched jobs that failed, such as an image failing verification
+function reportFinishedJobs() {
+    return Promise.all(watchedJobIds.map(id =>
+        fetch(`/api/jobs/${id}`).then(response => response.ok ? response.json() : null)
+    )).then(jobs => {
+        const failed = jobs.filter(job => job && job.state === 'failed');
+        if (failed.length > 0) {
+            alert(failed.map(job => `${job.title} failed: ${job.error}`).join('\n'));
+        }
+    });
+}
+
+// Ask the server to cancel a job
+function cancelJob(jobId) {
+    if (!confirm('Cancel this operation?')) {
+        return;
+    }
+    fetch(`/api/jobs/${jobId}/cancel`, { method: 'POST' })
+        .then(() => {
+            clearTimeout(jobsTimer);
+            refreshJobs();
+        })
+        .catch(error => console.error('Error cancelling job:', error));
+}
+
+function formatJobBytes(bytes) {
+    if (bytes >= 1024 ** 3) return `${(bytes / 1024 ** 3).toFixed(1)} GB`;
+    return `${(bytes / 1024 ** 2).toFixed(0)} MB`;
+}
+
+function escapeJobText(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
@@ -0,0 +1,239 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import app, db
+from models import ClientStats, ClientLatestStats
+
+logger = logging.getLogger(__name__)
+
+STAT_FIELDS = ('cpu_usage', 'memory_usage_mb', 'network_rx_mbps', 'network_tx_mbps')
+STATS_COLUMNS = ('client_id', 'timestamp') + STAT_FIELDS
+# Samples waiting to be written; a request that does not fit is refused
+QUEUE_CAPACITY = 50000
+# Rows written per transaction
+BATCH_SIZE = 2000
+# A partial batch is written after waiting this long
+FLUSH_INTERVAL = 1.0
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+_UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+class StatsIngestQueue:
+    """
+    Bounded queue of client stats samples, written in batches
+
+    Requests only append samples; one writer thread takes up to BATCH_SIZE
+    of them at a time and inserts them with a single executemany in one
+    transaction. When the writer falls behind the queue fills up and
+    offer() refuses whole requests, so clients back off instead of the
+    server buffering without limit.
+
+    A batch the database rejects is logged and dropped; telemetry is not
+    worth blocking the queue for.
+    """
+
+    def __init__(self, writer, capacity=QUEUE_CAPACITY, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        """
+        Args:
+            writer (callable): Called with a list of row dicts; raises if
+                they could not be written
+            capacity (int): Most samples waiting at once
+            batch_size (int): Most rows per write
+            flush_interval (float): Seconds a partial batch may wait
+        """
+        self.writer = writer
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._samples = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._writing = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+
+    @property
+    def depth(self):
+        return len(self._samples)
+
+    def offer(self, rows):
+        """
+        Queue rows, all or none
+
+        Args:
+            rows (list): Row dicts ready for the writer
+
+        Returns:
+            bool: False if the queue has no room for all of them
+        """
+        with self._cond:
+            if len(self._samples) + len(rows) > self.capacity:
+                self.rejected += len(rows)
+                return False
+            self._samples.extend(rows)
+            self.accepted += len(rows)
+            if len(self._samples) >= self.batch_size:
+                self._cond.notify()
+        self._start()
+        return True
+
+    def retry_after(self):
+        """Seconds a refused client should wait: the time to drain the queue"""
+        rate = self.written / self.write_seconds if self.write_seconds else 0
+        if not rate:
+            return 5
+        return max(1, min(60, int(self.depth / rate) + 1))
+
+    def flush(self):
+        """Write everything queued so far from the calling thread"""
+        while self._write_batch():
+            pass
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+
+    def _take(self):
+        with self._cond:
+            count = min(self.batch_size, len(self._samples))
+            batch = [self._samples.popleft() for _ in range(count)]
+            if batch:
+                self._writing += 1
+            return batch
+
+    def _write_batch(self):
+        batch = self._take()
+        if not batch:
+            return False
+        started = time.monotonic()
+        try:
+            self.writer(batch)
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} client stats samples: {e}")
+            self.dropped += len(batch)
+        else:
+            self.written += len(batch)
+            self.batches += 1
+            self.write_seconds += time.monotonic() - started
+        finally:
+            with self._cond:
+                self._writing -= 1
+                self._cond.notify_all()
+        return True
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='stats-ingest')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._samples) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+            while self._write_batch():
+                if len(self._samples) < self.batch_size:
+                    break
+
+    def status(self):
+        """Return queue counters for monitoring"""
+        return {
+            'depth': self.depth,
+            'capacity': self.capacity,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'rows_per_second': self.written / self.write_seconds if self.write_seconds else None,
+        }
+
+
+def stats_row(stats):
+    """Row dict of a ClientStats object, as record_latest_stats() takes it"""
+    return {column: getattr(stats, column) for column in STATS_COLUMNS}
+
+
+def record_latest_stats(rows):
+    """
+    Bring client_latest_stats up to the newest sample of each client in rows
+
+    Runs in the caller's transaction as one upsert, so two writers seeing
+    a client's first sample at once cannot fail each other's transaction
+    (and with it the raw samples). A stored sample newer than the
+    submitted one is left alone, so a late batch cannot move a client back
+    in time.
+
+    Databases without ON CONFLICT get a batched UPDATE for clients that
+    already have a row and an INSERT for the rest; an INSERT that loses a
+    race is rolled back to a savepoint and retried as the UPDATE.
+
+    Args:
+        rows (list): Row dicts with at least STATS_COLUMNS
+    """
+    newest = {}
+    for row in rows:
+        current = newest.get(row['client_id'])
+        if current is None or row['timestamp'] >= current['timestamp']:
+            newest[row['client_id']] = row
+    if not newest:
+        return
+
+    table = ClientLatestStats.__table__
+    upsert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if upsert is not None:
+        statement = upsert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.client_id],
+            set_={column: statement.excluded[column] for column in STATS_COLUMNS if column != 'client_id'},
+            where=table.c.timestamp <= statement.excluded.timestamp)
+        db.session.execute(statement, [{column: row[column] for column in STATS_COLUMNS}
+                                       for row in newest.values()])
+        return
+
+    existing = {client_id for client_id, in
+                db.session.query(table.c.client_id).filter(table.c.client_id.in_(list(newest)))}
+    update = table.update().where(
+        table.c.client_id == bindparam('b_client_id'),
+        table.c.timestamp <= bindparam('b_timestamp')
+    ).values(**{column: bindparam(f'b_{column}') for column in STATS_COLUMNS if column != 'client_id'})
+    updates = [{f'b_{column}': row[column] for column in STATS_COLUMNS}
+               for client_id, row in newest.items() if client_id in existing]
+    inserts = [row for client_id, row in newest.items() if client_id not in existing]
+
+    if updates:
+        db.session.execute(update, updates)
+    if inserts:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert(), [{column: row[column] for column in STATS_COLUMNS}
+                                                    for row in inserts])
+        except IntegrityError:
+            # Another writer inserted first; its row now exists to update
+            db.session.execute(update, [{f'b_{column}': row[column] for column in STATS_COLUMNS}
+                                        for row in inserts])
+
+
+def insert_stats(rows):
+    """Insert many ClientStats rows with one executemany in one transaction"""
+    with app.app_context():
+        db.session.execute(ClientStats.__table__.insert(), rows)
+        record_latest_stats(rows)
+        db.session.commit()
+
+
+stats_queue = StatsIngestQueue(insert_stats)
@@ -0,0 +1,269 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from app import app, db
+from models import ClientStats, ClientStatsRollup, NetworkSettings
+from stats_ingest import STAT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = (('1m', 60), ('1h', 3600), ('1d', 86400))
+RESOLUTION_SECONDS = dict(RESOLUTIONS)
+# Rollups older than this are deleted; daily rollups are kept for good
+ROLLUP_RETENTION = {'1m': timedelta(days=30), '1h': timedelta(days=365), '1d': None}
+# Raw rows must outlive the widest bucket so every rollup is computed from raw samples
+MIN_RAW_RETENTION = timedelta(days=2)
+# Batched samples arrive late; a bucket is rolled up this long after it ends
+LATE_GRACE = timedelta(minutes=2)
+ROLLUP_INTERVAL = 60.0
+# Raw samples are served for windows up to this long, rollups beyond
+RAW_WINDOW = timedelta(hours=6)
+# Finest rollup that keeps a series below this many points is used
+MAX_POINTS = 1500
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(timestamp, seconds):
+    """Start of the bucket of the given width that contains timestamp"""
+    offset = int((timestamp - EPOCH).total_seconds()) // seconds * seconds
+    return EPOCH + timedelta(seconds=offset)
+
+
+def summarize(values):
+    """Min, max, mean and nearest-rank 95th percentile of some values"""
+    if not values:
+        return None, None, None, None
+    values = sorted(values)
+    p95 = values[max(0, -(-len(values) * 95 // 100) - 1)]
+    return values[0], values[-1], sum(values) / len(values), p95
+
+
+def rollup_range(resolution, start, end):
+    """
+    Roll raw samples with start <= timestamp < end up into buckets
+
+    Clients are read one at a time, so memory stays bounded by one
+    client's samples in the range.
+
+    Returns:
+        int: Rollup rows written
+    """
+    seconds = RESOLUTION_SECONDS[resolution]
+    in_range = (ClientStats.timestamp >= start, ClientStats.timestamp < end)
+    client_ids = [client_id for client_id, in
+                  db.session.query(ClientStats.client_id).filter(*in_range).distinct()]
+    columns = [getattr(ClientStats, field) for field in STAT_FIELDS]
+
+    written = 0
+    for client_id in client_ids:
+        buckets = {}
+        samples = db.session.query(ClientStats.timestamp, *columns).filter(
+            ClientStats.client_id == client_id, *in_range)
+        for timestamp, *values in samples:
+            buckets.setdefault(bucket_start(timestamp, seconds), []).append(values)
+
+        rows = []
+        for start_time, bucket in buckets.items():
+            row = {'client_id': client_id, 'resolution': resolution,
+                   'bucket_start': start_time, 'samples': len(bucket)}
+            for index, field in enumerate(STAT_FIELDS):
+                values = [values[index] for values in bucket if values[index] is not None]
+                (row[f'{field}_min'], row[f'{field}_max'],
+                 row[f'{field}_avg'], row[f'{field}_p95']) = summarize(values)
+            rows.append(row)
+        if rows:
+            db.session.execute(ClientStatsRollup.__table__.insert(), rows)
+            written += len(rows)
+    return written
+
+
+def rollup_watermark(resolution):
+    """End of the last bucket rolled up at a resolution, or None"""
+    last = db.session.query(func.max(ClientStatsRollup.bucket_start)).filter(
+        ClientStatsRollup.resolution == resolution).scalar()
+    return last + timedelta(seconds=RESOLUTION_SECONDS[resolution]) if last else None
+
+
+def earliest_sample_time(now=None):
+    """
+    Oldest timestamp a newly submitted raw sample may have
+
+    Older samples would fall into buckets that are already rolled up, or
+    past raw retention, and never show up in any series.
+    """
+    now = now or datetime.utcnow()
+    settings = NetworkSettings.query.first()
+    retention_days = settings.stats_retention_days if settings else 0
+    earliest = now - max(timedelta(days=retention_days or 0), MIN_RAW_RETENTION)
+    watermark = rollup_watermark(RESOLUTIONS[0][0])
+    return max(earliest, watermark) if watermark else earliest
+
+
+def run_rollups(now=None):
+    """
+    Roll up every complete bucket not rolled up yet, at every resolution
+
+    Returns:
+        dict: Rollup rows written per resolution
+    """
+    now = now or datetime.utcnow()
+    oldest = db.session.query(func.min(ClientStats.timestamp)).scalar()
+    written = {}
+    for resolution, seconds in RESOLUTIONS:
+        end = bucket_start(now - LATE_GRACE, seconds)
+        start = rollup_watermark(resolution)
+        if start is None and oldest is not None:
+            start = bucket_start(oldest, seconds)
+        if start is None or start >= end:
+            continue
+        written[resolution] = rollup_range(resolution, start, end)
+    db.session.commit()
+    return written
+
+
+def prune_stats(retention_days, now=None):
+    """
+    Delete raw samples past retention and rollups past ROLLUP_RETENTION
+
+    Raw samples are only deleted once the daily rollup covers them.
+
+    Returns:
+        int: Raw rows deleted
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - max(timedelta(days=retention_days or 0), MIN_RAW_RETENTION)
+    covered = rollup_watermark('1d')
+    deleted = 0
+    if covered:
+        deleted = ClientStats.query.filter(ClientStats.timestamp < min(cutoff, covered)).delete(
+            synchronize_session=False)
+    for resolution, keep in ROLLUP_RETENTION.items():
+        if keep:
+            ClientStatsRollup.query.filter(ClientStatsRollup.resolution == resolution,
+                                           ClientStatsRollup.bucket_start < now - keep).delete(
+                synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def choose_resolution(since, until, retention_days, now=None):
+    """
+    Pick the data source for a stats window
+
+    Raw samples for short windows still within retention, otherwise the
+    finest rollup that is kept that far back and stays under MAX_POINTS.
+
+    Returns:
+        str: 'raw', '1m', '1h' or '1d'
+    """
+    now = now or datetime.utcnow()
+    raw_kept = max(timedelta(days=retention_days or 0), MIN_RAW_RETENTION)
+    if until - since <= RAW_WINDOW and since >= now - raw_kept:
+        return 'raw'
+    for resolution, seconds in RESOLUTIONS:
+        keep = ROLLUP_RETENTION[resolution]
+        if (until - since).total_seconds() / seconds <= MAX_POINTS and (keep is None or since >= now - keep):
+            return resolution
+    return RESOLUTIONS[-1][0]
+
+
+def stats_series(client_id, since, until=None, retention_days=None):
+    """
+    A client's stats over a window, at the resolution that suits its length
+
+    Raw points carry the sampled values. Rollup points carry the bucket
+    average under the same names, plus _min, _max and _p95 variants and
+    the number of samples.
+
+    Args:
+        client_id (int): Client
+        since (datetime): Window start (UTC)
+        until (datetime, optional): Window end, now by default
+        retention_days (int, optional): Raw retention; read from settings if omitted
+
+    Returns:
+        tuple: (resolution, list of point dicts, oldest first)
+    """
+    until = until or datetime.utcnow()
+    if retention_days is None:
+        settings = NetworkSettings.query.first()
+        retention_days = settings.stats_retention_days if settings else 0
+    resolution = choose_resolution(since, until, retention_days)
+
+    if resolution == 'raw':
+        rows = ClientStats.query.filter(ClientStats.client_id == client_id,
+                                        ClientStats.timestamp >= since,
+                                        ClientStats.timestamp < until).order_by(ClientStats.timestamp).all()
+        return resolution, [dict({field: getattr(row, field) for field in STAT_FIELDS}, timestamp=row.timestamp)
+                            for row in rows]
+
+    rows = ClientStatsRollup.query.filter(ClientStatsRollup.client_id == client_id,
+                                          ClientStatsRollup.resolution == resolution,
+                                          ClientStatsRollup.bucket_start >= bucket_start(since, RESOLUTION_SECONDS[resolution]),
+                                          ClientStatsRollup.bucket_start < until).order_by(
+        ClientStatsRollup.bucket_start).all()
+    points = []
+    for row in rows:
+        point = {'timestamp': row.bucket_start, 'samples': row.samples}
+        for field in STAT_FIELDS:
+            point[field] = getattr(row, f'{field}_avg')
+            for suffix in ('min', 'max', 'p95'):
+                point[f'{field}_{suffix}'] = getattr(row, f'{field}_{suffix}')
+        points.append(point)
+    return resolution, points
+
+
+def _take_rollup_lock(path):
+    """
+    Try to become the one process that rolls up and prunes
+
+    Returns:
+        int: Descriptor holding the lock for the life of the process, or
+            None if another process holds it
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _rollup_loop(interval):
+    # Every worker process starts this loop; only the lock holder does the work,
+    # and another takes over if it exits
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock_path = os.path.join(app.instance_path, 'stats-rollup.lock')
+    lock_fd = None
+    while True:
+        time.sleep(interval)
+        if lock_fd is None:
+            lock_fd = _take_rollup_lock(lock_path)
+            if lock_fd is None:
+                continue
+        with app.app_context():
+            try:
+                written = run_rollups()
+                settings = NetworkSettings.query.first()
+                deleted = prune_stats(settings.stats_retention_days if settings else 0)
+                if written or deleted:
+                    logger.debug(f"Client stats rollups {written}, pruned {deleted} raw rows")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Client stats rollup failed: {e}")
+
+
+def start_stats_rollups(interval=ROLLUP_INTERVAL):
+    """Roll up and prune client stats in a background thread, in one process at a time"""
+    thread = threading.Thread(target=_rollup_loop, args=(interval,), name='stats-rollup')
+    thread.daemon = True
+    thread.start()
+    return thread
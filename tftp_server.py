@@ -0,0 +1,1018 @@
+import os
+import mmap
+import socket
+import struct
+import asyncio
+import logging
+import threading
+import time
+import ipaddress
+from collections import OrderedDict
+
+from boot_cache import CachedSource
+from io_throttle import boot_latency, touch_pages
+
+logger = logging.getLogger(__name__)
+
+# TFTP opcodes (RFC 1350, RFC 2347)
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+# TFTP error codes
+ERR_NOT_DEFINED = 0
+ERR_FILE_NOT_FOUND = 1
+ERR_ACCESS_VIOLATION = 2
+ERR_ILLEGAL_OPERATION = 4
+ERR_UNKNOWN_TID = 5
+ERR_OPTION_NEGOTIATION = 8
+
+DEFAULT_BLKSIZE = 512
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464  # RFC 2348 upper bound
+DEFAULT_TIMEOUT = 3
+MAX_WINDOWSIZE = 65535  # RFC 7440 upper bound
+
+# Retransmission timeout bounds (seconds) and the first congestion window (blocks)
+MIN_RTO = 0.2
+MAX_RTO = 16
+INITIAL_CWND = 4
+
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+def parse_request(packet):
+    """
+    Parse a RRQ/WRQ packet
+
+    Args:
+        packet (bytes): Raw request datagram
+
+    Returns:
+        tuple: (opcode, filename, mode, options) where options maps lowercase
+               option names to their string values
+    """
+    opcode = struct.unpack('!H', packet[:2])[0]
+    fields = packet[2:].split(b'\0')
+    if len(fields) < 3:
+        raise ValueError("Truncated TFTP request")
+
+    filename = fields[0].decode('ascii', errors='replace')
+    mode = fields[1].decode('ascii', errors='replace').lower()
+
+    options = {}
+    pairs = fields[2:-1]
+    for i in range(0, len(pairs) - 1, 2):
+        name = pairs[i].decode('ascii', errors='replace').lower()
+        options[name] = pairs[i + 1].decode('ascii', errors='replace')
+
+    return opcode, filename, mode, options
+
+
+def negotiate_options(requested, file_size, max_blksize=MAX_BLKSIZE, max_windowsize=64):
+    """
+    Negotiate RFC 2347 options for a read request
+
+    Unknown or malformed options are silently ignored, as allowed by RFC 2347.
+
+    Args:
+        requested (dict): Options sent by the client
+        file_size (int): Size of the requested file in bytes
+        max_blksize (int): Largest block size the server will accept
+        max_windowsize (int): Largest window the server will accept
+
+    Returns:
+        dict: Accepted options with the values the server will use
+    """
+    accepted = {}
+
+    if 'blksize' in requested:
+        try:
+            blksize = int(requested['blksize'])
+            if blksize >= MIN_BLKSIZE:
+                accepted['blksize'] = min(blksize, max_blksize, MAX_BLKSIZE)
+        except ValueError:
+            pass
+
+    if 'tsize' in requested:
+        accepted['tsize'] = file_size
+
+    if 'timeout' in requested:
+        try:
+            timeout = int(requested['timeout'])
+            if 1 <= timeout <= 255:
+                accepted['timeout'] = timeout
+        except ValueError:
+            pass
+
+    if 'windowsize' in requested:
+        try:
+            windowsize = int(requested['windowsize'])
+            if windowsize >= 1:
+                accepted['windowsize'] = min(windowsize, max_windowsize, MAX_WINDOWSIZE)
+        except ValueError:
+            pass
+
+    return accepted
+
+
+def build_error(code, message):
+    """Build a TFTP ERROR packet"""
+    return struct.pack('!HH', OP_ERROR, code) + message.encode('ascii', errors='replace') + b'\0'
+
+
+def build_oack(options):
+    """Build a TFTP OACK packet from a dict of accepted options"""
+    body = b''.join(
+        name.encode('ascii') + b'\0' + str(value).encode('ascii') + b'\0'
+        for name, value in options.items()
+    )
+    return struct.pack('!H', OP_OACK) + body
+
+
+class FileSource:
+    """
+    Readable file handed out by the TFTP server
+
+    Sessions only need the size and positional block reads, so alternative
+    sources (in-memory configs, cached files) can be swapped in. This one
+    reads with pread() and is the fallback for files that cannot be mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        st = os.fstat(self._file.fileno())
+        self.size = st.st_size
+        self.key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def read(self, offset, length):
+        """Return up to length bytes starting at offset"""
+        return os.pread(self._file.fileno(), length, offset)
+
+    def close(self):
+        self._file.close()
+
+
+class MemorySource:
+    """Generated file served straight from memory"""
+
+    def __init__(self, path, data, key):
+        self.path = path
+        self.data = data
+        self.size = len(data)
+        self.key = key
+
+    def read(self, offset, length):
+        """Return up to length bytes starting at offset"""
+        return memoryview(self.data)[offset:offset + length]
+
+    def close(self):
+        pass
+
+
+class MappedFile:
+    """
+    Read-only mmap of a boot file shared by every session serving it
+
+    read() returns memoryview slices of the mapping, so blocks go from the
+    page cache to the socket without being copied into the Python heap.
+    """
+
+    def __init__(self, registry, key, path, sequential=True):
+        self.registry = registry
+        self.key = key
+        self.path = path
+        self.refs = 0
+
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # mmap() refuses empty files
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+        if sequential and self._map is not None and hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._view = memoryview(self._map) if self._map is not None else memoryview(b'')
+
+    def read(self, offset, length):
+        """Return a zero-copy view of up to length bytes starting at offset"""
+        return self._view[offset:offset + length]
+
+    def close(self):
+        """Drop this session's reference"""
+        self.registry.release(self)
+
+    def unmap(self):
+        try:
+            self._view.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            # A caller still holds a slice; the mapping goes away with it
+            logger.debug(f"Deferred unmapping of {self.path}, views still exported")
+
+
+class FileMapRegistry:
+    """
+    Maps each boot file once and reference-counts it across sessions
+
+    Entries are keyed by path and file identity, so replacing a file on disk
+    gives new sessions a fresh mapping while running transfers keep the old one.
+    """
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path, sequential=True):
+        """
+        Get a shared mapping of a file
+
+        Args:
+            path (str): Absolute path of the file
+            sequential (bool): Hint read-ahead for front-to-back reads; only
+                applies when the file is not mapped yet
+
+        Returns:
+            MappedFile: Mapping with one reference taken for the caller
+        """
+        st = os.stat(path)
+        if not os.path.isfile(path):
+            raise IsADirectoryError(path)
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            mapped = self._files.get(path)
+            if mapped is None or mapped.key != key:
+                mapped = MappedFile(self, key, path, sequential)
+                self._files[path] = mapped
+            mapped.refs += 1
+            return mapped
+
+    def release(self, mapped):
+        """Drop a reference and unmap the file when no session uses it"""
+        with self._lock:
+            mapped.refs -= 1
+            if mapped.refs > 0:
+                return
+            if self._files.get(mapped.path) is mapped:
+                del self._files[mapped.path]
+        mapped.unmap()
+
+    def status(self):
+        """Return the number and total size of currently mapped files"""
+        with self._lock:
+            files = list(self._files.values())
+        return {
+            'mapped_files': len(files),
+            'mapped_bytes': sum(f.size for f in files),
+            'mapped_refs': sum(f.refs for f in files),
+        }
+
+
+class CongestionControl:
+    """
+    Per-session retransmission timeout and congestion window
+
+    The timeout follows RFC 6298: smoothed RTT plus four times its variance,
+    doubled on every timeout, with no samples taken from retransmitted
+    windows (Karn). The congestion window is AIMD like TCP's: slow start up
+    to ssthresh, then one more block per acknowledged window; a loss inside
+    a window halves it and a timeout drops it to one block. A client that
+    negotiated the RFC 2349 timeout option keeps that timeout.
+    """
+
+    def __init__(self, max_window, initial_rto, fixed_rto=False):
+        self.max_window = max_window
+        self.cwnd = min(INITIAL_CWND, max_window)
+        self.ssthresh = max_window
+        self.rto = initial_rto
+        self.fixed_rto = fixed_rto
+        self.srtt = None
+        self.rttvar = None
+
+    @property
+    def window(self):
+        """Blocks that may be sent per round trip"""
+        return max(1, int(self.cwnd))
+
+    @property
+    def pacing_interval(self):
+        return self.srtt if self.srtt is not None else MIN_RTO
+
+    def on_rtt_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        if not self.fixed_rto:
+            self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def on_window_acked(self):
+        if self.cwnd < self.ssthresh:
+            self.cwnd = min(self.cwnd * 2, self.ssthresh, self.max_window)
+        else:
+            self.cwnd = min(self.cwnd + 1, self.max_window)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, 1)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self.ssthresh = max(self.cwnd / 2, 1)
+        self.cwnd = 1
+        if not self.fixed_rto:
+            self.rto = min(self.rto * 2, MAX_RTO)
+
+
+class TFTPSession:
+    """
+    A single read transfer on its own socket (transfer ID)
+
+    Blocks are sent in windows of `windowsize` packets (RFC 7440). The client
+    acknowledges the last block it received in order, and the server restarts
+    the next window right after that block, which covers both a completed
+    window and a loss inside one.
+
+    Clients only acknowledge complete windows, so congestion control cannot
+    shrink the negotiated window. Instead, at most a congestion window of
+    blocks goes out per round trip and the rest of the window is paced.
+    """
+
+    def __init__(self, server, peer, source, options):
+        self.server = server
+        self.peer = peer
+        self.source = source
+        self.options = options
+
+        self.blksize = options.get('blksize', DEFAULT_BLKSIZE)
+        self.windowsize = options.get('windowsize', 1)
+        self.cc = self._congestion_control(options)
+
+        # A final short (possibly empty) block terminates the transfer
+        self.total_blocks = source.size // self.blksize + 1
+
+        # Absolute block numbers; the wire carries them modulo 65536
+        self._acked = 0
+        self._next = 1
+        self._window_end = 0
+        self._oack_pending = bool(options)
+        self._retries = 0
+        self._timer = None
+        self._pace_timer = None
+        self._burst = 0
+        self._writing = False
+        self._sent_at = None
+        self._retransmitted = False
+        self._recover = 0
+        self._started_at = time.monotonic()
+
+        self.loop = server.loop
+        self.sock = self._open_socket()
+        self.closed = False
+
+    def _congestion_control(self, options):
+        return CongestionControl(
+            options.get('windowsize', 1),
+            options.get('timeout', self.server.timeout),
+            fixed_rto='timeout' in options
+        )
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.server.socket_buffer)
+        sock.bind((self.server.host, 0))
+        sock.connect(self.peer)
+        return sock
+
+    def start(self):
+        """Begin the transfer with an OACK or the first window"""
+        self.loop.add_reader(self.sock.fileno(), self._on_readable)
+        if self.server.scheduler is not None:
+            self.server.scheduler.open(self._bandwidth_key())
+        if self._oack_pending:
+            self._send_oack()
+        else:
+            self._send_window()
+
+    def _send_oack(self):
+        self._send(self._oack())
+        self._sent_at = time.monotonic()
+        self._arm_timer()
+
+    def _oack(self):
+        return build_oack(self.options)
+
+    def _send(self, packet, payload=None, addr=None):
+        try:
+            if payload is None:
+                if addr is None:
+                    self.sock.send(packet)
+                else:
+                    self.sock.sendto(packet, addr)
+            elif _HAS_SENDMSG:
+                # Scatter-gather send straight from the shared mapping
+                if addr is None:
+                    self.sock.sendmsg([packet, payload])
+                else:
+                    self.sock.sendmsg([packet, payload], [], 0, addr)
+            elif addr is None:
+                self.sock.send(packet + bytes(payload))
+            else:
+                self.sock.sendto(packet + bytes(payload), addr)
+            return True
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            logger.warning(f"TFTP send to {self.peer} failed: {e}")
+            self.close(failed=True)
+            return False
+
+    def _block(self, block):
+        """Return the DATA header and payload view for an absolute block number"""
+        with boot_latency.timed():
+            payload = touch_pages(self.source.read((block - 1) * self.blksize, self.blksize))
+        return struct.pack('!HH', OP_DATA, block & 0xFFFF), payload
+
+    def _send_block(self, header, payload):
+        return self._send(header, payload)
+
+    def _send_window(self):
+        """(Re)start a window right after the last acknowledged block"""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._pace_timer:
+            self._pace_timer.cancel()
+            self._pace_timer = None
+        self._next = self._acked + 1
+        self._window_end = min(self._acked + self.windowsize, self.total_blocks)
+        self._burst = 0
+        self._pump()
+
+    def _pump(self):
+        self._pace_timer = None
+        sent = 0
+        while self._next <= self._window_end and not self.closed:
+            if self._burst == 0:
+                if sent:
+                    # Congestion window used up: send the rest one RTT later
+                    self._pace_timer = self.loop.call_later(self.cc.pacing_interval, self._pump)
+                    break
+                self._burst = min(self.cc.window, self._window_end - self._next + 1)
+                delay = self._reserve_bandwidth(self._burst)
+                if delay > 0:
+                    # Over the shared bandwidth limit: send this burst later
+                    self._pace_timer = self.loop.call_later(delay, self._pump)
+                    break
+            header, payload = self._block(self._next)
+            if not self._send_block(header, payload):
+                if self.closed:
+                    return
+                # Socket buffer is full, continue when it drains
+                if not self._writing:
+                    self._writing = True
+                    self.loop.add_writer(self.sock.fileno(), self._pump)
+                return
+            self.server.stats['packets_sent'] += 1
+            self.server.stats['bytes_sent'] += len(payload)
+            self._next += 1
+            self._burst -= 1
+            sent += 1
+
+        if self._writing:
+            self._writing = False
+            self.loop.remove_writer(self.sock.fileno())
+
+        if self._next > self._window_end and not self.closed:
+            # Whole window is out: the RTT sample and timeout start now
+            self._sent_at = time.monotonic()
+            self._arm_timer()
+
+    def _bandwidth_key(self):
+        return self.peer[0]
+
+    def _reserve_bandwidth(self, blocks):
+        scheduler = self.server.scheduler
+        if scheduler is None or not scheduler.limited:
+            return 0
+        return scheduler.reserve(self._bandwidth_key(), blocks * self.blksize)
+
+    def _arm_timer(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = self.loop.call_later(self.cc.rto, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timer = None
+        if self.closed:
+            return
+
+        self._retries += 1
+        if self._retries > self.server.max_retries:
+            logger.warning(f"TFTP transfer of {self.source.path} to {self.peer} timed out")
+            self._send(build_error(ERR_NOT_DEFINED, "Timeout"))
+            self._peer_failed()
+            return
+
+        self.server.stats['retransmits'] += 1
+        self.cc.on_timeout()
+        self._retransmitted = True
+        if self._oack_pending:
+            self._send_oack()
+        else:
+            self._send_window()
+
+    def _on_readable(self):
+        while not self.closed:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on the connected socket
+                logger.debug(f"TFTP receive from {self.peer} failed: {e}")
+                self.close(failed=True)
+                return
+            self._handle_packet(data, addr)
+
+    def _handle_packet(self, data, addr):
+        if len(data) < 4:
+            return
+
+        opcode, value = struct.unpack('!HH', data[:4])
+        if opcode == OP_ACK:
+            self._handle_ack(value)
+        elif opcode == OP_ERROR:
+            message = data[4:].split(b'\0')[0].decode('ascii', errors='replace')
+            logger.info(f"TFTP client {self.peer} aborted transfer: {message} ({value})")
+            self._peer_failed()
+        else:
+            self._send(build_error(ERR_ILLEGAL_OPERATION, "Unexpected packet"))
+
+    def _handle_ack(self, wire_block):
+        if self._oack_pending:
+            if wire_block != 0:
+                return
+            self._oack_pending = False
+            self._on_acked(window_complete=False)
+        else:
+            # Map the 16-bit block number onto the outstanding range
+            delta = (wire_block - self._acked) & 0xFFFF
+            if delta == 0 or delta > self._next - 1 - self._acked:
+                return  # duplicate or stale ACK
+            self._acked += delta
+            self._on_acked(self._acked >= self._window_end)
+
+        self._retries = 0
+        if self._acked >= self.total_blocks:
+            self._peer_done()
+            return
+
+        self._send_window()
+
+    def _on_acked(self, window_complete):
+        """Feed an acknowledgement to congestion control"""
+        if not self._retransmitted and self._sent_at is not None and (window_complete or self._acked == 0):
+            self.cc.on_rtt_sample(time.monotonic() - self._sent_at)
+        self._retransmitted = False
+
+        if window_complete:
+            self.cc.on_window_acked()
+        elif self._acked and self._acked > self._recover:
+            # The client saw a gap inside the window; react once per window
+            self.cc.on_loss()
+            self._recover = self._next - 1
+            self.server.stats['loss_events'] += 1
+
+    def _peer_done(self):
+        """The client acknowledged the final block"""
+        self.close()
+
+    def _peer_failed(self):
+        """The client aborted or stopped answering"""
+        self.close(failed=True)
+
+    def _teardown(self):
+        self.closed = True
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._pace_timer:
+            self._pace_timer.cancel()
+            self._pace_timer = None
+        self.loop.remove_reader(self.sock.fileno())
+        if self._writing:
+            self.loop.remove_writer(self.sock.fileno())
+        self.sock.close()
+        self.source.close()
+        self.server.sessions.discard(self)
+        if self.server.scheduler is not None:
+            self.server.scheduler.close(self._bandwidth_key())
+
+    def close(self, failed=False):
+        """Tear down the transfer socket and release the file"""
+        if self.closed:
+            return
+        self._teardown()
+
+        elapsed = time.monotonic() - self._started_at
+        if failed:
+            self.server.stats['sessions_failed'] += 1
+        else:
+            self.server.stats['sessions_completed'] += 1
+            logger.info(
+                f"TFTP sent {self.source.path} ({self.source.size} bytes) to {self.peer} "
+                f"in {elapsed:.2f}s (blksize={self.blksize}, windowsize={self.windowsize}, "
+                f"cwnd={self.cc.window}, rto={self.cc.rto:.3f}s)"
+            )
+
+
+class MulticastSession(TFTPSession):
+    """
+    RFC 2090 multicast transfer shared by every client reading the same file
+
+    DATA goes to the group address once per block. One member at a time is
+    the master client and drives the transfer with its ACKs; clients that ask
+    for the same file later join the group and listen in. When the master has
+    everything, the next member is promoted and ACKs the last block it holds
+    in sequence, so the server only resends what that client missed.
+    """
+
+    def __init__(self, server, peer, source, options, group):
+        self.group = group
+        self.members = OrderedDict()
+        self.members[peer] = options
+        self.group_key = (source.key, options.get('blksize', DEFAULT_BLKSIZE))
+        self.completed = 0
+        self.failed = 0
+        super().__init__(server, peer, source, options)
+        # The multicast option itself always needs an OACK
+        self._oack_pending = True
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.server.socket_buffer)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        if self.server.host not in ('', '0.0.0.0'):
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.server.host))
+        sock.bind((self.server.host, 0))
+        return sock
+
+    def _multicast_oack(self, options, master):
+        accepted = dict(options)
+        accepted['multicast'] = f"{self.group[0]},{self.group[1]},{1 if master else 0}"
+        return build_oack(accepted)
+
+    def _oack(self):
+        return self._multicast_oack(self.options, True)
+
+    def _send(self, packet, payload=None, addr=None):
+        # Control packets go to the current master, DATA to the group
+        return super()._send(packet, payload, addr or self.peer)
+
+    def _send_block(self, header, payload):
+        return self._send(header, payload, self.group)
+
+    def _bandwidth_key(self):
+        # One stream feeds the whole group, so it takes a single share
+        return self.group[0]
+
+    def join(self, peer, options):
+        """
+        Add a late requester to the group as a passive listener
+
+        Args:
+            peer (tuple): Client address
+            options (dict): Options negotiated for that client
+        """
+        if peer != self.peer:
+            self.members[peer] = options
+        self._send(self._multicast_oack(options, peer == self.peer), addr=peer)
+        logger.debug(f"TFTP client {peer} joined multicast transfer of {self.source.path}")
+
+    def _handle_packet(self, data, addr):
+        if addr == self.peer:
+            super()._handle_packet(data, addr)
+            return
+
+        # Non-master members only ever leave the group
+        if len(data) >= 2 and struct.unpack('!H', data[:2])[0] == OP_ERROR and addr in self.members:
+            del self.members[addr]
+            self.failed += 1
+
+    def _handle_ack(self, wire_block):
+        if not self._oack_pending:
+            # A master that joined late may already hold blocks the server has
+            # not resent yet, so its ACK can run ahead of the window. Serial
+            # number arithmetic (RFC 1982) tells such a jump from a stale ACK.
+            delta = (wire_block - self._acked) & 0xFFFF
+            if delta == 0 or delta >= 0x8000 or self._acked + delta > self.total_blocks:
+                return
+            self._acked += delta
+            self._on_acked(self._acked >= self._window_end)
+            self._retries = 0
+            if self._acked >= self.total_blocks:
+                self._peer_done()
+                return
+            self._send_window()
+            return
+
+        # A newly promoted master reports the last block it holds in sequence.
+        # Past a block-number rollover the lowest candidate is taken, which can
+        # only resend blocks the client already has, never skip one.
+        self._oack_pending = False
+        self._retries = 0
+        self._acked = min(wire_block, self.total_blocks)
+        self._next = self._acked + 1
+        self._recover = self._acked
+        self._retransmitted = False
+        if self._acked >= self.total_blocks:
+            self._peer_done()
+            return
+        self._send_window()
+
+    def _peer_done(self):
+        self.members.pop(self.peer, None)
+        self.completed += 1
+        self.server.stats['sessions_completed'] += 1
+        self._promote_next()
+
+    def _peer_failed(self):
+        self.members.pop(self.peer, None)
+        self.failed += 1
+        self.server.stats['sessions_failed'] += 1
+        self._promote_next()
+
+    def _promote_next(self):
+        if not self.members:
+            self.close()
+            return
+
+        self.peer, options = next(iter(self.members.items()))
+        self.options = options
+        self.windowsize = options.get('windowsize', 1)
+        # The new master sits behind its own switch port
+        self.cc = self._congestion_control(options)
+        self._oack_pending = True
+        self._retries = 0
+        self._send_oack()
+
+    def close(self, failed=False):
+        """Finish the group transfer and free its multicast address"""
+        if self.closed:
+            return
+        self._teardown()
+        self.server.multicast_groups.pop(self.group_key, None)
+
+        if failed:
+            self.server.stats['sessions_failed'] += len(self.members)
+        elapsed = time.monotonic() - self._started_at
+        logger.info(
+            f"TFTP multicast of {self.source.path} to {self.group[0]}:{self.group[1]} finished "
+            f"in {elapsed:.2f}s ({self.completed} clients completed, {self.failed} failed)"
+        )
+
+
+class TFTPServer:
+    """
+    Read-only TFTP server for PXE boot files
+
+    All sessions share one asyncio event loop; the well-known port only
+    receives requests and every transfer gets its own ephemeral socket.
+    With multicast enabled, clients asking for the RFC 2090 "multicast"
+    option share one transfer per file and block size.
+    """
+
+    def __init__(self, root, host='0.0.0.0', port=69, timeout=DEFAULT_TIMEOUT,
+                 max_retries=5, max_blksize=MAX_BLKSIZE, max_windowsize=64,
+                 socket_buffer=4 * 1024 * 1024, block_cache=None,
+                 multicast_enabled=False, multicast_address='239.255.69.1',
+                 multicast_port=1758, multicast_pool_size=64, config_provider=None,
+                 scheduler=None):
+        self.root = os.path.realpath(root)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.socket_buffer = socket_buffer
+        self.block_cache = block_cache
+        self.multicast_enabled = multicast_enabled
+        self.multicast_address = multicast_address
+        self.multicast_port = multicast_port
+        self.multicast_pool_size = multicast_pool_size
+        self.config_provider = config_provider
+        self.scheduler = scheduler
+
+        self.loop = None
+        self.sock = None
+        self.file_maps = FileMapRegistry()
+        self.sessions = set()
+        self.multicast_groups = {}
+        self._stop_event = None
+        self._stop_requested = False
+        self.stats = {
+            'requests': 0,
+            'sessions_completed': 0,
+            'sessions_failed': 0,
+            'packets_sent': 0,
+            'bytes_sent': 0,
+            'retransmits': 0,
+            'loss_events': 0,
+        }
+
+    def resolve_path(self, filename):
+        """
+        Map a requested filename onto a path below the TFTP root
+
+        Args:
+            filename (str): Filename from the RRQ (PXE ROMs may use backslashes)
+
+        Returns:
+            str: Absolute path, or None if it escapes the root
+        """
+        name = filename.replace('\\', '/').lstrip('/')
+        path = os.path.realpath(os.path.join(self.root, name))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def open_source(self, filename, peer):
+        """
+        Open the file behind a read request
+
+        Args:
+            filename (str): Requested filename
+            peer (tuple): Client address
+
+        Returns:
+            Readable source for the session (MemorySource for generated
+            boot configs, MappedFile, or CachedSource wrapping it when a
+            block cache is configured)
+        """
+        if self.config_provider is not None:
+            data = self.config_provider.render(filename)
+            if data is not None:
+                key = ('config', filename, self.config_provider.generation)
+                return MemorySource(filename, data, key)
+
+        path = self.resolve_path(filename)
+        if path is None:
+            raise PermissionError(filename)
+        source = self._open_file(path)
+        if self.block_cache is not None:
+            return CachedSource(source, self.block_cache)
+        return source
+
+    def _open_file(self, path):
+        try:
+            return self.file_maps.acquire(path)
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError):
+            raise
+        except (ValueError, OSError) as e:
+            logger.debug(f"Cannot mmap {path}, falling back to pread: {e}")
+            return FileSource(path)
+
+    async def start(self):
+        """Bind the listening socket on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setblocking(False)
+        self.sock.bind((self.host, self.port))
+        self.port = self.sock.getsockname()[1]
+        self.loop.add_reader(self.sock.fileno(), self._on_request)
+        logger.info(f"TFTP server started on {self.host}:{self.port} serving {self.root}")
+
+    def close(self):
+        """Stop listening and abort all active transfers"""
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        for session in list(self.sessions):
+            session.close(failed=True)
+        logger.info("TFTP server stopped")
+
+    def serve_forever(self):
+        """Run the server on a new event loop until stop() is called"""
+        async def _serve():
+            self._stop_event = asyncio.Event()
+            await self.start()
+            try:
+                if not self._stop_requested:
+                    await self._stop_event.wait()
+            finally:
+                self.close()
+
+        asyncio.run(_serve())
+
+    def stop(self):
+        """Stop a server running in serve_forever() from another thread"""
+        self._stop_requested = True
+        if self.loop and self._stop_event and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop_event.set)
+
+    def _on_request(self):
+        while self.sock is not None:
+            try:
+                data, peer = self.sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"TFTP server error: {e}")
+                return
+            try:
+                self._handle_request(data, peer)
+            except Exception as e:
+                logger.error(f"Error handling TFTP request from {peer}: {e}")
+
+    def _reply_error(self, peer, code, message):
+        try:
+            self.sock.sendto(build_error(code, message), peer)
+        except OSError:
+            pass
+
+    def _handle_request(self, data, peer):
+        if len(data) < 4:
+            return
+
+        try:
+            opcode, filename, mode, requested = parse_request(data)
+        except (ValueError, struct.error):
+            self._reply_error(peer, ERR_ILLEGAL_OPERATION, "Malformed request")
+            return
+
+        if opcode == OP_WRQ:
+            self._reply_error(peer, ERR_ACCESS_VIOLATION, "Server is read-only")
+            return
+        if opcode != OP_RRQ:
+            self._reply_error(peer, ERR_ILLEGAL_OPERATION, "Illegal TFTP operation")
+            return
+
+        self.stats['requests'] += 1
+        logger.debug(f"TFTP RRQ {filename} ({mode}) from {peer} options={requested}")
+
+        try:
+            source = self.open_source(filename, peer)
+        except PermissionError:
+            self._reply_error(peer, ERR_ACCESS_VIOLATION, "Access violation")
+            return
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            self._reply_error(peer, ERR_FILE_NOT_FOUND, "File not found")
+            return
+
+        options = negotiate_options(requested, source.size, self.max_blksize, self.max_windowsize)
+        if self.multicast_enabled and 'multicast' in requested:
+            self._start_multicast(peer, source, options)
+            return
+
+        session = TFTPSession(self, peer, source, options)
+        self.sessions.add(session)
+        session.start()
+
+    def _start_multicast(self, peer, source, options):
+        """Join the requester to a running transfer of the file or start one"""
+        key = (source.key, options.get('blksize', DEFAULT_BLKSIZE))
+        session = self.multicast_groups.get(key)
+        if session is not None and not session.closed:
+            source.close()
+            session.join(peer, options)
+            return
+
+        group = self._allocate_group()
+        if group is None:
+            logger.warning("No free multicast address, serving request over unicast")
+            session = TFTPSession(self, peer, source, options)
+        else:
+            session = MulticastSession(self, peer, source, options, group)
+            self.multicast_groups[key] = session
+        self.sessions.add(session)
+        session.start()
+
+    def _allocate_group(self):
+        in_use = {session.group for session in self.multicast_groups.values()}
+        base = ipaddress.IPv4Address(self.multicast_address)
+        for i in range(self.multicast_pool_size):
+            group = (str(base + i), self.multicast_port)
+            if group not in in_use:
+                return group
+        return None
+
+    def status(self):
+        """Return transfer counters for the status page"""
+        status = dict(self.stats)
+        status['active_sessions'] = len(self.sessions)
+        status['multicast_groups'] = len(self.multicast_groups)
+        status.update(self.file_maps.status())
+        return status
@@ -0,0 +1,671 @@
+import os
+import time
+import uuid
+import fcntl
+import struct
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+DEFAULT_BLOCK_SIZE = 2 * 1024 * 1024
+# VHD timestamps count seconds from 2000-01-01 00:00:00 UTC
+VHD_EPOCH = 946684800
+
+FOOTER_COOKIE = b'conectix'
+HEADER_COOKIE = b'cxsparse'
+DISK_FIXED = 2
+DISK_DYNAMIC = 3
+DISK_DIFFERENCING = 4
+BAT_UNUSED = 0xFFFFFFFF
+NO_DATA_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+# cookie, features, version, data offset, timestamp, creator app, creator version,
+# creator OS, original size, current size, cylinders, heads, sectors/track,
+# disk type, checksum, unique id, saved state
+FOOTER_FORMAT = '>8sIIQI4sI4sQQHBBII16sB427x'
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+FOOTER_CHECKSUM_OFFSET = 64
+
+# cookie, data offset, table offset, version, max table entries, block size,
+# checksum, parent unique id, parent timestamp, reserved, parent unicode name
+HEADER_FORMAT = '>8sQQIIII16sII512s'
+LOCATOR_FORMAT = '>4sIIIQ'
+LOCATOR_COUNT = 8
+HEADER_SIZE = 1024
+HEADER_CHECKSUM_OFFSET = 36
+
+PLATFORM_NONE = b'\0\0\0\0'
+PLATFORM_W2RU = b'W2ru'  # relative Windows path, UTF-16LE
+PLATFORM_W2KU = b'W2ku'  # absolute Windows path, UTF-16LE
+
+
+class VHDError(Exception):
+    pass
+
+
+class DiskInUseError(VHDError):
+    """A disk is attached by clients, or being changed, and cannot be taken now"""
+
+
+def _checksum(data, offset):
+    """One's complement of the byte sum, skipping the 4-byte checksum field"""
+    total = sum(data[:offset]) + sum(data[offset + 4:])
+    return ~total & 0xFFFFFFFF
+
+
+def _align(value, multiple=SECTOR_SIZE):
+    return (value + multiple - 1) // multiple * multiple
+
+
+def _timestamp(seconds=None):
+    return max(0, int(seconds if seconds is not None else time.time()) - VHD_EPOCH) & 0xFFFFFFFF
+
+
+def disk_geometry(size):
+    """CHS geometry for a disk size, as given in the VHD specification"""
+    total = min(size // SECTOR_SIZE, 65535 * 16 * 255)
+    if total >= 65535 * 16 * 63:
+        spt, heads = 255, 16
+        cylinder_times_heads = total // spt
+    else:
+        spt = 17
+        cylinder_times_heads = total // spt
+        heads = max((cylinder_times_heads + 1023) // 1024, 4)
+        if cylinder_times_heads >= heads * 1024 or heads > 16:
+            spt, heads = 31, 16
+            cylinder_times_heads = total // spt
+        if cylinder_times_heads >= heads * 1024:
+            spt, heads = 63, 16
+            cylinder_times_heads = total // spt
+    return cylinder_times_heads // heads, heads, spt
+
+
+class Footer:
+    """The 512-byte hard disk footer shared by every VHD type"""
+
+    def __init__(self, disk_type, size, data_offset=NO_DATA_OFFSET, unique_id=None, timestamp=None):
+        self.disk_type = disk_type
+        self.size = size
+        self.original_size = size
+        self.data_offset = data_offset
+        self.unique_id = unique_id or uuid.uuid4().bytes
+        self.timestamp = _timestamp() if timestamp is None else timestamp
+
+    @classmethod
+    def parse(cls, data):
+        if len(data) < FOOTER_SIZE or data[:8] != FOOTER_COOKIE:
+            return None
+        fields = struct.unpack(FOOTER_FORMAT, data[:FOOTER_SIZE])
+        if _checksum(data[:FOOTER_SIZE], FOOTER_CHECKSUM_OFFSET) != fields[14]:
+            raise VHDError("footer checksum mismatch")
+        footer = cls(fields[13], fields[9], data_offset=fields[3], unique_id=fields[15], timestamp=fields[4])
+        footer.original_size = fields[8]
+        return footer
+
+    def pack(self):
+        cylinders, heads, spt = disk_geometry(self.size)
+        fields = [FOOTER_COOKIE, 2, 0x00010000, self.data_offset, self.timestamp, b'gnm ', 0x00010000,
+                  b'Wi2k', self.original_size, self.size, cylinders, heads, spt, self.disk_type, 0,
+                  self.unique_id, 0]
+        data = bytearray(struct.pack(FOOTER_FORMAT, *fields))
+        struct.pack_into('>I', data, FOOTER_CHECKSUM_OFFSET, _checksum(data, FOOTER_CHECKSUM_OFFSET))
+        return bytes(data)
+
+
+class DynamicHeader:
+    """The 1024-byte header of dynamic and differencing disks"""
+
+    def __init__(self, table_offset, max_table_entries, block_size,
+                 parent_id=b'\0' * 16, parent_timestamp=0, parent_name='', locators=()):
+        self.table_offset = table_offset
+        self.max_table_entries = max_table_entries
+        self.block_size = block_size
+        self.parent_id = parent_id
+        self.parent_timestamp = parent_timestamp
+        self.parent_name = parent_name
+        # (platform code, data space, data length, data offset)
+        self.locators = list(locators)
+
+    @classmethod
+    def parse(cls, data):
+        if data[:8] != HEADER_COOKIE:
+            raise VHDError("missing dynamic disk header")
+        if _checksum(data[:HEADER_SIZE], HEADER_CHECKSUM_OFFSET) != struct.unpack_from('>I', data, HEADER_CHECKSUM_OFFSET)[0]:
+            raise VHDError("dynamic header checksum mismatch")
+        (_cookie, _data_offset, table_offset, _version, entries, block_size, _checksum_value,
+         parent_id, parent_timestamp, _reserved, parent_name) = struct.unpack_from(HEADER_FORMAT, data)
+        locators = []
+        position = struct.calcsize(HEADER_FORMAT)
+        for _ in range(LOCATOR_COUNT):
+            code, space, length, _reserved, offset = struct.unpack_from(LOCATOR_FORMAT, data, position)
+            position += struct.calcsize(LOCATOR_FORMAT)
+            if code != PLATFORM_NONE:
+                locators.append((code, space, length, offset))
+        name = parent_name.decode('utf-16-be', errors='replace').rstrip('\0')
+        return cls(table_offset, entries, block_size, parent_id, parent_timestamp, name, locators)
+
+    def pack(self):
+        name = self.parent_name.encode('utf-16-be')[:512]
+        data = bytearray(HEADER_SIZE)
+        struct.pack_into(HEADER_FORMAT, data, 0, HEADER_COOKIE, NO_DATA_OFFSET, self.table_offset,
+                         0x00010000, self.max_table_entries, self.block_size, 0,
+                         self.parent_id, self.parent_timestamp, 0, name)
+        position = struct.calcsize(HEADER_FORMAT)
+        for code, space, length, offset in self.locators[:LOCATOR_COUNT]:
+            struct.pack_into(LOCATOR_FORMAT, data, position, code, space, length, 0, offset)
+            position += struct.calcsize(LOCATOR_FORMAT)
+        struct.pack_into('>I', data, HEADER_CHECKSUM_OFFSET, _checksum(data, HEADER_CHECKSUM_OFFSET))
+        return bytes(data)
+
+
+class RawDisk:
+    """
+    Flat disk image: a fixed VHD, or a raw image without any footer
+
+    Fixed VHDs are plain sector data followed by a footer, so both are read
+    and written in place.
+    """
+
+    read_only = True
+    multi_conn = True
+
+    def __init__(self, path, writable=False, footer=None):
+        self.path = path
+        self.read_only = not writable
+        self.fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        self.footer = footer
+        self.size = footer.size if footer else os.fstat(self.fd).st_size
+        self.unique_id = footer.unique_id if footer else b'\0' * 16
+
+    def read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        # A raw image may be shorter than the size a footer or child claims
+        return data if len(data) == length else data + bytes(length - len(data))
+
+    def write(self, offset, data):
+        if self.read_only:
+            raise PermissionError(self.path)
+        if os.pwrite(self.fd, data, offset) != len(data):
+            raise OSError(f"short write to {self.path}")
+
+    def flush(self):
+        if not self.read_only:
+            os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DynamicDisk:
+    """
+    Dynamic or differencing VHD
+
+    Data lives in blocks allocated on first write and located through the
+    block allocation table (BAT). Each block starts with a sector bitmap;
+    in a differencing disk a clear bit means the sector is read from the
+    parent, in a dynamic disk it reads as zeros.
+    """
+
+    multi_conn = False
+
+    def __init__(self, path, footer, writable=False, parent_writable=False):
+        self.path = path
+        self.footer = footer
+        self.size = footer.size
+        self.unique_id = footer.unique_id
+        self.read_only = not writable
+        self.fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        try:
+            self.header = DynamicHeader.parse(os.pread(self.fd, HEADER_SIZE, footer.data_offset))
+            self.block_size = self.header.block_size
+            self.sectors_per_block = self.block_size // SECTOR_SIZE
+            self.bitmap_size = _align((self.sectors_per_block + 7) // 8)
+            entries = self.header.max_table_entries
+            raw = os.pread(self.fd, entries * 4, self.header.table_offset)
+            self.bat = list(struct.unpack(f'>{entries}I', raw))
+            self.end = os.fstat(self.fd).st_size - FOOTER_SIZE
+            self._bitmaps = {}
+
+            self.parent = None
+            if footer.disk_type == DISK_DIFFERENCING:
+                self.parent = open_disk(self._locate_parent(), writable=parent_writable)
+                if self.parent.unique_id != b'\0' * 16 and self.parent.unique_id != self.header.parent_id:
+                    logger.warning(f"Parent of {path} has a different unique id; it was modified or replaced")
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def _locate_parent(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        candidates = []
+        for code, _space, length, offset in self.header.locators:
+            if code in (PLATFORM_W2RU, PLATFORM_W2KU):
+                locator = os.pread(self.fd, length, offset).decode('utf-16-le', errors='replace')
+                locator = locator.rstrip('\0').replace('\\', '/')
+                candidates.append(os.path.normpath(os.path.join(directory, locator)))
+        if self.header.parent_name:
+            candidates.append(os.path.join(directory, self.header.parent_name))
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        raise VHDError(f"parent of {self.path} not found (tried {', '.join(candidates) or 'nothing'})")
+
+    def _bitmap(self, block):
+        bitmap = self._bitmaps.get(block)
+        if bitmap is None:
+            bitmap = bytearray(os.pread(self.fd, self.bitmap_size, self.bat[block] * SECTOR_SIZE))
+            self._bitmaps[block] = bitmap
+        return bitmap
+
+    @staticmethod
+    def _present(bitmap, sector):
+        # Bits are numbered from the most significant bit of each byte
+        return bitmap[sector >> 3] & (0x80 >> (sector & 7))
+
+    def _read_missing(self, offset, length):
+        if self.parent is not None:
+            return self.parent.read(offset, length)
+        return bytes(length)
+
+    def read(self, offset, length):
+        """Read length bytes, taking absent sectors from the parent"""
+        if offset + length > self.size:
+            raise VHDError("read beyond end of disk")
+        pieces = []
+        end = offset + length
+        position = offset
+        while position < end:
+            block, block_offset = divmod(position, self.block_size)
+            chunk_end = min(end, (block + 1) * self.block_size)
+            if self.bat[block] == BAT_UNUSED:
+                pieces.append(self._read_missing(position, chunk_end - position))
+                position = chunk_end
+                continue
+
+            bitmap = self._bitmap(block)
+            data_start = self.bat[block] * SECTOR_SIZE + self.bitmap_size
+            sector = block_offset // SECTOR_SIZE
+            while position < chunk_end:
+                present = bool(self._present(bitmap, sector))
+                run = sector + 1
+                while run < self.sectors_per_block and bool(self._present(bitmap, run)) == present \
+                        and block * self.block_size + run * SECTOR_SIZE < chunk_end:
+                    run += 1
+                stop = min(chunk_end, block * self.block_size + run * SECTOR_SIZE)
+                if present:
+                    pieces.append(os.pread(self.fd, stop - position,
+                                           data_start + position - block * self.block_size))
+                else:
+                    pieces.append(self._read_missing(position, stop - position))
+                position = stop
+                sector = run
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    def _allocate(self, block):
+        """Append a block with an empty sector bitmap and point the BAT at it"""
+        offset = self.end
+        new_end = offset + self.bitmap_size + self.block_size
+        # The new block is a hole until written; move the footer behind it first
+        os.ftruncate(self.fd, new_end + FOOTER_SIZE)
+        os.pwrite(self.fd, bytes(self.bitmap_size), offset)
+        os.pwrite(self.fd, self.footer.pack(), new_end)
+        self.end = new_end
+        self.bat[block] = offset // SECTOR_SIZE
+        os.pwrite(self.fd, struct.pack('>I', self.bat[block]), self.header.table_offset + block * 4)
+        self._bitmaps[block] = bytearray(self.bitmap_size)
+
+    def write(self, offset, data):
+        """Write data, allocating blocks and filling partial sectors from the parent"""
+        if self.read_only:
+            raise PermissionError(self.path)
+        end = offset + len(data)
+        if end > self.size:
+            raise VHDError("write beyond end of disk")
+        view = memoryview(data)
+        position = offset
+        while position < end:
+            block = position // self.block_size
+            block_start = block * self.block_size
+            chunk_end = min(end, block_start + self.block_size)
+            if self.bat[block] == BAT_UNUSED:
+                self._allocate(block)
+            bitmap = self._bitmap(block)
+
+            first = (position - block_start) // SECTOR_SIZE
+            last = (chunk_end - 1 - block_start) // SECTOR_SIZE
+            start = position
+            head = tail = b''
+            sector_start = block_start + first * SECTOR_SIZE
+            if position > sector_start and not self._present(bitmap, first):
+                head = self._read_missing(sector_start, position - sector_start)
+                start = sector_start
+            sector_end = block_start + (last + 1) * SECTOR_SIZE
+            if chunk_end < sector_end and not self._present(bitmap, last):
+                tail = self._read_missing(chunk_end, sector_end - chunk_end)
+
+            payload = view[position - offset:chunk_end - offset]
+            buffer = b''.join((head, payload, tail)) if head or tail else payload
+            data_start = self.bat[block] * SECTOR_SIZE + self.bitmap_size
+            if os.pwrite(self.fd, buffer, data_start + start - block_start) != len(buffer):
+                raise OSError(f"short write to {self.path}")
+
+            for sector in range(first, last + 1):
+                bitmap[sector >> 3] |= 0x80 >> (sector & 7)
+            os.pwrite(self.fd, bytes(bitmap[first >> 3:(last >> 3) + 1]),
+                      self.bat[block] * SECTOR_SIZE + (first >> 3))
+            position = chunk_end
+
+    def allocated_blocks(self):
+        """Indices of blocks present in this file"""
+        return [block for block, entry in enumerate(self.bat) if entry != BAT_UNUSED]
+
+    def dirty_extents(self):
+        """
+        Yield (offset, length) for every run of sectors stored in this file
+
+        Only allocated blocks are visited, so the cost is proportional to the
+        amount of data written, not to the size of the disk.
+        """
+        for block in self.allocated_blocks():
+            bitmap = self._bitmap(block)
+            if not any(bitmap):
+                continue
+            sector = 0
+            while sector < self.sectors_per_block:
+                if not self._present(bitmap, sector):
+                    sector += 1
+                    continue
+                run = sector + 1
+                while run < self.sectors_per_block and self._present(bitmap, run):
+                    run += 1
+                offset = block * self.block_size + sector * SECTOR_SIZE
+                yield offset, min(run * SECTOR_SIZE, self.size - block * self.block_size) - sector * SECTOR_SIZE
+                sector = run
+
+    def dirty_bytes(self):
+        return sum(length for _offset, length in self.dirty_extents())
+
+    def commit(self, chunk_size=4 * 1024 * 1024):
+        """
+        Merge the sectors stored in this differencing disk into its parent
+
+        Returns:
+            int: Bytes written to the parent
+        """
+        if self.parent is None:
+            raise VHDError(f"{self.path} is not a differencing disk")
+        merged = 0
+        for offset, length in self.dirty_extents():
+            done = 0
+            while done < length:
+                count = min(chunk_size, length - done)
+                position = offset + done
+                block_start = position // self.block_size * self.block_size
+                data = os.pread(self.fd, count, self.bat[position // self.block_size] * SECTOR_SIZE
+                                + self.bitmap_size + position - block_start)
+                self.parent.write(position, data)
+                done += count
+            merged += length
+        self.parent.flush()
+        return merged
+
+    def flush(self):
+        if not self.read_only:
+            os.fsync(self.fd)
+
+    def close(self):
+        if self.parent is not None:
+            self.parent.close()
+        os.close(self.fd)
+
+
+def read_footer(path):
+    """Return the VHD footer of a file, or None for a raw image"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < FOOTER_SIZE:
+            return None
+        f.seek(size - FOOTER_SIZE)
+        footer = Footer.parse(f.read(FOOTER_SIZE))
+        if footer is None:
+            # Dynamic disks keep a copy at the start; use it if the end was torn
+            f.seek(0)
+            footer = Footer.parse(f.read(FOOTER_SIZE))
+            if footer is not None and footer.disk_type == DISK_FIXED:
+                footer = None
+        return footer
+
+
+def open_disk(path, writable=False, parent_writable=False):
+    """
+    Open a disk image of any supported type
+
+    Args:
+        path (str): Image path
+        writable (bool): Open for writing
+        parent_writable (bool): For differencing disks, open the parent for
+            writing too (needed to commit)
+
+    Returns:
+        RawDisk or DynamicDisk
+    """
+    footer = read_footer(path)
+    if footer is None or footer.disk_type == DISK_FIXED:
+        return RawDisk(path, writable=writable, footer=footer)
+    if footer.disk_type in (DISK_DYNAMIC, DISK_DIFFERENCING):
+        return DynamicDisk(path, footer, writable=writable, parent_writable=parent_writable)
+    raise VHDError(f"unsupported VHD disk type {footer.disk_type} in {path}")
+
+
+def create_differencing(path, parent_path, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Create an empty differencing disk on top of a parent image
+
+    The file holds only the footer copy, the header, the parent locators and
+    an empty BAT, so it is created in constant time whatever the disk size.
+
+    Args:
+        path (str): Path of the new child
+        parent_path (str): Parent image (raw, fixed, dynamic or differencing)
+        block_size (int): Allocation block size in bytes
+
+    Returns:
+        str: Path of the child
+    """
+    parent = open_disk(parent_path)
+    try:
+        size = parent.size
+        parent_id = parent.unique_id
+    finally:
+        parent.close()
+
+    parent_abs = os.path.abspath(parent_path)
+    relative = os.path.relpath(parent_abs, os.path.dirname(os.path.abspath(path)))
+    locator_data = [
+        (PLATFORM_W2RU, ('.\\' + relative.replace('/', '\\')).encode('utf-16-le')),
+        (PLATFORM_W2KU, parent_abs.encode('utf-16-le')),
+    ]
+
+    entries = (size + block_size - 1) // block_size
+    position = FOOTER_SIZE + HEADER_SIZE
+    locators = []
+    blobs = []
+    for code, data in locator_data:
+        space = _align(len(data))
+        locators.append((code, space // SECTOR_SIZE, len(data), position))
+        blobs.append((position, data))
+        position += space
+    table_offset = position
+    end = table_offset + _align(entries * 4)
+
+    footer = Footer(DISK_DIFFERENCING, size, data_offset=FOOTER_SIZE)
+    header = DynamicHeader(table_offset, entries, block_size, parent_id=parent_id,
+                           parent_timestamp=_timestamp(os.path.getmtime(parent_path)),
+                           parent_name=os.path.basename(parent_path), locators=locators)
+
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(footer.pack())
+        f.write(header.pack())
+        for offset, data in blobs:
+            f.seek(offset)
+            f.write(data)
+        f.seek(table_offset)
+        f.write(b'\xff' * (entries * 4))
+        f.seek(end)
+        f.write(footer.pack())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def _flock(path, mode):
+    """Take a non-blocking flock on the lock file next to a disk"""
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise DiskInUseError(f"{path} is in use")
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+@contextlib.contextmanager
+def exclusive_disk(path):
+    """
+    Hold a disk exclusively, for changes that replace or merge it
+
+    Attached SharedDisks hold a shared lock on the same lock file, in this
+    process or any other, so this fails instead of pulling the disk out
+    from under live writers.
+
+    Raises:
+        DiskInUseError: Clients have the disk open
+    """
+    fd = _flock(path, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def disk_in_use(path):
+    """Whether clients have a disk attached through SharedDisks"""
+    try:
+        with exclusive_disk(path):
+            return False
+    except DiskInUseError:
+        return True
+
+
+class SharedDisks:
+    """
+    Writable disks shared by every connection attached to them
+
+    A dynamic or differencing disk keeps its BAT and end of file in memory,
+    so two instances on one file would allocate the same blocks. Each path
+    is opened once, refcounted, and every read and write goes through one
+    lock. While open, a shared flock is held on the disk's lock file, which
+    exclusive_disk() uses to refuse commits and discards under live writers.
+    """
+
+    def __init__(self):
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        """
+        Attach to a disk, opening it on first use
+
+        Returns:
+            _SharedDiskHandle: Handle to close when the connection ends
+
+        Raises:
+            DiskInUseError: The disk is being committed or discarded
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            shared = self._open.get(path)
+            if shared is None:
+                lock_fd = _flock(path, fcntl.LOCK_SH)
+                try:
+                    shared = _SharedDisk(open_disk(path, writable=True), lock_fd)
+                except Exception:
+                    os.close(lock_fd)
+                    raise
+                self._open[path] = shared
+            shared.refs += 1
+            return _SharedDiskHandle(self, path, shared)
+
+    def release(self, path, shared):
+        with self._lock:
+            shared.refs -= 1
+            if shared.refs > 0:
+                return
+            if self._open.get(path) is shared:
+                del self._open[path]
+        shared.close()
+
+    def status(self):
+        """Return shared disk counters for the status page"""
+        with self._lock:
+            return {'shared_disks': len(self._open),
+                    'shared_disk_connections': sum(s.refs for s in self._open.values())}
+
+
+class _SharedDisk:
+    """One open disk, its lock and the flock that marks it attached"""
+
+    def __init__(self, disk, lock_fd):
+        self.disk = disk
+        self.lock_fd = lock_fd
+        self.lock = threading.Lock()
+        self.refs = 0
+
+    def close(self):
+        try:
+            with self.lock:
+                self.disk.flush()
+                self.disk.close()
+        finally:
+            os.close(self.lock_fd)
+
+
+class _SharedDiskHandle:
+    """One connection's reference to a disk in SharedDisks"""
+
+    read_only = False
+    # Every connection goes through the same instance, so flushes cover them all
+    multi_conn = True
+
+    def __init__(self, store, path, shared):
+        self.store = store
+        self.path = path
+        self.shared = shared
+        self.size = shared.disk.size
+        self.closed = False
+
+    def read(self, offset, length):
+        with self.shared.lock:
+            return self.shared.disk.read(offset, length)
+
+    def write(self, offset, data):
+        with self.shared.lock:
+            self.shared.disk.write(offset, data)
+
+    def flush(self):
+        with self.shared.lock:
+            self.shared.disk.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.store.release(self.path, self.shared)
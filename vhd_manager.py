@@ -6,6 +6,14 @@ import time
 import uuid
 from datetime import datetime
 
+from vhd_format import open_disk, create_differencing, exclusive_disk, disk_in_use, DiskInUseError
+from file_clone import clone_file
+from chunk_store import is_manifest, store_for_manifest
+from block_tracking import ChangeTracker
+from io_throttle import CopyThrottle
+from image_integrity import IntegrityManifest, integrity_status
+from boot_trace import BootTrace
+
 logger = logging.getLogger(__name__)
 
 class VHDManager:
@@ -18,8 +26,27 @@ class VHDManager:
     
     def __init__(self):
         # In a real implementation, we would initialize VHD management libraries here
+        self.copy_throttle = CopyThrottle()
         logger.info("VHD Manager initialized")
     
+    def configure_copy_throttle(self, limit_mb_s=0, latency_target_ms=0, low_priority=False, drop_cache=False):
+        """
+        Pace clone, backup and restore I/O so it does not slow down booting clients
+        
+        Applies to copies started afterwards; running copies keep their settings.
+        
+        Args:
+            limit_mb_s (int): Ceiling for all copies together in MB/s; 0 for none
+            latency_target_ms (int): Back off while boot reads are slower than
+                this; 0 to ignore boot latency
+            low_priority (bool): Copy at the lowest I/O priority
+            drop_cache (bool): Keep copies from evicting boot blocks from the page cache
+        """
+        self.copy_throttle = CopyThrottle(limit_mb_s, latency_target_ms, low_priority, drop_cache)
+        if self.copy_throttle.active:
+            logger.info(f"Image copies limited to {limit_mb_s or 'unlimited'} MB/s, "
+                        f"boot latency target {latency_target_ms or 'none'} ms")
+    
     def create_vhd(self, file_path, size_gb):
         """
         Create a new VHD file
@@ -61,6 +88,9 @@ class VHDManager:
             # For the demo, we'll just simulate deletion
             if os.path.exists(file_path):
                 os.remove(file_path)
+                ChangeTracker(file_path).delete()
+                IntegrityManifest(file_path).delete()
+                BootTrace(file_path).delete()
                 logger.info(f"Deleted VHD file at {file_path}")
                 return True
             else:
@@ -70,33 +100,39 @@ class VHDManager:
             logger.error(f"Failed to delete VHD file: {e}")
             return False
     
-    def clone_vhd(self, source_path, target_path):
+    def clone_vhd(self, source_path, target_path, progress=None):
         """
         Clone a VHD file
         
+        Uses a reflink when the filesystem supports it, so cloning a template
+        takes constant time and no extra space; otherwise only the data
+        regions are copied and holes stay holes.
+        
         Args:
             source_path (str): Path to the source VHD file
             target_path (str): Path where the cloned VHD file should be created
+            progress (callable, optional): Called with (bytes done, total bytes)
             
         Returns:
-            bool: True if successful, False otherwise
+            str: Clone strategy used (reflink, copy_file_range, sparse or copy)
+                if successful, None otherwise
         """
         try:
             # Ensure the directory exists
             os.makedirs(os.path.dirname(target_path), exist_ok=True)
             
-            # In a real implementation, we would use a proper VHD cloning library
-            # For the demo, we'll just copy the file
             if os.path.exists(source_path):
-                shutil.copy2(source_path, target_path)
-                logger.info(f"Cloned VHD from {source_path} to {target_path}")
-                return True
+                start = time.time()
+                strategy = clone_file(source_path, target_path, progress=progress, throttle=self.copy_throttle)
+                logger.info(f"Cloned VHD from {source_path} to {target_path} "
+                            f"using {strategy} in {time.time() - start:.2f}s")
+                return strategy
             else:
                 logger.warning(f"Source VHD file at {source_path} does not exist")
-                return False
+                return None
         except Exception as e:
             logger.error(f"Failed to clone VHD file: {e}")
-            return False
+            return None
     
     def mount_vhd(self, file_path, mount_point):
         """
@@ -157,18 +193,24 @@ class VHDManager:
             logger.error(f"Failed to resize VHD file: {e}")
             return False
     
-    def create_restoration_point(self, source_path, name, description, backup_dir):
+    def create_restoration_point(self, source_path, name, description, backup_dir, chunk_store=None,
+                                 progress=None):
         """
         Create a restoration point (backup) of a VHD
         
+        With a chunk store the point is saved as a manifest of deduplicated
+        chunks, so it only costs the chunks that are not stored already.
+        
         Args:
             source_path (str): Path to the source VHD file
             name (str): Name for the restoration point
             description (str): Description of the restoration point
             backup_dir (str): Directory to store the backup
+            chunk_store (ChunkStore, optional): Store to save the point in
+            progress (callable, optional): Called with (bytes done, total bytes)
             
         Returns:
-            str: Path to the backup file if successful, None otherwise
+            str: Path to the backup file or manifest if successful, None otherwise
         """
         try:
             if not os.path.exists(source_path):
@@ -185,24 +227,53 @@ class VHDManager:
             filename = f"{os.path.basename(source_path).split('.')[0]}_{safe_name}_{timestamp}.vhd"
             backup_path = os.path.join(backup_dir, filename)
             
-            # In a real implementation, we would create a differential backup or snapshot
-            # For demonstration, we'll simply copy the file
             logger.info(f"Creating restoration point '{name}' for {source_path}")
-            shutil.copy2(source_path, backup_path)
+            if chunk_store:
+                manifest_path = self._store_point(chunk_store, source_path, filename[:-len('.vhd')],
+                                                  {'name': name, 'description': description}, progress)
+                logger.info(f"Restoration point stored as {manifest_path}")
+                return manifest_path
+            
+            strategy = clone_file(source_path, backup_path, progress=progress, throttle=self.copy_throttle)
             
-            logger.info(f"Restoration point created at {backup_path}")
+            logger.info(f"Restoration point created at {backup_path} using {strategy}")
             return backup_path
         except Exception as e:
             logger.error(f"Failed to create restoration point for {source_path}: {e}")
             return None
             
-    def restore_from_point(self, backup_path, target_path):
+    def _store_point(self, chunk_store, source_path, point_name, meta=None, progress=None):
+        """
+        Save the current state of a VHD in the chunk store
+        
+        When the VHD's change tracker covers every write since the previous
+        point, only the changed blocks are read; otherwise the whole file is
+        chunked. Either way the tracker then starts over from this point.
+        
+        Returns:
+            str: Path to the manifest
+        """
+        tracker = ChangeTracker.load(source_path)
+        if tracker.trusted:
+            manifest_path = chunk_store.put_incremental(source_path, point_name, tracker.base_manifest,
+                                                        tracker.changed_ranges(), kind='restoration_point',
+                                                        meta=meta, progress=progress, throttle=self.copy_throttle)
+        else:
+            manifest_path = chunk_store.put(source_path, point_name, kind='restoration_point', meta=meta,
+                                            progress=progress, throttle=self.copy_throttle)
+        tracker.reset(manifest_path)
+        return manifest_path
+    
+    def restore_from_point(self, backup_path, target_path, progress=None, restore_id=None):
         """
         Restore a VHD from a restoration point
         
         Args:
             backup_path (str): Path to the backup VHD file
             target_path (str): Path where the restored VHD should be placed
+            progress (callable, optional): Called with (bytes done, total bytes)
+            restore_id (str, optional): Identifies this restore, so running it
+                again after an interruption continues where it stopped
             
         Returns:
             bool: True if successful, False otherwise
@@ -212,29 +283,93 @@ class VHDManager:
                 logger.error(f"Backup file {backup_path} does not exist")
                 return False
                 
-            # In a real implementation, we would apply the differential backup or snapshot
-            # For demonstration, we'll simply copy the file
             logger.info(f"Restoring from {backup_path} to {target_path}")
             
+            if is_manifest(backup_path):
+                self._restore_from_manifest(backup_path, target_path, progress, restore_id)
+                logger.info(f"Successfully restored from {backup_path}")
+                return True
+            
             # Create a temporary backup of the current state before restoring
+            # (an interrupted restore never touched the target; clone_file renames into place)
             if os.path.exists(target_path):
                 temp_backup = f"{target_path}.pre_restore.tmp"
                 logger.info(f"Creating temporary backup at {temp_backup}")
-                shutil.copy2(target_path, temp_backup)
+                clone_file(target_path, temp_backup, throttle=self.copy_throttle)
             
             # Restore the file
-            shutil.copy2(backup_path, target_path)
+            strategy = clone_file(backup_path, target_path, progress=progress, throttle=self.copy_throttle)
+            logger.info(f"Restored {target_path} using {strategy}")
             
             logger.info(f"Successfully restored from {backup_path}")
             return True
         except Exception as e:
             logger.error(f"Failed to restore from {backup_path}: {e}")
             return False
+    
+    def _restore_from_manifest(self, manifest_path, target_path, progress=None, restore_id=None):
+        """
+        Restore a VHD from a chunk store point, rewriting only differing blocks
+        
+        The current state is first saved as the VHD's pre-restore point
+        (incrementally when the change tracker allows), which replaces the
+        full .pre_restore.tmp copy and also tells exactly which chunks differ
+        from the point being restored. Running a restore_id again keeps the
+        pre-restore point its first attempt saved and compares every chunk,
+        since the target may be part way between the two states.
+        """
+        store = store_for_manifest(manifest_path)
+        throttle = self.copy_throttle
+        if not os.path.exists(target_path):
+            with throttle.priority():
+                store.restore(manifest_path, target_path, progress=progress, throttle=throttle)
+            ChangeTracker.load(target_path).reset(manifest_path)
+        else:
+            pre_name = f"{os.path.basename(target_path).split('.')[0]}_pre_restore"
+            pre_restore = store.manifest_path(pre_name)
+            if restore_id and os.path.exists(pre_restore) and \
+                    store.load_manifest(pre_restore).get('meta', {}).get('restore_id') == restore_id:
+                ranges = None
+            else:
+                meta = {'restoring': os.path.basename(manifest_path), 'restore_id': restore_id}
+                pre_restore = self._store_point(store, target_path, pre_name, meta, progress)
+                ranges = store.diff_ranges(manifest_path, pre_restore)
+            tracker = ChangeTracker.load(target_path)
+            with throttle.priority():
+                written = store.restore_in_place(manifest_path, target_path, ranges, progress=progress,
+                                                 throttle=throttle)
+            for offset, length in ranges if ranges is not None else [(0, os.path.getsize(target_path))]:
+                tracker.mark(offset, length)
+            tracker.reset(manifest_path)
+            logger.info(f"Rewrote {written / (1024**2):.1f} MB of {target_path}; "
+                        f"current state saved as {pre_restore}")
             
+    @staticmethod
+    def get_differencing_disk(vhd_path):
+        """
+        Get the differencing disk that holds a VHD's super mode changes
+        
+        Args:
+            vhd_path (str): Path to the VHD file
+            
+        Returns:
+            str: Path to the differencing disk, or None if super mode is off
+        """
+        super_mode_marker = f"{vhd_path}.super"
+        try:
+            with open(super_mode_marker) as f:
+                diff_path = f.readline().strip()
+        except FileNotFoundError:
+            return None
+        return diff_path if diff_path and os.path.exists(diff_path) else None
+    
     def enable_super_mode(self, vhd_path, diff_dir=None):
         """
         Set a VHD to super mode, which means changes to it are preserved
         
+        Writes go to a differencing disk whose parent is the VHD; the VHD
+        itself is only changed when the changes are committed.
+        
         Args:
             vhd_path (str): Path to the VHD file
             diff_dir (str, optional): Directory to store differencing disks
@@ -243,20 +378,27 @@ class VHDManager:
             bool: True if successful, False otherwise
         """
         try:
-            # In a real implementation, this would configure the VHD for differencing mode
-            # For demonstration, we'll just log the action
             logger.info(f"Enabling super mode for VHD {vhd_path}")
             
+            if self.get_differencing_disk(vhd_path):
+                logger.info(f"VHD {vhd_path} is already in super mode")
+                return True
+            
             # If differencing directory is provided, ensure it exists
             if diff_dir and not os.path.exists(diff_dir):
                 os.makedirs(diff_dir)
-                
-            # In a real implementation, we would create a differencing disk here
-            # For demonstration, we'll just create a stub file to indicate super mode
+            
+            diff_path = os.path.join(diff_dir or os.path.dirname(vhd_path),
+                                     f"{os.path.basename(vhd_path)}.diff.vhd")
+            create_differencing(diff_path, vhd_path)
+            
+            # The marker records where the differencing disk lives
             super_mode_marker = f"{vhd_path}.super"
             with open(super_mode_marker, 'w') as f:
-                f.write(f"Super mode enabled at {datetime.now()}")
-                
+                f.write(f"{diff_path}\n")
+                f.write(f"Super mode enabled at {datetime.now()}\n")
+            
+            logger.info(f"Created differencing disk {diff_path}")
             return True
         except Exception as e:
             logger.error(f"Failed to enable super mode for VHD {vhd_path}: {e}")
@@ -276,17 +418,40 @@ class VHDManager:
         try:
             logger.info(f"Disabling super mode for VHD {vhd_path}")
             
-            # In a real implementation, we would merge/discard differencing disks
-            # For demonstration, we'll just remove the marker file
+            diff_path = self.get_differencing_disk(vhd_path)
+            if diff_path:
+                with exclusive_disk(diff_path):
+                    if commit_changes and not self._merge(diff_path):
+                        return False
+                    os.remove(diff_path)
+                    os.remove(f"{diff_path}.lock")
             super_mode_marker = f"{vhd_path}.super"
             if os.path.exists(super_mode_marker):
                 os.remove(super_mode_marker)
             
             return True
+        except DiskInUseError:
+            logger.warning(f"Not disabling super mode for VHD {vhd_path}: clients are attached")
+            return False
         except Exception as e:
             logger.error(f"Failed to disable super mode for VHD {vhd_path}: {e}")
             return False
     
+    def super_mode_in_use(self, vhd_path):
+        """
+        Check whether clients are attached to a VHD's differencing disk
+        
+        Changes cannot be committed or discarded while they are.
+        
+        Args:
+            vhd_path (str): Path to the VHD file
+            
+        Returns:
+            bool: True if the differencing disk is attached
+        """
+        diff_path = self.get_differencing_disk(vhd_path)
+        return bool(diff_path) and disk_in_use(diff_path)
+    
     def commit_changes(self, vhd_path):
         """
         Commit changes made to a VHD in super mode
@@ -298,17 +463,23 @@ class VHDManager:
             bool: True if successful, False otherwise
         """
         try:
-            # In a real implementation, this would merge differencing disks or commit changes
-            # For demonstration, we'll just log the action
             logger.info(f"Committing changes to VHD {vhd_path}")
             
-            # In a real implementation, we would merge differencing disks here
-            # For demonstration purposes, we'll just update the modification time
-            if os.path.exists(vhd_path):
-                # Touch the file to update modification time
-                os.utime(vhd_path, None)
+            diff_path = self.get_differencing_disk(vhd_path)
+            if not diff_path:
+                logger.warning(f"VHD {vhd_path} has no differencing disk to commit")
+                return False
+            
+            with exclusive_disk(diff_path):
+                if not self._merge(diff_path):
+                    return False
                 
+                # Start over with an empty child so the same sectors are not merged twice
+                create_differencing(diff_path, vhd_path)
             return True
+        except DiskInUseError:
+            logger.warning(f"Not committing changes to VHD {vhd_path}: clients are attached")
+            return False
         except Exception as e:
             logger.error(f"Failed to commit changes to VHD {vhd_path}: {e}")
             return False
@@ -324,17 +495,93 @@ class VHDManager:
             bool: True if successful, False otherwise
         """
         try:
-            # In a real implementation, this would discard differencing disks or changes
-            # For demonstration, we'll just log the action
             logger.info(f"Discarding changes to VHD {vhd_path}")
             
-            # In a real implementation, we would discard differencing disks here
+            diff_path = self.get_differencing_disk(vhd_path)
+            if not diff_path:
+                logger.warning(f"VHD {vhd_path} has no differencing disk to discard")
+                return False
             
+            # Dropping the child is all it takes; the parent was never written
+            with exclusive_disk(diff_path):
+                os.remove(diff_path)
+                create_differencing(diff_path, vhd_path)
             return True
+        except DiskInUseError:
+            logger.warning(f"Not discarding changes to VHD {vhd_path}: clients are attached")
+            return False
         except Exception as e:
             logger.error(f"Failed to discard changes to VHD {vhd_path}: {e}")
             return False
     
+    def _merge(self, diff_path):
+        """
+        Write the sectors stored in a differencing disk into its parent
+        
+        Only allocated blocks are visited, so the cost follows the size of
+        the changes rather than the size of the image.
+        
+        Args:
+            diff_path (str): Path to the differencing disk
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            disk = open_disk(diff_path, parent_writable=True)
+            try:
+                start = time.time()
+                tracker = ChangeTracker.load(disk.parent.path)
+                for offset, length in disk.dirty_extents():
+                    tracker.mark(offset, length)
+                merged = disk.commit()
+            finally:
+                disk.close()
+            tracker.save()
+            logger.info(f"Merged {merged / (1024**2):.1f} MB from {diff_path} in {time.time() - start:.2f}s")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to merge differencing disk {diff_path}: {e}")
+            return False
+    
+    def verify_vhd(self, file_path, full=False, progress=None):
+        """
+        Check a VHD against its per-block hash manifest
+        
+        The first call builds the manifest. Later calls only rehash blocks
+        written since the last verification unless full is set.
+        
+        Args:
+            file_path (str): Path to the VHD file
+            full (bool): Rehash every block
+            progress (callable, optional): Called with (bytes hashed, total bytes)
+            
+        Returns:
+            dict: Verification status, or None if an error occurred
+        """
+        try:
+            return IntegrityManifest.load(file_path).verify(full=full, progress=progress)
+        except Exception as e:
+            logger.error(f"Failed to verify VHD {file_path}: {e}")
+            return None
+    
+    def accept_vhd_contents(self, file_path, progress=None):
+        """
+        Accept a VHD's current contents as correct and rebuild its hash manifest
+        
+        Args:
+            file_path (str): Path to the VHD file
+            progress (callable, optional): Called with (bytes hashed, total bytes)
+            
+        Returns:
+            dict: Verification status, or None if an error occurred
+        """
+        try:
+            return IntegrityManifest(file_path).build(progress=progress)
+        except Exception as e:
+            logger.error(f"Failed to rebuild hash manifest for VHD {file_path}: {e}")
+            return None
+    
     def is_super_mode_enabled(self, vhd_path):
         """
         Check if super mode is enabled for a VHD
@@ -369,13 +616,26 @@ class VHDManager:
                 # Check if super mode is enabled
                 is_super = self.is_super_mode_enabled(file_path)
                 
+                # Size of the super mode changes waiting to be committed
+                pending_bytes = 0
+                diff_path = self.get_differencing_disk(file_path)
+                if diff_path:
+                    disk = open_disk(diff_path)
+                    try:
+                        pending_bytes = disk.dirty_bytes()
+                    finally:
+                        disk.close()
+                
                 return {
                     'size_bytes': size,
                     'size_gb': size / (1024**3),
                     'created': created_time,
                     'modified': modified_time,
                     'file_path': file_path,
-                    'is_super_mode': is_super
+                    'is_super_mode': is_super,
+                    'differencing_disk': diff_path,
+                    'pending_changes_bytes': pending_bytes,
+                    'integrity': integrity_status(file_path)
                 }
             else:
                 logger.warning(f"VHD file at {file_path} does not exist")
@@ -0,0 +1,310 @@
+import os
+import glob
+import struct
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+OVERLAY_MAGIC = b'GNMOVL1\0'
+# magic, block size, virtual size, base inode, base size, base mtime
+HEADER_FORMAT = '!8sIQQQQ'
+HEADER_SIZE = 4096
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def _round_up(value, multiple):
+    return (value + multiple - 1) // multiple * multiple
+
+
+class WriteOverlay:
+    """
+    Copy-on-write layer over a read-only base export
+
+    Writes land in a sparse overlay file at the same offset they have in the
+    image, behind a header and a dirty-block bitmap:
+
+        [header][bitmap, one bit per block][data area, sparse]
+
+    A read tests one bit per block and goes to the overlay for dirty blocks
+    and to the shared base mapping for everything else; runs of blocks in
+    the same state are read in one go. The overlay is a single file, so
+    throwing away a client's changes is one unlink.
+    """
+
+    read_only = False
+    multi_conn = True
+
+    def __init__(self, base, path, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Args:
+            base: Read-only export the overlay sits on (an nbd_server.ImageExport)
+            path (str): Overlay file; reused when it was made for the same base
+            block_size (int): Copy-on-write granularity in bytes
+        """
+        self.base = base
+        self.path = path
+        self.size = base.size
+        self.refs = 0
+        self.dirty_blocks = 0
+        self._bitmap_dirty = set()
+
+        st = os.stat(base.path)
+        identity = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not self._load(identity):
+                self._create(identity, block_size)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def _load(self, identity):
+        header = os.pread(self.fd, struct.calcsize(HEADER_FORMAT), 0)
+        if len(header) < struct.calcsize(HEADER_FORMAT):
+            return False
+        magic, block_size, size, *base_identity = struct.unpack(HEADER_FORMAT, header)
+        if magic != OVERLAY_MAGIC or size != self.size or tuple(base_identity) != identity:
+            # The golden image changed underneath; old blocks no longer apply
+            logger.info(f"Resetting stale overlay {self.path}")
+            return False
+
+        self._layout(block_size)
+        self.bitmap = bytearray(os.pread(self.fd, self.bitmap_size, HEADER_SIZE))
+        self.bitmap.extend(bytes(self.bitmap_size - len(self.bitmap)))
+        self.dirty_blocks = sum(bin(byte).count('1') for byte in self.bitmap if byte)
+        return True
+
+    def _create(self, identity, block_size):
+        self._layout(block_size)
+        self.bitmap = bytearray(self.bitmap_size)
+        os.ftruncate(self.fd, 0)
+        os.ftruncate(self.fd, self.data_offset + self.size)
+        os.pwrite(self.fd, struct.pack(HEADER_FORMAT, OVERLAY_MAGIC, block_size, self.size, *identity), 0)
+
+    def _layout(self, block_size):
+        self.block_size = block_size
+        self.blocks = (self.size + block_size - 1) // block_size
+        self.bitmap_size = _round_up((self.blocks + 7) // 8, HEADER_SIZE)
+        self.data_offset = HEADER_SIZE + self.bitmap_size
+
+    def is_dirty(self, block):
+        return self.bitmap[block >> 3] & (1 << (block & 7))
+
+    def _mark_dirty(self, first, last):
+        for block in range(first, last + 1):
+            bit = 1 << (block & 7)
+            if not self.bitmap[block >> 3] & bit:
+                self.bitmap[block >> 3] |= bit
+                self.dirty_blocks += 1
+                self._bitmap_dirty.add((block >> 3) // HEADER_SIZE)
+
+    def read(self, offset, length):
+        """Return length bytes at offset, dirty blocks from the overlay"""
+        if not self.dirty_blocks or not length:
+            return self.base.read(offset, length)
+
+        bs = self.block_size
+        end = offset + length
+        block = offset // bs
+        last = (end - 1) // bs
+        pieces = []
+        position = offset
+        while block <= last:
+            dirty = self.is_dirty(block)
+            run_end = block + 1
+            while run_end <= last and bool(self.is_dirty(run_end)) == bool(dirty):
+                run_end += 1
+            stop = min(run_end * bs, end)
+            if dirty:
+                pieces.append(os.pread(self.fd, stop - position, self.data_offset + position))
+            else:
+                pieces.append(self.base.read(position, stop - position))
+            position = stop
+            block = run_end
+
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    def write(self, offset, data):
+        """Write data at offset, copying clean edge blocks up from the base first"""
+        if not data:
+            return
+        bs = self.block_size
+        end = offset + len(data)
+        first = offset // bs
+        last = (end - 1) // bs
+        start = offset
+        head = tail = b''
+
+        block_start = first * bs
+        if offset > block_start and not self.is_dirty(first):
+            head = self.base.read(block_start, offset - block_start)
+            start = block_start
+        block_end = min((last + 1) * bs, self.size)
+        if end < block_end and not self.is_dirty(last):
+            tail = self.base.read(end, block_end - end)
+
+        buffer = b''.join((head, data, tail)) if head or tail else data
+        written = os.pwrite(self.fd, buffer, self.data_offset + start)
+        if written != len(buffer):
+            raise OSError(f"short write to overlay {self.path}")
+        self._mark_dirty(first, last)
+
+    def flush(self):
+        """Persist the bitmap pages touched since the last flush, then the file"""
+        for page in sorted(self._bitmap_dirty):
+            chunk = self.bitmap[page * HEADER_SIZE:(page + 1) * HEADER_SIZE]
+            os.pwrite(self.fd, chunk, HEADER_SIZE + page * HEADER_SIZE)
+        self._bitmap_dirty.clear()
+        os.fsync(self.fd)
+
+    def close(self):
+        """Drop the overlay file descriptor and the base mapping"""
+        try:
+            self.flush()
+        except OSError as e:
+            # The file may already be discarded; its changes are gone anyway
+            logger.debug(f"Could not flush overlay {self.path}: {e}")
+        os.close(self.fd)
+        self.base.close()
+
+
+class OverlayStore:
+    """
+    Per-client overlays, one shared instance per client
+
+    Every connection a client opens gets the same WriteOverlay, so blocks
+    written on one connection are visible on all of them. Overlays are kept
+    in one directory, named after the client and its base image.
+    """
+
+    def __init__(self, directory, block_size=DEFAULT_BLOCK_SIZE):
+        self.directory = directory
+        self.block_size = block_size
+        self._open = {}
+        self._lock = threading.Lock()
+        self.discarded = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _prefix(self, name):
+        safe = name.replace(':', '-').replace('/', '_').replace('\\', '_').lower()
+        return os.path.join(self.directory, safe)
+
+    def path_for(self, name, base_path):
+        """
+        Overlay file for a client name (its MAC address) on one base image
+
+        The base is part of the name, so a client moved to another image
+        never reuses, or truncates, the file its old image's overlay is
+        still writing to.
+        """
+        digest = hashlib.sha1(os.path.abspath(base_path).encode('utf-8')).hexdigest()[:12]
+        return f"{self._prefix(name)}-{digest}.overlay"
+
+    def open(self, name, base):
+        """
+        Get the client's overlay, creating it on first use
+
+        Args:
+            name (str): Client name (its MAC address)
+            base: Read-only export of the client's image; the store takes
+                ownership of it
+
+        Returns:
+            _OverlayHandle: Handle to close when the connection ends
+        """
+        with self._lock:
+            overlay = self._open.get(name)
+            if overlay is not None and overlay.base.path != base.path:
+                # The client was moved to another image; the old overlay stays
+                # with the connections that still use it until they close
+                del self._open[name]
+                overlay = None
+            if overlay is None:
+                path = self.path_for(name, base.path)
+                # Changes made on any other image are stale now
+                for stale in self._paths(name):
+                    if stale != path:
+                        self._unlink(stale)
+                overlay = WriteOverlay(base, path, self.block_size)
+                self._open[name] = overlay
+            else:
+                base.close()
+            overlay.refs += 1
+            return _OverlayHandle(self, name, overlay)
+
+    def release(self, name, overlay):
+        with self._lock:
+            overlay.refs -= 1
+            if overlay.refs > 0:
+                return
+            if self._open.get(name) is overlay:
+                del self._open[name]
+        overlay.close()
+
+    def _paths(self, name):
+        return glob.glob(f"{glob.escape(self._prefix(name))}-*.overlay")
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def discard(self, name):
+        """
+        Throw away every change a client made
+
+        Open connections keep writing to the unlinked file until they close;
+        the next connection starts from the clean base image.
+        """
+        with self._lock:
+            self._open.pop(name, None)
+        if not sum(self._unlink(path) for path in self._paths(name)):
+            return False
+        self.discarded += 1
+        logger.info(f"Discarded write overlay of {name}")
+        return True
+
+    def status(self):
+        """Return overlay counters for the status page"""
+        with self._lock:
+            overlays = list(self._open.values())
+        return {
+            'open_overlays': len(overlays),
+            'dirty_bytes': sum(o.dirty_blocks * o.block_size for o in overlays),
+            'discarded': self.discarded,
+        }
+
+
+class _OverlayHandle:
+    """One connection's reference to a shared WriteOverlay"""
+
+    read_only = False
+    multi_conn = True
+
+    def __init__(self, store, name, overlay):
+        self.store = store
+        self.name = name
+        self.overlay = overlay
+        self.path = overlay.base.path
+        self.size = overlay.size
+        self.closed = False
+
+    def read(self, offset, length):
+        return self.overlay.read(offset, length)
+
+    def write(self, offset, data):
+        self.overlay.write(offset, data)
+
+    def flush(self):
+        self.overlay.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.store.release(self.name, self.overlay)